@@ -0,0 +1,119 @@
+import time
+import socket
+import logging
+
+from typing import Callable, Dict, Iterable
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from rpc import get_pool, abandon, REQUEST_TIMEOUT
+from shard_map import ShardMap, admin_port
+
+# --- Constants ---
+MAX_RETRIES = 10          # connection attempts before giving up on a worker
+RETRY_DELAY = 2           # seconds between attempts
+FANOUT_TIMEOUT = 10.0     # seconds a scatter waits for all shards together
+
+replication_pool = ThreadPoolExecutor(max_workers=8)
+fanout_pool = ThreadPoolExecutor(max_workers=32)
+
+# --- Worker admin calls ---
+def send_admin_command(command: str, data: dict, worker_port: int,
+                       retries: int = MAX_RETRIES) -> dict:
+    """Run one admin command on the worker serving `worker_port`."""
+    admin = admin_port(worker_port)
+    last_err = None
+
+    for attempt in range(1, retries + 1):
+        try:
+            # Only connecting is retried; a request that reached the worker
+            # is never resent, so an 'add' can't be applied twice
+            future = get_pool(admin).submit({'command': command, **data})
+        except (ConnectionRefusedError, socket.timeout) as e:
+            last_err = e
+            logging.warning(f"[admin] attempt {attempt}/{retries} failed to connect to port {admin}: {e}")
+            if attempt < retries:
+                time.sleep(RETRY_DELAY)
+            continue
+        except Exception as e:
+            logging.error(f"[admin] unexpected error talking to worker {worker_port}: {e}")
+            return {'status': 'error', 'message': str(e)}
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except Exception as e:
+            logging.error(f"[admin] unexpected error talking to worker {worker_port}: {e}")
+            return {'status': 'error', 'message': str(e) or type(e).__name__}
+        finally:
+            abandon(future)
+
+    msg = f"Could not connect to worker {worker_port} admin port {admin} after {retries} attempts: {last_err}"
+    logging.error(msg)
+    return {'status': 'error', 'message': msg}
+
+def connect_retries(shard_map: ShardMap, shard_id: int) -> int:
+    """With other replicas to fall back on, don't wait out a dead one."""
+    return MAX_RETRIES if len(shard_map.replicas(shard_id)) == 1 else 1
+
+def read_shard(shard_map: ShardMap, command: str, data: dict, shard_id: int,
+               retries: int = None) -> dict:
+    """Run a read-only command on the first replica of `shard_id` that answers."""
+    errors = []
+    for port in shard_map.replicas(shard_id):
+        resp = send_admin_command(command, data, port,
+                                  retries or connect_retries(shard_map, shard_id))
+        if resp.get('status') == 'success':
+            return resp
+        errors.append(f"Worker {port}: {resp.get('message')}")
+    return {'status': 'error', 'message': '; '.join(errors)}
+
+def write_shard(shard_map: ShardMap, command: str, data: dict, shard_id: int,
+                retries: int = None) -> dict:
+    """Apply an add/remove to every replica of `shard_id`.
+
+    The first replica that accepts the write applies it and assigns its
+    doc IDs and LSN; the rest then apply that same operation. Replicas
+    that miss it ('lagging') catch up from their peers' logs.
+    """
+    replicas = shard_map.replicas(shard_id)
+    errors = []
+    lagging = []
+    for port in replicas:
+        resp = send_admin_command(command, data, port,
+                                  retries or connect_retries(shard_map, shard_id))
+        if resp.get('status') == 'success':
+            break
+        errors.append(f"Worker {port}: {resp.get('message')}")
+        lagging.append(port)
+    else:
+        return {'status': 'error', 'message': '; '.join(errors)}
+
+    op = dict(data, lsn=resp['lsn'])
+    if command == 'add':
+        op['doc_ids'] = resp['doc_ids']
+    followers = replicas[len(lagging) + 1:]
+    futures = [replication_pool.submit(send_admin_command, command, op, p, 1) for p in followers]
+    for port, future in zip(followers, futures):
+        if future.result().get('status') != 'success':
+            lagging.append(port)
+    return dict(resp, lagging=lagging or None)
+
+def scatter(call: Callable[[int], dict], shard_ids: Iterable[int],
+            timeout: float = FANOUT_TIMEOUT) -> Dict[int, dict]:
+    """Run `call(shard_id)` for every shard at once; {shard_id: reply}.
+
+    Waits at most `timeout` for all of them together. A shard with no
+    reply by then gets an error reply marked 'timed_out'; its call is
+    left to finish in the background, so a write may still be applied.
+    """
+    futures = {shard_id: fanout_pool.submit(call, shard_id) for shard_id in shard_ids}
+    done, _ = wait(futures.values(), timeout)
+    replies = {}
+    for shard_id, future in futures.items():
+        if future not in done:
+            replies[shard_id] = {'status': 'error', 'timed_out': True,
+                                 'message': f'No reply within {timeout:g} s'}
+            continue
+        try:
+            replies[shard_id] = future.result()
+        except Exception as e:
+            replies[shard_id] = {'status': 'error', 'message': str(e)}
+    return replies
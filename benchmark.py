@@ -0,0 +1,607 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import heapq
+import itertools
+import socket
+import asyncio
+import argparse
+import threading
+import numpy as np
+
+from collections import deque
+from typing import Dict, Callable, List, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import send_message, receive_message, JSON, BINARY
+from rpc import serve_connection, get_pool
+from routing import ShardRouter
+from shard_map import ShardMap
+from doc_ids import make_doc_id
+from admin import write_shard, send_admin_command
+from models import StubModel, MODEL_ENV, STUB_MODEL
+
+# --- Baseline: the original <END>-marker framing ---
+LEGACY_BUFFER_SIZE = 4096
+LEGACY_END_MARKER = "<END>"
+
+def legacy_receive(sock: socket.socket) -> Dict:
+    data = ""
+    while True:
+        chunk = sock.recv(LEGACY_BUFFER_SIZE).decode('utf-8')
+        if not chunk:
+            break
+        if LEGACY_END_MARKER in chunk:
+            data += chunk[:chunk.index(LEGACY_END_MARKER)]
+            break
+        data += chunk
+    return json.loads(data)
+
+def legacy_send(sock: socket.socket, payload: Dict) -> None:
+    if isinstance(payload.get('embedding'), np.ndarray):
+        payload = dict(payload, embedding=payload['embedding'].tolist())
+    data_str = json.dumps(payload) + LEGACY_END_MARKER
+    for i in range(0, len(data_str), LEGACY_BUFFER_SIZE):
+        sock.sendall(data_str[i:i + LEGACY_BUFFER_SIZE].encode('utf-8'))
+
+# --- Protocol benchmark ---
+def _round_trips(send: Callable, receive: Callable, query: Dict, reply: Dict,
+                 messages: int) -> float:
+    """Seconds for `messages` query/reply round trips over a socketpair."""
+    a, b = socket.socketpair()
+
+    def echo():
+        for _ in range(messages):
+            receive(b)
+            send(b, reply)
+
+    server = threading.Thread(target=echo, daemon=True)
+    server.start()
+    start = time.perf_counter()
+    for _ in range(messages):
+        send(a, query)
+        receive(a)
+    elapsed = time.perf_counter() - start
+    server.join()
+    a.close()
+    b.close()
+    return elapsed
+
+def bench_protocol(args) -> Dict:
+    """Compare legacy framing, the fixed JSON framing and binary frames."""
+    rng = np.random.default_rng(0)
+    query = {'embedding': rng.standard_normal(args.dim).astype(np.float32)}
+    reply = {'results': [
+        {'doc_id': make_doc_id(1, i), 'document': f"document {i} " * 8, 'score': float(s)}
+        for i, s in enumerate(rng.random(args.results))
+    ]}
+
+    variants = {
+        'legacy': (legacy_send, legacy_receive),
+        JSON: (lambda s, p: send_message(s, p, JSON), lambda s: receive_message(s)[0]),
+        BINARY: (lambda s, p: send_message(s, p, BINARY), lambda s: receive_message(s)[0]),
+    }
+    report = {}
+    for name, (send, receive) in variants.items():
+        elapsed = _round_trips(send, receive, query, reply, args.messages)
+        report[name] = {
+            'round_trips_per_s': round(args.messages / elapsed, 1),
+            'us_per_round_trip': round(1e6 * elapsed / args.messages, 1),
+        }
+        print(f"{name:>7}: {report[name]['round_trips_per_s']:>10} round trips/s "
+              f"({report[name]['us_per_round_trip']} us each)")
+    return report
+
+# --- Top-k benchmark ---
+def _best_ms(fn: Callable, repeats: int) -> float:
+    """Fastest of `repeats` runs, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best
+
+def bench_topk(args) -> Dict:
+    """Full argsort vs argpartition selection, and sort vs heap merge."""
+    rng = np.random.default_rng(0)
+    report = {'select': [], 'merge': []}
+
+    print(f"Shard top-{args.top_k} selection (ms):")
+    for n in args.sizes:
+        sims = rng.standard_normal(n).astype(np.float32)
+        argsort_ms = _best_ms(lambda: np.argsort(sims)[::-1][:args.top_k], args.repeats)
+        def partition():
+            idx = np.argpartition(-sims, args.top_k - 1)[:args.top_k]
+            return idx[np.argsort(-sims[idx])]
+        partition_ms = _best_ms(partition, args.repeats)
+        report['select'].append({'rows': n, 'argsort_ms': round(argsort_ms, 3),
+                                 'argpartition_ms': round(partition_ms, 3),
+                                 'speedup': round(argsort_ms / partition_ms, 1)})
+        print(f"{n:>10} rows: argsort {argsort_ms:8.3f}  argpartition {partition_ms:8.3f}"
+              f"  ({argsort_ms / partition_ms:.1f}x)")
+
+    print(f"Master merge of per-worker top-{args.top_k} lists (ms):")
+    for workers in args.workers:
+        lists = [sorted(({'doc_id': i, 'score': float(s)}
+                         for i, s in enumerate(rng.random(args.top_k))),
+                        key=lambda r: r['score'], reverse=True)
+                 for _ in range(workers)]
+        def sort_merge():
+            flat = [r for results in lists for r in results]
+            return sorted(flat, key=lambda r: r['score'], reverse=True)[:args.top_k]
+        def heap_merge():
+            merged = heapq.merge(*lists, key=lambda r: r['score'], reverse=True)
+            return list(itertools.islice(merged, args.top_k))
+        sort_ms = _best_ms(sort_merge, args.repeats)
+        heap_ms = _best_ms(heap_merge, args.repeats)
+        report['merge'].append({'workers': workers, 'sort_ms': round(sort_ms, 4),
+                                'heap_ms': round(heap_ms, 4),
+                                'speedup': round(sort_ms / heap_ms, 1)})
+        print(f"{workers:>10} workers: sort {sort_ms:8.4f}  heapq.merge {heap_ms:8.4f}"
+              f"  ({sort_ms / heap_ms:.1f}x)")
+    return report
+
+# --- Hedging / fault-injection benchmark ---
+def _stand_in_worker(latency: Callable[[], float]) -> int:
+    """Local fake worker answering queries after `latency()` seconds; returns its port."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', 0))
+    server.listen(16)
+    executor = ThreadPoolExecutor(max_workers=64)
+
+    def handle(req: Dict) -> Dict:
+        time.sleep(latency())
+        return {'results': [{'doc_id': i, 'score': 1.0 / (i + 1)} for i in range(req.get('top_k', 3))],
+                'version': 1}
+
+    def accept_loop():
+        while True:
+            client, _ = server.accept()
+            threading.Thread(target=serve_connection, args=(client, handle, executor),
+                             daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return server.getsockname()[1]
+
+def _run_router(router: ShardRouter, queries: int, concurrency: int, timeout: float) -> Dict:
+    """Drive `queries` fan-outs through `router` from a closed loop of `concurrency` clients."""
+    latencies, partial = [], 0
+
+    async def one():
+        nonlocal partial
+        start = time.perf_counter()
+        replies = await router.fan_out({'embedding': np.zeros(4, dtype=np.float32)}, timeout)
+        latencies.append(1000 * (time.perf_counter() - start))
+        partial += any(resp is None for _, _, resp in replies)
+
+    async def main():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def guarded():
+            async with slots:
+                await one()
+        await asyncio.gather(*[guarded() for _ in range(queries)])
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - start
+    lat = np.array(latencies)
+    return {'qps': round(queries / elapsed, 1),
+            'p50_ms': round(float(np.percentile(lat, 50)), 2),
+            'p99_ms': round(float(np.percentile(lat, 99)), 2),
+            'max_ms': round(float(lat.max()), 2),
+            'partial': partial,
+            'hedges': router.counters['hedges'],
+            'hedge_wins': router.counters['hedge_wins']}
+
+def bench_hedging(args) -> Dict:
+    """p99 with and without hedging against stand-in workers that stall at random.
+
+    Workers and clients share this process and its CPU: at high
+    `concurrency` the clients hedging frees from stalls queue for that CPU
+    instead, which shows up as a higher p50.
+    """
+    rng = np.random.default_rng(0)
+    lock = threading.Lock()
+
+    def latency() -> float:
+        with lock:
+            stall = rng.random() < args.stall_rate
+        return (args.stall_ms if stall else args.base_ms) / 1000
+
+    shards = [[_stand_in_worker(latency) for _ in range(args.replicas)]
+              for _ in range(args.shards)]
+    if args.hung:
+        # One replica of shard 1 never answers within the deadline
+        shards[0][0] = _stand_in_worker(lambda: 2 * args.deadline_ms / 1000)
+
+    report = {}
+    for name, percentile in (('no_hedge', None), ('hedge', args.hedge_percentile)):
+        router = ShardRouter(shards, timeout=args.deadline_ms / 1000,
+                             hedge_percentile=percentile)
+        # Warm-up fills the connection pools and the latency windows
+        _run_router(router, 200, args.concurrency, args.deadline_ms / 1000)
+        router.counters.update(hedges=0, hedge_wins=0)
+        report[name] = _run_router(router, args.queries, args.concurrency,
+                                   args.deadline_ms / 1000)
+        r = report[name]
+        print(f"{name:>9}: {r['qps']:7.1f} q/s  p50 {r['p50_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms  "
+              f"max {r['max_ms']:7.2f} ms  partial {r['partial']:>4}  "
+              f"hedges {r['hedges']:>4} (won {r['hedge_wins']})")
+    return report
+
+# --- Local cluster benchmark ---
+BASE_PORT = 7000           # master port; workers take the ports after it
+READY_TIMEOUT = 120.0      # seconds to wait for the cluster to come up
+CORPUS_CHUNK = 10000       # synthetic documents generated and sent per step
+SEND_WINDOW = 4            # 'add' requests in flight while generating the next chunk
+VOCAB_SIZE = 20000         # distinct words in the synthetic corpus
+ZIPF_EXPONENT = 1.1        # word frequencies fall off like natural text
+DOC_WORDS = 12
+QUERY_WORDS = 3
+QUERY_POOL = 1000          # distinct query texts drawn from for load
+
+def zipf_words(rng: np.random.Generator, size: int = VOCAB_SIZE,
+               exponent: float = ZIPF_EXPONENT) -> Callable[[Tuple], np.ndarray]:
+    """Sampler of word IDs in [0, size) with Zipf-distributed frequencies."""
+    p = 1.0 / np.arange(1, size + 1) ** exponent
+    cdf = np.cumsum(p / p.sum())
+    return lambda shape: np.minimum(np.searchsorted(cdf, rng.random(shape)), size - 1)
+
+def synthetic_corpus(docs: int, model: StubModel, seed: int = 0,
+                     chunk: int = CORPUS_CHUNK) -> Iterator[Tuple[List[str], np.ndarray]]:
+    """(texts, embeddings) chunks of a synthetic corpus, generated as they're consumed.
+
+    Embeddings equal `model.encode(texts)` but are summed from a token
+    table with NumPy, so millions of documents take seconds, not hours.
+    """
+    rng = np.random.default_rng(seed)
+    sample = zipf_words(rng)
+    vocab = [f"w{i}" for i in range(VOCAB_SIZE)]
+    table = np.stack([model.token_vector(word) for word in vocab])
+    for start in range(0, docs, chunk):
+        ids = sample((min(chunk, docs - start), DOC_WORDS))
+        vectors = np.zeros((len(ids), model.dim), dtype=np.float32)
+        for j in range(DOC_WORDS):
+            vectors += table[ids[:, j]]
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        yield [' '.join(vocab[w] for w in row) for row in ids.tolist()], vectors
+
+def synthetic_queries(count: int, seed: int = 1) -> List[str]:
+    sample = zipf_words(np.random.default_rng(seed))
+    return [' '.join(f"w{w}" for w in row) for row in sample((count, QUERY_WORDS)).tolist()]
+
+def rss_mb(pid: int) -> float:
+    """Resident memory of a process (Linux /proc; None elsewhere)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+class LocalCluster:
+    """A master and one worker per shard as local subprocesses, using the stub model."""
+
+    def __init__(self, args):
+        self.args = args
+        self.master_port = args.port
+        self.shard_map = ShardMap({i: [args.port + i] for i in range(1, args.workers + 1)})
+        self.log_dir = tempfile.mkdtemp(prefix="search-bench-")
+        self.procs: Dict[str, subprocess.Popen] = {}
+
+    def spawn(self, name: str, argv: List[str]):
+        env = dict(os.environ, **{MODEL_ENV: STUB_MODEL})
+        log = open(os.path.join(self.log_dir, f"{name}.log"), 'w')
+        self.procs[name] = subprocess.Popen([sys.executable] + argv, env=env, stdout=log,
+                                            stderr=subprocess.STDOUT,
+                                            cwd=os.path.dirname(os.path.abspath(__file__)))
+        log.close()
+
+    def wait_ready(self, name: str, port: int, deadline: float):
+        while True:
+            if self.procs[name].poll() is not None:
+                raise RuntimeError(f"{name} exited; see {self.log_dir}/{name}.log")
+            try:
+                if get_pool(port).request({'command': 'ping'}, timeout=1.0).get('pong'):
+                    return
+            except Exception:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{name} not ready after {READY_TIMEOUT}s; see {self.log_dir}")
+            time.sleep(0.2)
+
+    def start(self):
+        args = self.args
+        map_path = os.path.join(self.log_dir, "shard_map.json")
+        with open(map_path, 'w') as f:
+            json.dump(self.shard_map.to_dict(), f)
+        service = []
+        if args.shared_encoder:
+            embedder_port = self.master_port + args.workers + 1
+            self.spawn("embedder", ["embedder.py", "--port", str(embedder_port)])
+            service = ["--embedding_service", str(embedder_port)]
+        for shard_id in self.shard_map.ids:
+            self.spawn(f"worker{shard_id}", [
+                "worker.py", "--port", str(self.shard_map.replicas(shard_id)[0]),
+                "--worker_id", str(shard_id), "--index", args.index,
+                "--nlist", str(args.nlist), "--nprobe", str(args.nprobe),
+                "--storage", args.storage, "--rerank", str(args.rerank),
+                "--query_threads", str(args.query_threads), "--shard_map", map_path] + service)
+        self.spawn("master", ["master.py", "--port", str(self.master_port),
+                              "--shard_map", map_path,
+                              "--result_cache", str(args.result_cache)] + service)
+        deadline = time.monotonic() + READY_TIMEOUT
+        if args.shared_encoder:
+            self.wait_ready("embedder", embedder_port, deadline)
+        for shard_id in self.shard_map.ids:
+            self.wait_ready(f"worker{shard_id}", self.shard_map.replicas(shard_id)[0], deadline)
+        self.wait_ready("master", self.master_port, deadline)
+
+    def stop(self, keep_logs: bool = False):
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if not keep_logs:
+            shutil.rmtree(self.log_dir, ignore_errors=True)
+
+def _latency_report(latencies_ms: List[float], errors: int, elapsed: float) -> Dict:
+    lat = np.array(latencies_ms) if latencies_ms else np.zeros(1)
+    return {'queries': len(latencies_ms), 'errors': errors,
+            'qps': round(len(latencies_ms) / elapsed, 1),
+            'p50_ms': round(float(np.percentile(lat, 50)), 2),
+            'p95_ms': round(float(np.percentile(lat, 95)), 2),
+            'p99_ms': round(float(np.percentile(lat, 99)), 2),
+            'max_ms': round(float(lat.max()), 2)}
+
+def ingest_corpus(cluster: LocalCluster, docs: int, model: StubModel) -> Dict:
+    """Store a synthetic corpus with precomputed embeddings; returns throughput."""
+    shard_map = cluster.shard_map
+    senders = ThreadPoolExecutor(SEND_WINDOW)
+    sending: deque = deque()
+    stored, errors = 0, []
+
+    def finish_send():
+        nonlocal stored
+        count, resp = sending.popleft().result()
+        if resp.get('status') == 'success':
+            stored += count
+        else:
+            errors.append(resp.get('message'))
+
+    start = time.perf_counter()
+    try:
+        for texts, vectors in synthetic_corpus(docs, model):
+            owners = shard_map.owners(texts)
+            for shard_id in shard_map.ids:
+                rows = np.flatnonzero(owners == shard_id)
+                if len(rows) == 0:
+                    continue
+                data = {'documents': [texts[i] for i in rows], 'embeddings': vectors[rows]}
+                sending.append(senders.submit(
+                    lambda data=data, shard_id=shard_id:
+                        (len(data['documents']), write_shard(shard_map, 'add', data, shard_id))))
+                while len(sending) > SEND_WINDOW:
+                    finish_send()
+        while sending:
+            finish_send()
+    finally:
+        senders.shutdown(wait=True)
+    elapsed = time.perf_counter() - start
+    return {'documents': stored, 'seconds': round(elapsed, 2),
+            'docs_per_sec': round(stored / elapsed, 1), 'errors': errors[:5] or None}
+
+def closed_loop(port: int, queries: List[str], clients: int, duration: float,
+                top_k: int) -> Dict:
+    """`clients` threads each sending their next query as soon as the last one returns."""
+    pool = get_pool(port)
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(offset: int):
+        nonlocal errors
+        i = offset
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                ok = pool.request({'query': queries[i % len(queries)], 'top_k': top_k}
+                                  ).get('status') != 'error'
+            except Exception:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(1000 * (time.perf_counter() - t0))
+                else:
+                    errors += 1
+            i += clients
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return dict(_latency_report(latencies, errors, time.perf_counter() - start), clients=clients)
+
+def open_loop(port: int, queries: List[str], rate: float, duration: float, top_k: int,
+              seed: int = 0) -> Dict:
+    """Poisson arrivals at `rate` per second regardless of how fast replies come.
+
+    Latency counts from each query's scheduled send time, so a stalled
+    server is charged for the queries that pile up behind it.
+    """
+    pool = get_pool(port)
+    rng = np.random.default_rng(seed)
+    arrivals = np.cumsum(rng.exponential(1.0 / rate, int(rate * duration * 1.2) + 1))
+    arrivals = arrivals[arrivals < duration]
+    latencies, errors = [], 0
+    lock = threading.Lock()
+    done = threading.Semaphore(0)
+
+    def finished(scheduled: float, future):
+        nonlocal errors
+        now = time.perf_counter()
+        try:
+            ok = future.result().get('status') != 'error'
+        except Exception:
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(1000 * (now - scheduled))
+            else:
+                errors += 1
+        done.release()
+
+    start = time.perf_counter()
+    for i, at in enumerate(arrivals):
+        scheduled = start + at
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            future = pool.submit({'query': queries[i % len(queries)], 'top_k': top_k})
+        except Exception:
+            with lock:
+                errors += 1
+            done.release()
+            continue
+        future.add_done_callback(lambda f, scheduled=scheduled: finished(scheduled, f))
+    for _ in arrivals:
+        done.acquire()
+    report = _latency_report(latencies, errors, time.perf_counter() - start)
+    return dict(report, offered_qps=round(rate, 1))
+
+def worker_report(cluster: LocalCluster, top_k: int) -> List[Dict]:
+    """Memory, index size and ANN recall of each worker."""
+    report = []
+    for shard_id in cluster.shard_map.ids:
+        port = cluster.shard_map.replicas(shard_id)[0]
+        info = send_admin_command('index', {}, port, 1)
+        recall = send_admin_command('recall', {'top_k': top_k}, port, 1)
+        index = info.get('index', {})
+        report.append({'shard_id': shard_id, 'port': port,
+                       'rss_mb': rss_mb(cluster.procs[f"worker{shard_id}"].pid),
+                       'documents': index.get('live'),
+                       'index_memory_mb': round(index.get('memory_bytes', 0) / 2**20, 1),
+                       'bytes_per_doc': index.get('bytes_per_doc'),
+                       'recall': recall.get('recall', {}).get('recall')})
+    return report
+
+def bench_cluster(args) -> Dict:
+    """End to end: start a local cluster, ingest a synthetic corpus, then drive query load."""
+    cluster = LocalCluster(args)
+    model = StubModel()
+    report = {'config': {k: v for k, v in vars(args).items() if k not in ('func', 'bench')}}
+    failed = True
+    try:
+        print(f"Starting master on {args.port} and {args.workers} workers (logs: {cluster.log_dir})")
+        cluster.start()
+
+        report['ingest'] = r = ingest_corpus(cluster, args.docs, model)
+        print(f"Ingest: {r['documents']} docs in {r['seconds']} s ({r['docs_per_sec']} docs/s)")
+
+        queries = synthetic_queries(QUERY_POOL)
+        closed_loop(args.port, queries, args.clients, min(args.duration, 2.0), args.top_k)  # warm-up
+        report['closed_loop'] = r = closed_loop(args.port, queries, args.clients,
+                                                args.duration, args.top_k)
+        print(f"Closed loop ({args.clients} clients): {r['qps']} q/s  p50 {r['p50_ms']} ms  "
+              f"p95 {r['p95_ms']} ms  p99 {r['p99_ms']} ms  errors {r['errors']}")
+
+        rate = args.rate or max(1.0, 0.7 * report['closed_loop']['qps'])
+        report['open_loop'] = r = open_loop(args.port, queries, rate, args.duration, args.top_k)
+        print(f"Open loop ({rate:.0f} q/s offered): {r['qps']} q/s  p50 {r['p50_ms']} ms  "
+              f"p95 {r['p95_ms']} ms  p99 {r['p99_ms']} ms  errors {r['errors']}")
+
+        stages = get_pool(args.port).request({'command': 'metrics'})['metrics']['stages_ms']
+        report['master_stages_ms'] = {stage: {q: h[q] for q in ('mean', 'p50', 'p99')}
+                                      for stage, h in stages.items()}
+        print("Master stages (mean ms): " + "  ".join(
+            f"{stage} {h['mean']}" for stage, h in report['master_stages_ms'].items()))
+
+        report['rss_mb'] = {name: rss_mb(proc.pid) for name, proc in cluster.procs.items()}
+        report['workers'] = worker_report(cluster, args.top_k)
+        for w in report['workers']:
+            print(f"Worker {w['shard_id']}: {w['documents']} docs  RSS {w['rss_mb']} MB  "
+                  f"index {w['index_memory_mb']} MB  recall@{args.top_k} {w['recall']}")
+        failed = False
+    finally:
+        cluster.stop(keep_logs=failed)
+    return report
+
+# --- Entry point ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search cluster microbenchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("protocol", help="Wire framing throughput")
+    p.add_argument("--messages", type=int, default=2000)
+    p.add_argument("--dim", type=int, default=384)
+    p.add_argument("--results", type=int, default=100,
+                   help="Results per reply")
+    p.set_defaults(func=bench_protocol)
+
+    p = sub.add_parser("topk", help="Top-k selection on workers and merge on the master")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+                   help="Shard sizes (rows scored per query)")
+    p.add_argument("--workers", type=int, nargs="+", default=[2, 8, 32])
+    p.add_argument("--top_k", type=int, default=10)
+    p.add_argument("--repeats", type=int, default=20)
+    p.set_defaults(func=bench_topk)
+
+    p = sub.add_parser("hedging", help="Deadlines and hedged requests under injected stalls")
+    p.add_argument("--shards", type=int, default=2)
+    p.add_argument("--replicas", type=int, default=2)
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--base_ms", type=float, default=2.0, help="Normal worker latency")
+    p.add_argument("--stall_ms", type=float, default=150.0, help="Latency of a stalled request")
+    p.add_argument("--stall_rate", type=float, default=0.03, help="Fraction of requests that stall")
+    p.add_argument("--deadline_ms", type=float, default=500.0)
+    p.add_argument("--hedge_percentile", type=float, default=95)
+    p.add_argument("--hung", action="store_true",
+                   help="Make one replica of shard 1 hang (exercises deadlines)")
+    p.set_defaults(func=bench_hedging)
+
+    p = sub.add_parser("cluster", help="Local cluster end to end: ingest, query load, memory, recall")
+    p.add_argument("--workers", type=int, default=2, help="Shards, one worker each")
+    p.add_argument("--docs", type=int, default=10_000, help="Synthetic corpus size")
+    p.add_argument("--port", type=int, default=BASE_PORT,
+                   help="Master port; workers use the ports after it")
+    p.add_argument("--clients", type=int, default=8, help="Closed-loop concurrent clients")
+    p.add_argument("--rate", type=float, default=None,
+                   help="Open-loop arrivals per second (default: 70%% of closed-loop QPS)")
+    p.add_argument("--duration", type=float, default=10.0, help="Seconds per load phase")
+    p.add_argument("--top_k", type=int, default=10)
+    p.add_argument("--index", choices=["flat", "ivf"], default="flat")
+    p.add_argument("--nlist", type=int, default=256)
+    p.add_argument("--nprobe", type=int, default=8)
+    p.add_argument("--storage", choices=["float32", "int8", "pq"], default="float32")
+    p.add_argument("--rerank", type=int, default=0)
+    p.add_argument("--query_threads", type=int, default=4, help="Query threads per worker")
+    p.add_argument("--result_cache", type=int, default=0,
+                   help="Master result cache entries (off by default so every query is searched)")
+    p.add_argument("--shared_encoder", action="store_true",
+                   help="Run one embedder.py that the master and workers encode through")
+    p.set_defaults(func=bench_cluster)
+
+    for p in sub.choices.values():
+        p.add_argument("--output", type=str, default=None,
+                       help="Also write the report here as JSON")
+    args = parser.parse_args()
+    report = args.func(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Hashable, Optional
+
+# --- Constants ---
+EMBEDDING_CACHE_SIZE = 10000   # query texts whose embeddings stay in memory
+RESULT_CACHE_SIZE = 10000      # (query, top_k) result lists kept in memory
+SPILL_FILE = "embeddings.sqlite"
+SPILL_MAX_ROWS = 1000000       # embeddings kept on disk; oldest are trimmed
+
+# --- In-memory LRU ---
+class LRUCache:
+    """Size-bounded least-recently-used map with hit/miss/eviction counters."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+# --- Level 1: query text -> embedding ---
+class EmbeddingSpill:
+    """On-disk text -> float32 embedding table (SQLite) that outlives the process.
+
+    Rows are written as they are encoded and read back on an in-memory
+    miss. Past `max_rows` the oldest rows are trimmed.
+    """
+
+    def __init__(self, directory: str, dim: int, max_rows: int = SPILL_MAX_ROWS):
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.max_rows = max_rows
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, SPILL_FILE),
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                         "(text TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._writes = 0
+
+    def get_many(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        with self._lock:
+            for text in texts:
+                row = self._db.execute("SELECT vector FROM embeddings WHERE text = ?",
+                                       (text,)).fetchone()
+                if row is not None and len(row[0]) == 4 * self.dim:
+                    found[text] = np.frombuffer(row[0], dtype=np.float32)
+            self.hits += len(found)
+        return found
+
+    def put_many(self, items: List[Tuple[str, np.ndarray]]):
+        if not items:
+            return
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (text, vector) VALUES (?, ?)",
+                [(text, np.asarray(vec, dtype=np.float32).tobytes()) for text, vec in items])
+            self._writes += len(items)
+            if self._writes >= self.max_rows // 10:
+                self._db.execute("DELETE FROM embeddings WHERE rowid <= "
+                                 "(SELECT MAX(rowid) FROM embeddings) - ?", (self.max_rows,))
+                self._writes = 0
+            self._db.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            rows = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {'rows': rows, 'max_rows': self.max_rows, 'hits': self.hits}
+
+class EmbeddingCache(LRUCache):
+    """LRU of query embeddings, optionally backed by an `EmbeddingSpill`."""
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE,
+                 spill: Optional[EmbeddingSpill] = None):
+        super().__init__(max_entries)
+        self.spill = spill
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        if self.spill is not None:
+            stats['spill'] = self.spill.stats()
+        return stats
+
+# --- Level 2: (query, top_k) -> merged results ---
+class ResultCache(LRUCache):
+    """Merged results tagged with the shard versions they were computed at.
+
+    An entry remembers which worker answered for each shard and at what
+    version. It is served only while each of those workers still reports
+    that version; any add or remove there makes it stale, and stale
+    entries are dropped on lookup.
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE):
+        super().__init__(max_entries)
+        self.invalidations = 0
+
+    def lookup(self, key: Hashable, versions: Dict[int, int]) -> Optional[List[Dict]]:
+        """Cached results if still valid given the latest `versions` (port -> version)."""
+        entry = self.get(key)
+        if entry is None:
+            return None
+        stored_versions, results = entry
+        if any(versions.get(port) != version for port, version in stored_versions):
+            self.discard(key)
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+                self.invalidations += 1
+            return None
+        return results
+
+    def store(self, key: Hashable, versions: Dict[int, int], results: List[Dict]):
+        self.put(key, (tuple(versions.items()), results))
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats['invalidations'] = self.invalidations
+        return stats
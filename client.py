@@ -1,50 +1,120 @@
-import socket
 import json
+import socket
 import argparse
 
-def query_master(query: str, master_port: int = 5000) -> list:
+from protocol import send_message, receive_message, split_results
+
+def warn_partial(reply: dict):
+    if reply.get('partial'):
+        print(f"Warning: partial results, shards {reply.get('missing_shards')} did not answer in time")
+
+def query_master(query: str, master_port: int = 5000, top_k: int = 3, offset: int = 0,
+                 deadline_ms: float = None, mode: str = 'dense', prefilter: bool = False,
+                 filter_expr: dict = None) -> list:
     try:
         client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client_socket.connect(('localhost', master_port))
 
         # Send query
-        query_data = {'query': query}
-        client_socket.send(json.dumps(query_data).encode('utf-8'))
+        query_data = {'query': query, 'top_k': top_k, 'offset': offset}
+        if deadline_ms is not None:
+            query_data['deadline_ms'] = deadline_ms
+        if mode != 'dense':
+            query_data.update(mode=mode, prefilter=prefilter)
+        if filter_expr is not None:
+            query_data['filter'] = filter_expr
+        send_message(client_socket, query_data)
         
-        # get results
-        response = client_socket.recv(4096).decode('utf-8')
-        results = json.loads(response)
+        # get results (read the whole frame, however large)
+        results, _ = receive_message(client_socket)
         client_socket.close()
         
+        if results.get('status') == 'error':
+            print(f"Search failed: {results.get('message')}")
+            return []
+        warn_partial(results)
         return results['results']
         
     except Exception as e:
         print(f"Error querying master server: {e}")
         return []
 
-def print_results(results: list):
+def query_master_batch(queries: list, master_port: int = 5000, top_k: int = 3,
+                       offset: int = 0, deadline_ms: float = None,
+                       filter_expr: dict = None) -> list:
+    """Search many queries in one request; returns one result list per query."""
+    try:
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect(('localhost', master_port))
+        query_data = {'queries': queries, 'top_k': top_k, 'offset': offset}
+        if deadline_ms is not None:
+            query_data['deadline_ms'] = deadline_ms
+        if filter_expr is not None:
+            query_data['filter'] = filter_expr
+        send_message(client_socket, query_data)
+        results, _ = receive_message(client_socket)
+        client_socket.close()
+
+        if results.get('status') == 'error':
+            print(f"Batch search failed: {results.get('message')}")
+            return []
+        warn_partial(results)
+        return split_results(results)
+
+    except Exception as e:
+        print(f"Error querying master server: {e}")
+        return []
+
+def print_results(results: list, start: int = 0):
     print("\nSearch Results:")
     print("-" * 80)
     
-    for i, result in enumerate(results, 1):
+    for i, result in enumerate(results, start + 1):
         print(f"\n{i}. Document (Score: {result['score']:.4f}):")
         print(f"   {result['document']}")
+        if result.get('metadata'):
+            print(f"   {result['metadata']}")
     
     print("\n" + "-" * 80)
 
 def main():
     parser = argparse.ArgumentParser(description="Distributed Search Client")
     parser.add_argument("--query", type=str, help="Search query")
+    parser.add_argument("--queries_file", type=str,
+                        help="File with one query per line, searched as one batch")
+    parser.add_argument("--top_k", type=int, default=3, help="Results per page")
+    parser.add_argument("--offset", type=int, default=0,
+                        help="Results to skip (offset / top_k is the page number)")
+    parser.add_argument("--deadline_ms", type=float,
+                        help="End-to-end budget; shards slower than this are left out")
+    parser.add_argument("--mode", choices=["dense", "lexical", "hybrid"], default="dense",
+                        help="Embedding, BM25 keyword, or fused (reciprocal rank) retrieval")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Hybrid: dense-score only documents matching a query term")
+    parser.add_argument("--filter", type=json.loads, default=None,
+                        help='Metadata filter as JSON, e.g. \'{"tenant": "acme", "year": {"$gte": 2020}}\'')
     args = parser.parse_args()
     
+    if args.queries_file:
+        with open(args.queries_file) as f:
+            queries = [line.strip() for line in f if line.strip()]
+        batch = query_master_batch(queries, top_k=args.top_k, offset=args.offset,
+                                   deadline_ms=args.deadline_ms, filter_expr=args.filter)
+        for query, results in zip(queries, batch):
+            print(f"\nQuery: {query}")
+            print_results(results, args.offset)
+        return
+
     if args.query:
         query = args.query
     else:
         query = input("Enter your search query: ")
     
-    results = query_master(query)
+    results = query_master(query, top_k=args.top_k, offset=args.offset,
+                           deadline_ms=args.deadline_ms, mode=args.mode,
+                           prefilter=args.prefilter, filter_expr=args.filter)
     if results:
-        print_results(results)
+        print_results(results, args.offset)
     else:
         print("No results found or an error occurred.")
 
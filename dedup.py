@@ -0,0 +1,121 @@
+import re
+import hashlib
+import unicodedata
+import numpy as np
+
+from typing import Dict, List, Iterable, Union
+
+from index import INITIAL_CAPACITY, GROWTH_FACTOR
+
+# --- Constants ---
+DIGEST_SIZE = 8            # bytes of BLAKE2b per text; matches are confirmed on the text itself
+BUILD_BLOCK = 10000        # documents hashed per step when rebuilding from a shard
+SPACE_RE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """NFC form with runs of whitespace collapsed and the ends stripped.
+
+    Case is kept: texts differing only in case are different documents,
+    and a cased model embeds them differently.
+    """
+    return SPACE_RE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+def content_hash(text: str) -> int:
+    """BLAKE2b digest of the normalized text, as an int."""
+    digest = hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=DIGEST_SIZE)
+    return int.from_bytes(digest.digest(), 'big')
+
+def first_occurrences(texts: Iterable[str]) -> List[int]:
+    """For each text, the position of the first text with the same normalized content."""
+    first: Dict[str, int] = {}
+    return [first.setdefault(normalize_text(text), i) for i, text in enumerate(texts)]
+
+# --- Content index ---
+class ContentIndex:
+    """Content hash of each row's text -> every row holding that text.
+
+    A hash maps to one row, or to a list of rows when the text was stored
+    more than once (copies migrated in, or re-added after a removal).
+    Removed rows stay listed, tombstoned, until `compacted` drops them, so
+    a text that was stored before can reuse its embedding. Hashes are
+    short, so a hit is only a candidate until `same_text` confirms it.
+    Single writer, lock-free readers, as for the other shard indexes:
+    tombstones are written before a row is listed, and deletes swap in a
+    fresh mask.
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self.rows: Dict[int, Union[int, List[int]]] = {}
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, texts: List[str]) -> np.ndarray:
+        """Hash `texts` as the next rows and return those rows."""
+        start = self._size
+        end = start + len(texts)
+        if end > len(self._alive):
+            alive = np.zeros(max(end, len(self._alive) * GROWTH_FACTOR), dtype=bool)
+            alive[:start] = self._alive[:start]
+            self._alive = alive
+        self._alive[start:end] = True
+        for row, text in enumerate(texts, start):
+            digest = content_hash(text)
+            rows = self.rows.get(digest)
+            if rows is None:
+                self.rows[digest] = row
+            elif isinstance(rows, int):
+                self.rows[digest] = [rows, row]
+            else:
+                rows.append(row)
+        self._size = end
+        return np.arange(start, end)
+
+    def add_all(self, documents, n: int):
+        """Hash rows 0..n-1 of `documents` (a list or lazy store), in blocks."""
+        for i in range(0, n, BUILD_BLOCK):
+            self.add([documents[row] for row in range(i, min(i + BUILD_BLOCK, n))])
+
+    def delete(self, rows: Iterable[int]):
+        """Tombstone rows; they stay listed for embedding reuse."""
+        rows = np.asarray(list(rows), dtype=np.int64)
+        alive = self._alive.copy()
+        alive[rows[(rows >= 0) & (rows < self._size)]] = False
+        self._alive = alive
+
+    def get(self, digest: int) -> List[int]:
+        """Rows whose text has this hash: live ones first, newest first within each."""
+        rows = self.rows.get(digest)
+        if rows is None:
+            return []
+        if isinstance(rows, int):
+            return [rows]
+        alive = self._alive
+        return sorted(rows, key=lambda row: (not alive[row], -row))
+
+    def is_alive(self, row: int) -> bool:
+        return 0 <= row < self._size and bool(self._alive[row])
+
+    @staticmethod
+    def same_text(a: str, b: str) -> bool:
+        return a == b or normalize_text(a) == normalize_text(b)
+
+    def compacted(self, keep: np.ndarray) -> "ContentIndex":
+        """Copy holding only the rows in `keep`, renumbered to their new positions."""
+        keep = np.asarray(keep, dtype=np.int64)
+        remap = np.full(self._size, -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+        out = ContentIndex(max(len(keep), INITIAL_CAPACITY))
+        for digest, rows in self.rows.items():
+            moved = [int(remap[row]) for row in ([rows] if isinstance(rows, int) else rows)
+                     if remap[row] >= 0]
+            if moved:
+                out.rows[digest] = moved[0] if len(moved) == 1 else moved
+        out._alive[:len(keep)] = self._alive[keep]
+        out._size = len(keep)
+        return out
+
+    def stats(self) -> Dict:
+        return {'hashes': len(self.rows), 'live': int(self._alive[:self._size].sum())}
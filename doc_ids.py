@@ -0,0 +1,25 @@
+"""Stable document IDs shared by the workers, the web app and tools.
+
+A doc ID is `(shard_id << SHARD_BITS) | sequence`: the high bits name the
+shard that first stored the document and the low 40 bits count that
+shard's adds, so IDs never collide across shards and don't change when a
+rebalance moves the document. That allows 2**40 documents per shard;
+keeping shard IDs below 2**13 keeps every ID under 2**53, so it survives
+JSON and JavaScript numbers exactly.
+"""
+
+# --- Constants ---
+SHARD_BITS = 40           # doc_id = (shard_id << SHARD_BITS) | sequence
+
+# --- Document IDs ---
+def make_doc_id(shard_id: int, seq: int) -> int:
+    """Globally unique, stable document ID (stays below 2**53 for JSON/JS)."""
+    return (shard_id << SHARD_BITS) | seq
+
+def shard_of(doc_id: int) -> int:
+    """Shard that allocated `doc_id`."""
+    return doc_id >> SHARD_BITS
+
+def seq_of(doc_id: int) -> int:
+    """Position of `doc_id` in its allocating shard's sequence (the low SHARD_BITS bits)."""
+    return doc_id & ((1 << SHARD_BITS) - 1)
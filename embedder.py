@@ -0,0 +1,160 @@
+import time
+import queue
+import socket
+import logging
+import argparse
+import threading
+import numpy as np
+
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from models import load_local_model, model_name, SERVICE_ENV
+from rpc import serve_connection
+from metrics import Metrics, Histogram
+
+# --- Constants ---
+EMBEDDER_PORT = 5100       # default port of the shared embedding service
+BATCH_SIZE = 64            # most texts encoded in one model call
+BATCH_WAIT_MS = 2.0        # longest a request waits for others to join its batch
+MAX_TEXTS = 4096           # most texts in one encode request
+REQUEST_THREADS = 32       # connections' requests waiting on the batcher at once
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+# --- Batching ---
+class EncodeBatcher:
+    """Coalesces texts from concurrent requests into one model call.
+
+    A batch closes once it holds `max_batch` texts or `max_wait_ms` after
+    its first request arrived; a single request larger than that goes
+    out on its own. One thread runs the model, so calls never contend
+    for its cores.
+    """
+
+    def __init__(self, model, max_batch: int = BATCH_SIZE, max_wait_ms: float = BATCH_WAIT_MS,
+                 metrics: Metrics = None):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.metrics = metrics or Metrics()
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self._queue = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True, name="encoder").start()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        future = Future()
+        self._queue.put((texts, future, time.perf_counter()))
+        return future.result()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            size = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+            self._run(batch)
+
+    def _run(self, batch: List):
+        start = time.perf_counter()
+        texts = [text for request, _, _ in batch for text in request]
+        for _, _, enqueued in batch:
+            self.metrics.observe('batch_wait', 1000 * (start - enqueued))
+        self.batch_sizes.observe(len(texts))
+        try:
+            embeddings = np.asarray(self.model.encode(texts, convert_to_numpy=True),
+                                    dtype=np.float32)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+        self.metrics.observe('model', 1000 * (time.perf_counter() - start))
+        self.metrics.incr('texts', len(texts))
+        offset = 0
+        for request, future, _ in batch:
+            future.set_result(embeddings[offset:offset + len(request)])
+            offset += len(request)
+
+# --- Service ---
+class EmbeddingServer:
+    """Loads the model once and encodes for the master, workers and ingest.
+
+    Speaks the same framed protocol as the workers, on `port`: 'encode'
+    takes a list of `texts` and returns an `embeddings` matrix (sent as
+    raw float32 buffers), 'info' reports the model and its width, and
+    'metrics' the batching and timing counters.
+    """
+
+    def __init__(self, port: int, name: str = None, max_batch: int = BATCH_SIZE,
+                 max_wait_ms: float = BATCH_WAIT_MS):
+        self.port = port
+        self.name = model_name(name)
+        self.metrics = Metrics()
+        start = time.perf_counter()
+        self.model = load_local_model(self.name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        logging.info(f"Loaded {self.name} (dim {self.dim}) in {time.perf_counter() - start:.1f} s")
+        self.batcher = EncodeBatcher(self.model, max_batch, max_wait_ms, self.metrics)
+        self.executor = ThreadPoolExecutor(max_workers=REQUEST_THREADS,
+                                           thread_name_prefix="request")
+
+    def handle(self, req: Dict) -> Dict:
+        cmd = req.get('command', '').lower()
+        if cmd == 'encode':
+            texts = req.get('texts')
+            if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                return {'status': 'error', 'message': 'texts must be a list of strings'}
+            if len(texts) > MAX_TEXTS:
+                return {'status': 'error', 'message': f'At most {MAX_TEXTS} texts per request'}
+            if not texts:
+                return {'status': 'success', 'embeddings': np.empty((0, self.dim), np.float32)}
+            return {'status': 'success', 'embeddings': self.batcher.encode(texts)}
+        if cmd == 'info':
+            return {'status': 'success', 'model': self.name, 'dim': self.dim}
+        if cmd == 'metrics':
+            return {'status': 'success', 'metrics': self.metrics.snapshot(),
+                    'batch_size': self.batcher.batch_sizes.snapshot()}
+        return {'status': 'error', 'message': f'Unknown command: {cmd}'}
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('localhost', self.port))
+        sock.listen(16)
+        logging.info(f"Embedding service listening on port {self.port}")
+        while True:
+            client, addr = sock.accept()
+            logging.info(f"Connection from {addr}")
+            threading.Thread(
+                target=serve_connection,
+                args=(client, self.handle, self.executor, self.metrics),
+                daemon=True
+            ).start()
+
+# --- Entry point ---
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+
+    parser = argparse.ArgumentParser(
+        description=f"Shared embedding service; point other processes at it with ${SERVICE_ENV} "
+                    "or --embedding_service")
+    parser.add_argument("--port", type=int, default=EMBEDDER_PORT)
+    parser.add_argument("--model", type=str, default=None,
+                        help="Model name (default: $EMBEDDING_MODEL, else all-MiniLM-L6-v2)")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="Most texts encoded in one model call")
+    parser.add_argument("--batch_wait_ms", type=float, default=BATCH_WAIT_MS,
+                        help="Longest a request waits for others to join its batch")
+    args = parser.parse_args()
+
+    EmbeddingServer(args.port, args.model, args.batch_size, args.batch_wait_ms).start()
@@ -0,0 +1,917 @@
+import os
+import time
+import numpy as np
+
+from typing import List, Tuple, Dict
+
+# --- Constants ---
+INITIAL_CAPACITY = 1024
+GROWTH_FACTOR = 2
+KMEANS_ITERS = 20
+DEFAULT_NLIST = 256
+DEFAULT_NPROBE = 8
+MIN_POINTS_PER_LIST = 39   # rows per list needed before IVF trains
+MAX_POINTS_PER_LIST = 256  # k-means sample cap per list
+RETRAIN_GROWTH = 4         # compaction retrains after this much growth
+SCORE_BLOCK = 65536        # rows dequantized per block when scoring
+PQ_TRAIN_SIZE = 4096       # rows staged as float32 before PQ trains
+PQ_MAX_TRAIN = 65536       # k-means sample cap for PQ codebooks
+BATCH_SCORE_CELLS = 1 << 22  # query x row scores materialized at once in batch search
+FILTER_GATHER_FRACTION = 0.1  # filters matching fewer rows than this score just those rows
+
+def top_k_pairs(rows: np.ndarray, sims: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+    """Best `top_k` (row, score) pairs among candidate rows; -inf is dropped.
+
+    Selects with `argpartition` (linear) and sorts only the selected slice.
+    """
+    if top_k < len(sims):
+        top_idxs = np.argpartition(-sims, top_k - 1)[:top_k]
+    else:
+        top_idxs = np.arange(len(sims))
+    top_idxs = top_idxs[np.argsort(-sims[top_idxs], kind='stable')]
+    return [(int(rows[i]), float(sims[i])) for i in top_idxs if sims[i] > -np.inf]
+
+# --- Storage ---
+class GrowableArray:
+    """Preallocated array that grows geometrically along its first axis.
+
+    Rows are only ever written past the current size, so a reader holding
+    ``view(n)`` for an older ``n`` never observes a partially written row.
+    """
+
+    def __init__(self, tail: Tuple[int, ...], dtype, capacity: int = INITIAL_CAPACITY):
+        self._data = np.empty((max(capacity, 1),) + tuple(tail), dtype=dtype)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return self._data.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    def _reserve(self, needed: int):
+        """Grow the buffer so it can hold at least `needed` rows."""
+        if needed <= self.capacity:
+            return
+        new_cap = self.capacity
+        while new_cap < needed:
+            new_cap *= GROWTH_FACTOR
+        data = np.empty((new_cap,) + self._data.shape[1:], dtype=self._data.dtype)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+
+    def append(self, values: np.ndarray) -> np.ndarray:
+        """Append rows and return their row numbers."""
+        start = self._size
+        self._reserve(start + len(values))
+        self._data[start:start + len(values)] = values
+        self._size = start + len(values)
+        return np.arange(start, self._size)
+
+    def view(self, n: int = None) -> np.ndarray:
+        """Return a read-only view of the first `n` rows (default: all)."""
+        view = self._data[:self._size if n is None else n]
+        view.flags.writeable = False
+        return view
+
+    def __getitem__(self, key):
+        return self._data[:self._size][key]
+
+    def flush(self):
+        """No-op for in-memory arrays; see `MappedArray`."""
+
+class MappedArray(GrowableArray):
+    """GrowableArray backed by a memory-mapped file.
+
+    The file is preallocated to the capacity and grown by extending it and
+    remapping. Older maps stay valid, so readers are unaffected. The first
+    `size` rows already on disk are treated as present.
+    """
+
+    def __init__(self, path: str, tail: Tuple[int, ...], dtype,
+                 size: int = 0, capacity: int = INITIAL_CAPACITY):
+        self.path = path
+        self._tail = tuple(tail)
+        self._dtype = np.dtype(dtype)
+        self._row_bytes = self._dtype.itemsize * int(np.prod(self._tail, dtype=np.int64))
+        on_disk = os.path.getsize(path) // self._row_bytes if os.path.exists(path) else 0
+        self._data = self._map(max(capacity, size, on_disk, 1))
+        self._size = size
+
+    def _map(self, capacity: int) -> np.memmap:
+        with open(self.path, 'ab') as f:
+            if f.tell() < capacity * self._row_bytes:
+                f.truncate(capacity * self._row_bytes)
+        return np.memmap(self.path, dtype=self._dtype, mode='r+',
+                         shape=(capacity,) + self._tail)
+
+    @property
+    def nbytes(self) -> int:
+        return 0  # page cache, not heap
+
+    @property
+    def mapped_bytes(self) -> int:
+        return self._data.nbytes
+
+    def _reserve(self, needed: int):
+        if needed <= self.capacity:
+            return
+        new_cap = self.capacity
+        while new_cap < needed:
+            new_cap *= GROWTH_FACTOR
+        self._data.flush()
+        self._data = self._map(new_cap)
+
+    def flush(self):
+        self._data.flush()
+
+class EmbeddingMatrix:
+    """Full-precision float32 embedding store (4 bytes per dimension).
+
+    All storage kinds share this interface: `append` rows, score a query
+    against the first `n` rows (`scores`) or selected rows (`scores_rows`),
+    score a (q, dim) batch against the first `n` rows (`scores_batch`),
+    and `decode` rows back to float32.
+    """
+
+    kind = 'float32'
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY,
+                 path: str = None, size: int = 0):
+        self.dim = dim
+        if path is None:
+            self._data = GrowableArray((dim,), np.float32, capacity)
+        else:
+            self._data = MappedArray(path, (dim,), np.float32, size, capacity)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def capacity(self) -> int:
+        return self._data.capacity
+
+    @property
+    def nbytes(self) -> int:
+        return self._data.nbytes
+
+    @property
+    def bytes_per_vector(self) -> float:
+        return 4 * self.dim
+
+    @property
+    def is_mapped(self) -> bool:
+        return isinstance(self._data, MappedArray)
+
+    def append(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        return self._data.append(vectors)
+
+    def flush(self):
+        self._data.flush()
+
+    def view(self, n: int = None) -> np.ndarray:
+        return self._data.view(n)
+
+    def scores(self, query: np.ndarray, n: int) -> np.ndarray:
+        return self._data.view(n) @ query
+
+    def scores_batch(self, queries: np.ndarray, n: int) -> np.ndarray:
+        return queries @ self._data.view(n).T
+
+    def scores_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        return self._data.view()[rows] @ query
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        return self._data.view()[rows]
+
+    def empty_like(self, capacity: int) -> "EmbeddingMatrix":
+        return EmbeddingMatrix(self.dim, capacity)
+
+class Int8Matrix:
+    """Scalar-quantized store: int8 codes plus one float32 scale per row.
+
+    Each vector is scaled so its largest component maps to +/-127, which
+    needs no training and costs dim + 4 bytes per row (~4x smaller than
+    float32). Scoring dequantizes in blocks to keep temporaries small.
+    """
+
+    kind = 'int8'
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY):
+        self.dim = dim
+        self._codes = GrowableArray((dim,), np.int8, capacity)
+        self._scales = GrowableArray((), np.float32, capacity)
+
+    def __len__(self) -> int:
+        return len(self._scales)
+
+    @property
+    def capacity(self) -> int:
+        return self._scales.capacity
+
+    @property
+    def nbytes(self) -> int:
+        return self._codes.nbytes + self._scales.nbytes
+
+    @property
+    def bytes_per_vector(self) -> float:
+        return self.dim + 4
+
+    def append(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        self._codes.append(codes)
+        return self._scales.append(scales.astype(np.float32))
+
+    def _score_block(self, query, codes, scales):
+        return (codes.astype(np.float32) @ query) * scales
+
+    def scores(self, query: np.ndarray, n: int) -> np.ndarray:
+        codes, scales = self._codes.view(n), self._scales.view(n)
+        out = np.empty(n, dtype=np.float32)
+        for i in range(0, n, SCORE_BLOCK):
+            j = min(i + SCORE_BLOCK, n)
+            out[i:j] = self._score_block(query, codes[i:j], scales[i:j])
+        return out
+
+    def scores_batch(self, queries: np.ndarray, n: int) -> np.ndarray:
+        codes, scales = self._codes.view(n), self._scales.view(n)
+        out = np.empty((len(queries), n), dtype=np.float32)
+        for i in range(0, n, SCORE_BLOCK):
+            j = min(i + SCORE_BLOCK, n)
+            out[:, i:j] = (queries @ codes[i:j].astype(np.float32).T) * scales[i:j]
+        return out
+
+    def scores_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        return self._score_block(query, self._codes.view()[rows], self._scales.view()[rows])
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        codes, scales = self._codes.view()[rows], self._scales.view()[rows]
+        return codes.astype(np.float32) * scales[..., None]
+
+    def empty_like(self, capacity: int) -> "Int8Matrix":
+        return Int8Matrix(self.dim, capacity)
+
+class PQMatrix:
+    """Product-quantized store scored by asymmetric distance computation.
+
+    Vectors are split into `m` sub-vectors, each replaced by the id of its
+    nearest of 256 k-means centroids, so a row costs `m` bytes (m = dim/4
+    gives ~16x compression). A query stays float: per search it builds an
+    (m, 256) table of sub-vector inner products and sums table lookups.
+
+    Until `train_size` rows arrive they are kept as float32 in a staging
+    matrix; the codebooks are then trained once and the staging dropped.
+    """
+
+    kind = 'pq'
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY,
+                 m: int = None, train_size: int = PQ_TRAIN_SIZE, codebooks=None):
+        self.dim = dim
+        self.m = m or max(1, dim // 4)
+        if dim % self.m:
+            raise ValueError(f"PQ: dim {dim} is not divisible by m={self.m}")
+        self.dsub = dim // self.m
+        self.train_size = train_size
+        self._codes = GrowableArray((self.m,), np.uint8, capacity)
+        self._codebooks = codebooks  # (m, 256, dsub) once trained
+        self._staging = None if codebooks is not None else EmbeddingMatrix(dim, capacity)
+
+    def __len__(self) -> int:
+        staging = self._staging
+        return len(staging) if staging is not None else len(self._codes)
+
+    @property
+    def is_trained(self) -> bool:
+        return self._codebooks is not None
+
+    @property
+    def capacity(self) -> int:
+        staging = self._staging
+        return staging.capacity if staging is not None else self._codes.capacity
+
+    @property
+    def nbytes(self) -> int:
+        staging = self._staging
+        codebooks = self._codebooks.nbytes if self._codebooks is not None else 0
+        return self._codes.nbytes + codebooks + (staging.nbytes if staging is not None else 0)
+
+    @property
+    def bytes_per_vector(self) -> float:
+        return self.m if self.is_trained else 4 * self.dim
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for s in range(self.m):
+            sub = vectors[:, s * self.dsub:(s + 1) * self.dsub]
+            codes[:, s] = nearest_centroids(sub, self._codebooks[s])
+        return codes
+
+    def train(self):
+        """Fit per-subspace codebooks on the staged rows and encode them."""
+        staged = self._staging.view()
+        sample = staged
+        if len(sample) > PQ_MAX_TRAIN:
+            rng = np.random.default_rng(0)
+            sample = staged[rng.choice(len(staged), PQ_MAX_TRAIN, replace=False)]
+        codebooks = np.empty((self.m, 256, self.dsub), dtype=np.float32)
+        for s in range(self.m):
+            sub = sample[:, s * self.dsub:(s + 1) * self.dsub]
+            centroids = kmeans(sub, 256, seed=s)
+            codebooks[s] = centroids[np.arange(256) % len(centroids)]
+        self._codebooks = codebooks
+        self._codes.append(self._encode(staged))
+        # Readers check staging first, so codes are complete before it goes
+        self._staging = None
+
+    def append(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if self._staging is None:
+            return self._codes.append(self._encode(vectors))
+        rows = self._staging.append(vectors)
+        if len(self._staging) >= self.train_size:
+            self.train()
+        return rows
+
+    def _tables(self, query: np.ndarray) -> np.ndarray:
+        return np.einsum('mkd,md->mk', self._codebooks, query.reshape(self.m, self.dsub))
+
+    def _score_block(self, tables, codes):
+        return tables[np.arange(self.m), codes].sum(axis=1)
+
+    def scores(self, query: np.ndarray, n: int) -> np.ndarray:
+        staging = self._staging
+        if staging is not None:
+            return staging.scores(query, n)
+        tables = self._tables(query)
+        codes = self._codes.view(n)
+        out = np.empty(n, dtype=np.float32)
+        for i in range(0, n, SCORE_BLOCK):
+            j = min(i + SCORE_BLOCK, n)
+            out[i:j] = self._score_block(tables, codes[i:j])
+        return out
+
+    def scores_batch(self, queries: np.ndarray, n: int) -> np.ndarray:
+        # ADC tables differ per query, so there is no shared matrix product
+        staging = self._staging
+        if staging is not None:
+            return staging.scores_batch(queries, n)
+        return np.stack([self.scores(query, n) for query in queries])
+
+    def scores_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        staging = self._staging
+        if staging is not None:
+            return staging.scores_rows(query, rows)
+        return self._score_block(self._tables(query), self._codes.view()[rows])
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        staging = self._staging
+        if staging is not None:
+            return staging.decode(rows)
+        codes = self._codes.view()[rows]
+        parts = [self._codebooks[s][codes[..., s]] for s in range(self.m)]
+        return np.concatenate(parts, axis=-1)
+
+    def empty_like(self, capacity: int) -> "PQMatrix":
+        return PQMatrix(self.dim, capacity, m=self.m, train_size=self.train_size,
+                        codebooks=self._codebooks)
+
+STORAGE_KINDS = {
+    'float32': EmbeddingMatrix,
+    'int8': Int8Matrix,
+    'pq': PQMatrix,
+}
+
+def make_storage(kind: str, dim: int, capacity: int = INITIAL_CAPACITY, **params):
+    """Construct an embedding store by name ('float32', 'int8' or 'pq')."""
+    if kind not in STORAGE_KINDS:
+        raise ValueError(f"Unknown storage kind: {kind}")
+    return STORAGE_KINDS[kind](dim, capacity, **params)
+
+# --- Clustering ---
+def kmeans(vectors: np.ndarray, k: int, iters: int = KMEANS_ITERS,
+           seed: int = 0) -> np.ndarray:
+    """Lloyd's k-means in NumPy; returns a (k, dim) float32 centroid matrix."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters from random points so no list stays unused
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Index of the L2-nearest centroid for each row of `vectors`."""
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+    half_norms = 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+    return np.argmax(vectors @ centroids.T - half_norms, axis=1)
+
+# --- Indexes ---
+class VectorIndex:
+    """Base class for inner-product indexes with incremental adds and tombstones.
+
+    An index expects a single writer (callers serialize mutations) but any
+    number of concurrent readers. Adds publish the new size only after the
+    rows are written, and deletes swap in a fresh tombstone mask, so searches
+    never need a lock. Compaction builds a new index instead of rewriting
+    this one in place.
+
+    Embeddings live in a `storage` of the given kind ('float32', 'int8' or
+    'pq'). With a quantized storage and `rerank` > 0, a float32 copy is also
+    kept and the best `rerank` candidates are re-scored exactly. `adopt`
+    attaches an external float32 matrix (such as a memory-mapped shard
+    file) as that copy, and as the storage itself in float32 mode.
+
+    Subclasses implement `_candidates` and may hook `_on_add` to maintain
+    their own structures; `exact_search` is always available as a reference.
+    """
+
+    kind = None
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY,
+                 storage: str = 'float32', rerank: int = 0,
+                 storage_params: Dict = None):
+        self.dim = dim
+        self.storage = storage
+        self.storage_params = storage_params or {}
+        self.rerank = rerank
+        self._store = make_storage(storage, dim, capacity, **self.storage_params)
+        self._floats = self._float_copy(capacity)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._deleted = 0
+
+    def _float_copy(self, capacity: int):
+        """Full-precision vectors: the store itself, a re-rank copy, or None."""
+        if self.storage == 'float32':
+            return self._store
+        if self.rerank:
+            return EmbeddingMatrix(self.dim, capacity)
+        return None
+
+    def __len__(self) -> int:
+        """Number of rows, including tombstoned ones."""
+        return self._size
+
+    @property
+    def live_count(self) -> int:
+        return self._size - self._deleted
+
+    @property
+    def tombstone_ratio(self) -> float:
+        return self._deleted / self._size if self._size else 0.0
+
+    @property
+    def has_float_vectors(self) -> bool:
+        return self._floats is not None
+
+    def is_alive(self, row: int) -> bool:
+        return 0 <= row < self._size and bool(self._alive[row])
+
+    def live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self._alive[:self._size])
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Embeddings for `rows`: exact if kept, else decoded from storage."""
+        if self._floats is not None:
+            return self._floats.decode(rows)
+        return self._store.decode(rows)
+
+    def add(self, vectors: np.ndarray) -> np.ndarray:
+        """Append embeddings and return the rows they were stored at."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(vectors) == 0:
+            return np.arange(self._size, self._size)
+        if self._floats is not None and self._floats is not self._store:
+            self._floats.append(vectors)
+        rows = self._store.append(vectors)
+        self._publish(rows, vectors)
+        return rows
+
+    def adopt(self, floats: EmbeddingMatrix):
+        """Take `floats` as the full-precision source and index its rows.
+
+        Used to reopen a persisted shard without re-encoding; later adds
+        append to `floats` as well.
+        """
+        self._floats = floats
+        if self.storage == 'float32':
+            self._store = floats
+        n = len(floats)
+        for i in range(self._size, n, SCORE_BLOCK):
+            rows = np.arange(i, min(i + SCORE_BLOCK, n))
+            vectors = floats.decode(rows)
+            if self._store is not floats:
+                self._store.append(vectors)
+            self._publish(rows, vectors)
+
+    def _publish(self, rows: np.ndarray, vectors: np.ndarray):
+        """Mark stored rows live, let subclasses index them, then expose them."""
+        if rows[-1] >= len(self._alive):
+            alive = np.zeros(max(rows[-1] + 1, len(self._alive) * GROWTH_FACTOR), dtype=bool)
+            alive[:self._size] = self._alive[:self._size]
+            self._alive = alive
+        self._alive[rows] = True
+        self._on_add(rows, vectors)
+        self._size = int(rows[-1]) + 1
+
+    def _on_add(self, rows: np.ndarray, vectors: np.ndarray):
+        """Hook for subclasses; called before the new rows become visible."""
+
+    def delete(self, rows: List[int]) -> int:
+        """Tombstone rows; returns how many were live before the call."""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        rows = rows[(rows >= 0) & (rows < self._size)]
+        alive = self._alive.copy()
+        removed = int(alive[rows].sum())
+        alive[rows] = False
+        self._alive = alive
+        self._deleted += removed
+        return removed
+
+    def _top_k(self, rows: np.ndarray, sims: np.ndarray, top_k: int
+               ) -> List[Tuple[int, float]]:
+        return top_k_pairs(rows, sims, top_k)
+
+    def _scan(self, source, query: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Score every row below `n` in `source`, masking tombstones to -inf."""
+        sims = source.scores(query, n)
+        return np.arange(n), np.where(self._alive[:n], sims, -np.inf)
+
+    def exact_search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """Brute-force scan over every live row, in full precision if kept."""
+        n = self._size
+        if n == 0 or top_k <= 0:
+            return []
+        source = self._floats if self._floats is not None else self._store
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        return self._top_k(*self._scan(source, query, n), top_k)
+
+    def _candidates(self, query: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Candidate rows below `n` and their (possibly approximate) scores."""
+        raise NotImplementedError
+
+    def search(self, query: np.ndarray, top_k: int, mask: np.ndarray = None
+               ) -> List[Tuple[int, float]]:
+        """Return up to `top_k` live (row, score) pairs by inner product.
+
+        Rows where `mask` (covering at least the first `len(self)` rows) is
+        False are skipped before ranking.
+        """
+        n = self._size
+        if n == 0 or top_k <= 0:
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        rows, sims = self._candidates(query, n)
+        if mask is not None:
+            sims = np.where(mask[rows], sims, -np.inf)
+        floats = self._floats
+        if self.rerank and floats is not None and floats is not self._store:
+            best = self._top_k(rows, sims, max(self.rerank, top_k))
+            rows = np.array([row for row, _ in best], dtype=np.int64)
+            sims = floats.scores_rows(query, rows)
+        return self._top_k(rows, sims, top_k)
+
+    def search_rows(self, query: np.ndarray, rows: np.ndarray, top_k: int
+                    ) -> List[Tuple[int, float]]:
+        """`search` restricted to candidate `rows` (e.g. lexical matches), in full precision if kept."""
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[(rows >= 0) & (rows < self._size)]
+        if len(rows) == 0 or top_k <= 0:
+            return []
+        source = self._floats if self._floats is not None else self._store
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        sims = np.where(self._alive[rows], source.scores_rows(query, rows), -np.inf)
+        return self._top_k(rows, sims, top_k)
+
+    def search_filtered(self, query: np.ndarray, mask: np.ndarray, top_k: int
+                        ) -> List[Tuple[int, float]]:
+        """`search` over only the rows where `mask` is True (a pre-filter).
+
+        A selective filter scores just its rows; a broad one masks the
+        usual scan or ANN candidates. If the ANN probes turn up fewer than
+        `top_k` matches, the matching rows are scanned instead, so a filter
+        never costs results.
+        """
+        n = self._size
+        mask = np.asarray(mask, dtype=bool)[:n]
+        if len(mask) < n:
+            mask = np.concatenate([mask, np.zeros(n - len(mask), dtype=bool)])
+        mask = mask & self._alive[:n]
+        matches = int(mask.sum())
+        if matches == 0 or top_k <= 0:
+            return []
+        if matches <= max(top_k, n * FILTER_GATHER_FRACTION):
+            return self.search_rows(query, np.flatnonzero(mask), top_k)
+        hits = self.search(query, top_k, mask)
+        if len(hits) < top_k:
+            return self.search_rows(query, np.flatnonzero(mask), top_k)
+        return hits
+
+    def search_batch(self, queries: np.ndarray, top_k: int) -> List[List[Tuple[int, float]]]:
+        """`search` for each row of a (q, dim) query matrix."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        return [self.search(query, top_k) for query in queries]
+
+    def _top_k_rows(self, sims: np.ndarray, top_k: int) -> List[List[Tuple[int, float]]]:
+        """Row-wise `_top_k` over a (q, n) score matrix whose columns are rows."""
+        k = min(top_k, sims.shape[1])
+        best = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        best_sims = np.take_along_axis(sims, best, axis=1)
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        best = np.take_along_axis(best, order, axis=1)
+        best_sims = np.take_along_axis(best_sims, order, axis=1)
+        return [
+            [(int(row), float(sim)) for row, sim in zip(rows, row_sims) if sim > -np.inf]
+            for rows, row_sims in zip(best.tolist(), best_sims.tolist())
+        ]
+
+    def _empty_like(self, capacity: int) -> "VectorIndex":
+        """New, empty index of the same kind and settings (codebooks kept)."""
+        out = type(self)(self.dim, capacity=capacity, storage=self.storage,
+                         rerank=self.rerank, storage_params=self.storage_params)
+        out._store = self._store.empty_like(capacity)
+        out._floats = out._float_copy(capacity)
+        return out
+
+    def compacted(self, floats: EmbeddingMatrix = None) -> Tuple["VectorIndex", np.ndarray]:
+        """Build a tombstone-free copy; returns it and the surviving old rows.
+
+        If `floats` is given it must already hold exactly the surviving rows,
+        in order, and is adopted instead of copying vectors.
+        """
+        keep = self.live_rows()
+        if floats is not None:
+            out = self._empty_like(INITIAL_CAPACITY)
+            out.adopt(floats)
+        else:
+            out = self._empty_like(max(len(keep), INITIAL_CAPACITY))
+            out.add(self.vectors(keep))
+        return out, keep
+
+    def _heap_floats(self):
+        """The separate in-RAM float copy, if any."""
+        floats = self._floats
+        if floats is None or floats is self._store or floats.is_mapped:
+            return None
+        return floats
+
+    def memory_bytes(self) -> int:
+        """Heap bytes allocated for vectors, the re-rank copy and tombstones."""
+        total = self._store.nbytes + self._alive.nbytes
+        if self._heap_floats() is not None:
+            total += self._floats.nbytes
+        return total
+
+    def bytes_per_doc(self) -> float:
+        """Steady-state in-RAM vector bytes per stored row."""
+        if getattr(self._store, 'is_mapped', False):
+            return 0
+        per_doc = self._store.bytes_per_vector
+        if self._heap_floats() is not None:
+            per_doc += self._floats.bytes_per_vector
+        return per_doc
+
+    def stats(self) -> Dict:
+        return {
+            'kind': self.kind,
+            'storage': self.storage,
+            'rerank': self.rerank,
+            'rows': self._size,
+            'live': self.live_count,
+            'tombstone_ratio': round(self.tombstone_ratio, 4),
+            'bytes_per_doc': self.bytes_per_doc(),
+            'memory_bytes': self.memory_bytes(),
+            'mapped_floats': self._floats is not None and self._floats.is_mapped,
+        }
+
+class FlatIndex(VectorIndex):
+    """Exact inner-product scan over all live rows."""
+
+    kind = 'flat'
+
+    def _candidates(self, query: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._scan(self._store, query, n)
+
+    def search_batch(self, queries: np.ndarray, top_k: int) -> List[List[Tuple[int, float]]]:
+        """Score all queries with one matrix product per block of queries."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        n = self._size
+        if n == 0 or top_k <= 0:
+            return [[] for _ in queries]
+        alive = self._alive[:n]
+        floats = self._floats
+        rerank = self.rerank and floats is not None and floats is not self._store
+        k = max(self.rerank, top_k) if rerank else top_k
+
+        results = []
+        step = max(1, BATCH_SCORE_CELLS // n)
+        for i in range(0, len(queries), step):
+            block = queries[i:i + step]
+            sims = self._store.scores_batch(block, n)
+            sims[:, ~alive] = -np.inf
+            best = self._top_k_rows(sims, k)
+            if rerank:
+                for query, pairs in zip(block, best):
+                    rows = np.array([row for row, _ in pairs], dtype=np.int64)
+                    results.append(self._top_k(rows, floats.scores_rows(query, rows), top_k))
+            else:
+                results.extend(best)
+        return results
+
+class IVFIndex(VectorIndex):
+    """Inverted-file ANN index with a k-means coarse quantizer.
+
+    Rows are bucketed by their nearest of `nlist` centroids and a search
+    scores only the `nprobe` closest buckets, so `nprobe` trades recall for
+    latency. Until `train_size` rows exist (default 39 per list) searches
+    fall back to an exact scan; the quantizer is then trained once and
+    later inserts are routed to their nearest bucket. Compaction retrains
+    if the shard has grown `RETRAIN_GROWTH` times since the last training.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, dim: int, capacity: int = INITIAL_CAPACITY,
+                 nlist: int = DEFAULT_NLIST, nprobe: int = DEFAULT_NPROBE,
+                 train_size: int = None, **storage):
+        super().__init__(dim, capacity, **storage)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size or nlist * MIN_POINTS_PER_LIST
+        self._trained_on = 0
+        # (centroids, lists) is replaced as one tuple so readers never pair
+        # new centroids with stale lists
+        self._ivf = None
+
+    @property
+    def is_trained(self) -> bool:
+        return self._ivf is not None
+
+    def train(self, n: int = None):
+        """Fit the coarse quantizer on the first `n` rows and rebuild the lists."""
+        n = self._size if n is None else n
+        live = np.flatnonzero(self._alive[:n])
+        sample = live
+        if len(sample) > self.nlist * MAX_POINTS_PER_LIST:
+            rng = np.random.default_rng(0)
+            sample = rng.choice(live, self.nlist * MAX_POINTS_PER_LIST, replace=False)
+        centroids = kmeans(self.vectors(sample), self.nlist)
+        lists = [GrowableArray((), np.int64, 16) for _ in range(len(centroids))]
+        rows = np.arange(n)
+        for i in range(0, n, SCORE_BLOCK):
+            block = rows[i:i + SCORE_BLOCK]
+            self._assign(centroids, lists, block, self.vectors(block))
+        self._ivf = (centroids, lists)
+        self._trained_on = int(self._alive[:n].sum())
+
+    @staticmethod
+    def _assign(centroids, lists, rows, vectors):
+        assign = nearest_centroids(vectors, centroids)
+        order = np.argsort(assign, kind='stable')
+        bounds = np.searchsorted(assign[order], np.arange(len(centroids) + 1))
+        for c in range(len(centroids)):
+            if bounds[c] < bounds[c + 1]:
+                lists[c].append(rows[order[bounds[c]:bounds[c + 1]]])
+
+    def _on_add(self, rows: np.ndarray, vectors: np.ndarray):
+        if self._ivf is not None:
+            self._assign(*self._ivf, rows, vectors)
+        elif rows[-1] + 1 >= self.train_size:
+            # Train on everything so far, including the rows being added
+            self.train(int(rows[-1]) + 1)
+
+    def _candidates(self, query: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+        ivf = self._ivf
+        if ivf is None:
+            return self._scan(self._store, query, n)
+        centroids, lists = ivf
+        half_norms = 0.5 * np.einsum('ij,ij->i', centroids, centroids)
+        probe = np.argsort(centroids @ query - half_norms)[::-1][:self.nprobe]
+        rows = np.concatenate([lists[c].view() for c in probe])
+        rows = rows[rows < n]
+        rows = rows[self._alive[rows]]
+        return rows, self._store.scores_rows(query, rows)
+
+    def _empty_like(self, capacity: int) -> "IVFIndex":
+        out = super()._empty_like(capacity)
+        out.nlist, out.nprobe, out.train_size = self.nlist, self.nprobe, self.train_size
+        if self._ivf is not None and self.live_count < self._trained_on * RETRAIN_GROWTH:
+            centroids = self._ivf[0]
+            out._ivf = (centroids, [GrowableArray((), np.int64, 16) for _ in range(len(centroids))])
+            out._trained_on = self._trained_on
+        return out
+
+    def memory_bytes(self) -> int:
+        total = super().memory_bytes()
+        if self._ivf is not None:
+            centroids, lists = self._ivf
+            total += centroids.nbytes + sum(lst.nbytes for lst in lists)
+        return total
+
+    def bytes_per_doc(self) -> float:
+        # Each row also sits in one int64 inverted list
+        return super().bytes_per_doc() + 8
+
+    def stats(self) -> Dict:
+        stats = super().stats()
+        stats.update({
+            'nlist': self.nlist,
+            'nprobe': self.nprobe,
+            'trained': self.is_trained,
+        })
+        return stats
+
+INDEX_BACKENDS = {
+    'flat': FlatIndex,
+    'ivf': IVFIndex,
+}
+
+def make_index(kind: str, dim: int, **params) -> VectorIndex:
+    """Construct an index backend by name ('flat' or 'ivf')."""
+    if kind not in INDEX_BACKENDS:
+        raise ValueError(f"Unknown index backend: {kind}")
+    return INDEX_BACKENDS[kind](dim, **params)
+
+# --- Evaluation ---
+def recall_report(index: VectorIndex, queries: np.ndarray, top_k: int = 10) -> Dict:
+    """Compare `index.search` against the exact scan on the same rows.
+
+    Returns mean recall@k plus average per-query latency of both paths.
+    """
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, index.dim)
+    hits = 0
+    total = 0
+    approx_s = exact_s = 0.0
+    for q in queries:
+        t0 = time.perf_counter()
+        approx = index.search(q, top_k)
+        t1 = time.perf_counter()
+        exact = index.exact_search(q, top_k)
+        t2 = time.perf_counter()
+        approx_s += t1 - t0
+        exact_s += t2 - t1
+        truth = {row for row, _ in exact}
+        hits += len(truth.intersection(row for row, _ in approx))
+        total += len(truth)
+    n = max(len(queries), 1)
+    return {
+        'kind': index.kind,
+        'storage': index.storage,
+        'reference': 'float32' if index.has_float_vectors else index.storage,
+        'k': top_k,
+        'queries': len(queries),
+        'recall': hits / total if total else 1.0,
+        'approx_ms': 1000 * approx_s / n,
+        'exact_ms': 1000 * exact_s / n,
+    }
+
+def storage_report(vectors: np.ndarray, queries: np.ndarray, top_k: int = 10,
+                   rerank: int = 100, **storage_params) -> List[Dict]:
+    """Recall@k and bytes/doc of each storage mode on a sample of vectors.
+
+    Every mode is built as a flat index over the same float32 `vectors`
+    and measured against the exact float32 scan, with and without re-rank.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    reference = FlatIndex(vectors.shape[1], capacity=len(vectors))
+    reference.add(vectors)
+    truth = [{row for row, _ in reference.search(q, top_k)} for q in queries]
+
+    reports = []
+    for storage, rr in [('float32', 0), ('int8', 0), ('int8', rerank),
+                        ('pq', 0), ('pq', rerank)]:
+        params = storage_params if storage == 'pq' else {}
+        if storage == 'pq':
+            # Train on the whole sample rather than the default threshold
+            params = dict(params, train_size=min(len(vectors), PQ_TRAIN_SIZE))
+        index = FlatIndex(vectors.shape[1], capacity=len(vectors), storage=storage,
+                          rerank=rr, storage_params=params)
+        index.add(vectors)
+        hits = sum(len(t.intersection(row for row, _ in index.search(q, top_k)))
+                   for q, t in zip(queries, truth))
+        total = sum(len(t) for t in truth)
+        reports.append({
+            'storage': storage,
+            'rerank': rr,
+            'bytes_per_doc': index.bytes_per_doc(),
+            'recall': hits / total if total else 1.0,
+        })
+    return reports
@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+
+from collections import deque, OrderedDict
+from typing import Iterable, Iterator, List, Dict, IO, Callable, Tuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+
+from shard_map import ShardMap, load_shard_map
+from admin import write_shard, read_shard, scatter
+from metadata import check_metadata
+from models import load_model
+from dedup import content_hash
+
+# --- Constants ---
+PROCESSES = max(1, (os.cpu_count() or 2) // 2)  # encoder processes
+BATCH_SIZE = 64            # documents per model call
+CHUNK_SIZE = 512           # documents per 'add' sent to a shard
+PENDING_BATCHES = 2        # encoded batches queued per process before reading stops
+SEND_WINDOW = 4            # 'add' requests in flight before encoding waits
+PROGRESS_INTERVAL = 5.0    # seconds between progress lines
+RECENT_HASHES = 100000     # content hashes remembered from this run (covers adds still in flight)
+NEAR_DUPLICATE_SAMPLES = 100  # near-duplicate pairs listed in the report
+
+# --- Reading ---
+def read_documents(lines: Iterable, fmt: str = 'text') -> Iterator[Tuple[str, Dict]]:
+    """(text, metadata) for each document in an iterable of lines, one at a time.
+
+    'jsonl' lines are a JSON string or an object with a 'text' (or
+    'document') field and optional 'metadata'; 'text' lines are documents
+    as-is. Blank lines are skipped. Raises ValueError on a line that isn't
+    valid JSON or has invalid metadata.
+    """
+    for number, line in enumerate(lines, 1):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        if fmt == 'jsonl':
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ValueError(f"Line {number} is not valid JSON")
+            if isinstance(record, str):
+                record = {'text': record}
+            elif not isinstance(record, dict):
+                raise ValueError(f"Line {number} is not a string or object")
+            line = record.get('text', record.get('document'))
+            if not isinstance(line, str) or not line.strip():
+                continue
+            try:
+                metadata = check_metadata(record.get('metadata'))
+            except ValueError as e:
+                raise ValueError(f"Line {number}: {e}")
+            yield line.strip(), metadata
+        else:
+            yield line, {}
+
+def until_error(documents: Iterable, errors: List[str]) -> Iterator:
+    """`documents` up to the first bad line, which is noted in `errors`.
+
+    Everything read before it is still stored.
+    """
+    try:
+        yield from documents
+    except ValueError as e:
+        errors.append(str(e))
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+# --- Encoder processes ---
+_model = None
+
+def _init_encoder(threads: int):
+    """Load the model once per process, with its share of the cores."""
+    global _model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _model = load_model()
+
+def _encode(texts: List[str]) -> np.ndarray:
+    return np.asarray(_model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+
+def make_encoder_pool(processes: int = PROCESSES) -> ProcessPoolExecutor:
+    """Processes that each hold a copy of the model (spawned, so safe from threaded callers)."""
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    return ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_encoder, initargs=(threads,))
+
+# --- Pipeline ---
+def ingest(documents: Iterable[Tuple[str, Dict]], shard_map: ShardMap, pool: ProcessPoolExecutor,
+           processes: int = PROCESSES, batch_size: int = BATCH_SIZE,
+           chunk_size: int = CHUNK_SIZE, progress: Callable[[Dict], None] = None,
+           dedup: bool = True, near_duplicate: float = None) -> Dict:
+    """Encode and store a stream of documents with bounded memory.
+
+    Batches are encoded on `pool` while earlier ones are being sent, and
+    each shard's documents go out in 'add' chunks of `chunk_size` with
+    their embeddings, so workers don't encode them again. At most
+    `PENDING_BATCHES` per process are being encoded and `SEND_WINDOW`
+    adds are in flight; beyond that, reading the input waits. Memory
+    stays the same however large the input is.
+
+    With `dedup`, a batch's exact duplicates (same normalized text) are
+    dropped before encoding: repeats within the run, and texts their
+    shard already holds. Shards also skip any that slip through, so
+    re-running an ingest after a failure stores and encodes only what is
+    missing. `near_duplicate` is passed to the shards, which flag (but
+    still store) documents that close to an existing one.
+    """
+    start = time.perf_counter()
+    report = {'documents': 0, 'stored': 0, 'duplicates': 0, 'encodes_avoided': 0,
+              'errors': [], 'per_shard': {}}
+    if near_duplicate is not None:
+        report['near_duplicates'] = []
+    recent = OrderedDict()
+    buffers = {shard_id: ([], [], []) for shard_id in shard_map.ids}
+    encoding: deque = deque()
+    sending: deque = deque()
+    senders = ThreadPoolExecutor(SEND_WINDOW)
+    last_progress = start
+
+    def finish_send(future: Future):
+        shard_id, count, resp = future.result()
+        if resp.get('status') == 'success':
+            count -= resp.get('duplicates', 0)
+            report['stored'] += count
+            report['duplicates'] += resp.get('duplicates', 0)
+            report['per_shard'][shard_id] = report['per_shard'].get(shard_id, 0) + count
+            if near_duplicate is not None:
+                flagged = report['near_duplicates']
+                flagged.extend(resp.get('near_duplicates', [])[:NEAR_DUPLICATE_SAMPLES - len(flagged)])
+        else:
+            report['errors'].append(f"Shard {shard_id}: {resp.get('message')}")
+
+    def send(shard_id: int, texts: List[str], vectors: List[np.ndarray], metadata: List[Dict]):
+        data = {'documents': texts, 'embeddings': np.stack(vectors)}
+        if not dedup:
+            data['dedup'] = False
+        if near_duplicate is not None:
+            data['near_duplicate'] = near_duplicate
+        if any(metadata):
+            data['metadata'] = metadata
+        sending.append(senders.submit(
+            lambda: (shard_id, len(texts), write_shard(shard_map, 'add', data, shard_id))))
+        while len(sending) > SEND_WINDOW:
+            finish_send(sending.popleft())
+
+    def place(batch: List[Tuple[str, Dict]], embeddings: np.ndarray):
+        texts = [text for text, _ in batch]
+        owners = shard_map.owners(texts).tolist()
+        for (text, metadata), vector, owner in zip(batch, embeddings, owners):
+            chunk = buffers[owner]
+            for part, item in zip(chunk, (text, vector, metadata)):
+                part.append(item)
+            if len(chunk[0]) >= chunk_size:
+                send(owner, *chunk)
+                buffers[owner] = ([], [], [])
+
+    def unseen(batch: List[Tuple[str, Dict]]) -> List[Tuple[str, Dict]]:
+        """`batch` without texts already seen this run or already stored."""
+        hashes = [content_hash(text) for text, _ in batch]
+        keep, in_batch = [], set()
+        for i, digest in enumerate(hashes):
+            if digest not in recent and digest not in in_batch:
+                in_batch.add(digest)
+                keep.append(i)
+        by_shard = {}
+        owners = shard_map.owners([batch[i][0] for i in keep]).tolist() if keep else []
+        for i, owner in zip(keep, owners):
+            by_shard.setdefault(owner, []).append(i)
+        lookups = scatter(lambda shard_id: read_shard(
+            shard_map, 'lookup', {'documents': [batch[i][0] for i in by_shard[shard_id]]}, shard_id),
+            by_shard)
+        stored = set()
+        for shard_id, resp in lookups.items():
+            # A shard that can't answer still drops duplicates when they arrive
+            if resp.get('status') == 'success':
+                stored.update(i for i, doc_id in zip(by_shard[shard_id], resp['doc_ids'])
+                              if doc_id is not None)
+        for digest in hashes:
+            recent[digest] = None
+            recent.move_to_end(digest)
+        while len(recent) > RECENT_HASHES:
+            recent.popitem(last=False)
+        fresh = [batch[i] for i in keep if i not in stored]
+        report['duplicates'] += len(batch) - len(fresh)
+        report['encodes_avoided'] += len(batch) - len(fresh)
+        return fresh
+
+    def drain_one():
+        nonlocal last_progress
+        batch, future = encoding.popleft()
+        place(batch, future.result())
+        now = time.perf_counter()
+        if progress is not None and now - last_progress >= PROGRESS_INTERVAL:
+            last_progress = now
+            progress(dict(report, docs_per_sec=report['documents'] / (now - start)))
+
+    try:
+        for batch in batched(until_error(documents, report['errors']), batch_size):
+            report['documents'] += len(batch)
+            if dedup:
+                batch = unseen(batch)
+                if not batch:
+                    continue
+            encoding.append((batch, pool.submit(_encode, [text for text, _ in batch])))
+            while len(encoding) > PENDING_BATCHES * processes:
+                drain_one()
+        while encoding:
+            drain_one()
+        for shard_id, chunk in buffers.items():
+            if chunk[0]:
+                send(shard_id, *chunk)
+        while sending:
+            finish_send(sending.popleft())
+    finally:
+        senders.shutdown(wait=True)
+
+    elapsed = time.perf_counter() - start
+    report.update(seconds=round(elapsed, 3),
+                  docs_per_sec=round(report['stored'] / elapsed, 1) if elapsed else 0.0,
+                  errors=report['errors'] or None)
+    return report
+
+def open_input(path: str) -> IO:
+    return sys.stdin if path == '-' else open(path, encoding='utf-8')
+
+# --- Entry point ---
+def main():
+    parser = argparse.ArgumentParser(description="Stream documents from a file into the shards")
+    parser.add_argument("--file", type=str, required=True,
+                        help="Input file ('-' for stdin): JSONL (text and optional metadata), "
+                             "or one document per line")
+    parser.add_argument("--format", choices=["jsonl", "text"], default=None,
+                        help="Input format (default: jsonl for .jsonl/.ndjson files, else text)")
+    parser.add_argument("--shard_map", type=str, default=None,
+                        help="Shard map JSON (default: $SHARD_MAP, else 5001 and 5002)")
+    parser.add_argument("--processes", type=int, default=PROCESSES,
+                        help="Encoder processes")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="Documents per model call")
+    parser.add_argument("--chunk_size", type=int, default=CHUNK_SIZE,
+                        help="Documents per add request to a shard")
+    parser.add_argument("--no_dedup", action="store_true",
+                        help="Store exact duplicates instead of skipping them")
+    parser.add_argument("--near_duplicate", type=float, default=None,
+                        help="Flag documents whose similarity to a stored one is at least this")
+    args = parser.parse_args()
+
+    fmt = args.format or ('jsonl' if args.file.endswith(('.jsonl', '.ndjson')) else 'text')
+    shard_map = load_shard_map(args.shard_map)
+    with make_encoder_pool(args.processes) as pool, open_input(args.file) as f:
+        report = ingest(read_documents(f, fmt), shard_map, pool, args.processes,
+                        args.batch_size, args.chunk_size,
+                        progress=lambda r: print(f"{r['documents']} read, {r['stored']} stored, "
+                                                 f"{r['duplicates']} duplicates, "
+                                                 f"{r['docs_per_sec']:.1f} docs/s"),
+                        dedup=not args.no_dedup, near_duplicate=args.near_duplicate)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import re
+import math
+import numpy as np
+
+from collections import Counter
+from typing import List, Tuple, Dict, Iterable
+
+from index import GrowableArray, top_k_pairs, INITIAL_CAPACITY, GROWTH_FACTOR
+
+# --- Constants ---
+BM25_K1 = 1.2              # term-frequency saturation
+BM25_B = 0.75              # document-length normalization
+POSTINGS_CAPACITY = 4      # initial slots per term's postings; grown geometrically
+BUILD_BLOCK = 10000        # documents tokenized per step when rebuilding from a shard
+TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; product codes like 'XJ-900' become 'xj' and '900'."""
+    return TOKEN_RE.findall(text.lower())
+
+# --- Inverted index ---
+class LexicalIndex:
+    """Incremental BM25 inverted index over the rows of a `VectorIndex`.
+
+    Each term maps to a compact (rows, 2) int32 array of (row, term
+    frequency) postings, appended in row order. Like `VectorIndex` it
+    expects a single writer and lock-free readers: postings and lengths
+    are written before the new size is published, and deletes swap in a
+    fresh tombstone mask. Collection statistics (live documents, total
+    length, document frequency) count live rows only, so scores don't
+    drift as documents are removed.
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY):
+        self.postings: Dict[str, GrowableArray] = {}
+        self._lengths = GrowableArray((), np.int32, capacity)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._live = 0
+        self._total_length = 0   # tokens across live rows
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, texts: List[str]) -> np.ndarray:
+        """Index `texts` as the next rows and return those rows."""
+        start = self._size
+        if not texts:
+            return np.arange(start, start)
+        by_term: Dict[str, List[Tuple[int, int]]] = {}
+        lengths = []
+        for row, text in enumerate(texts, start):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                by_term.setdefault(term, []).append((row, tf))
+
+        # One append per term for the whole batch
+        for term, pairs in by_term.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = GrowableArray((2,), np.int32, max(POSTINGS_CAPACITY, len(pairs)))
+            postings.append(np.array(pairs, dtype=np.int32))
+            self.postings[term] = postings
+        self._lengths.append(np.array(lengths, dtype=np.int32))
+
+        end = start + len(texts)
+        if end > len(self._alive):
+            alive = np.zeros(max(end, len(self._alive) * GROWTH_FACTOR), dtype=bool)
+            alive[:start] = self._alive[:start]
+            self._alive = alive
+        self._alive[start:end] = True
+        self._live += len(texts)
+        self._total_length += sum(lengths)
+        self._size = end
+        return np.arange(start, end)
+
+    def add_all(self, documents, n: int):
+        """Index rows 0..n-1 of `documents` (a list or lazy store), in blocks."""
+        for i in range(0, n, BUILD_BLOCK):
+            self.add([documents[row] for row in range(i, min(i + BUILD_BLOCK, n))])
+
+    def delete(self, rows: Iterable[int]) -> int:
+        """Tombstone rows; returns how many were live."""
+        rows = np.unique(np.asarray(list(rows), dtype=np.int64))
+        rows = rows[(rows >= 0) & (rows < self._size)]
+        alive = self._alive.copy()
+        rows = rows[alive[rows]]
+        alive[rows] = False
+        self._alive = alive
+        self._live -= len(rows)
+        self._total_length -= int(self._lengths[rows].sum())
+        return len(rows)
+
+    def search(self, query: str, top_k: int, mask: np.ndarray = None) -> List[Tuple[int, float]]:
+        """Up to `top_k` live (row, BM25 score) pairs for the query's terms.
+
+        Rows where `mask` is False (or beyond its end) are skipped; term
+        statistics still cover every live row, so scores don't change.
+        """
+        n, alive = self._size, self._alive
+        if n == 0 or top_k <= 0 or self._live <= 0:
+            return []
+        lengths = self._lengths.view(n)
+        avgdl = max(self._total_length / self._live, 1e-9)
+
+        rows_parts, score_parts = [], []
+        for term in dict.fromkeys(tokenize(query)):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            pairs = postings.view()
+            rows = pairs[:, 0]
+            keep = rows < n
+            keep[keep] = alive[rows[keep]]
+            rows, tf = rows[keep], pairs[keep, 1].astype(np.float32)
+            df = len(rows)
+            if mask is not None:
+                keep = rows < len(mask)
+                keep[keep] = mask[rows[keep]]
+                rows, tf = rows[keep], tf[keep]
+            if len(rows) == 0:
+                continue
+            idf = math.log(1 + (self._live - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / avgdl)
+            rows_parts.append(rows)
+            score_parts.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        if not rows_parts:
+            return []
+
+        # Sum each row's per-term scores over the candidates only
+        rows, inverse = np.unique(np.concatenate(rows_parts), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        return top_k_pairs(rows, scores, top_k)
+
+    def compacted(self, keep: np.ndarray) -> "LexicalIndex":
+        """Copy holding only `keep` (old rows, ascending), renumbered from 0.
+
+        Postings are remapped rather than re-tokenized.
+        """
+        keep = np.asarray(keep, dtype=np.int64)
+        out = LexicalIndex(max(len(keep), INITIAL_CAPACITY))
+        mapping = np.full(self._size, -1, dtype=np.int64)
+        mapping[keep] = np.arange(len(keep))
+        for term, postings in self.postings.items():
+            pairs = postings.view()
+            new_rows = mapping[pairs[:, 0]]
+            kept = new_rows >= 0
+            if kept.any():
+                moved = np.column_stack([new_rows[kept], pairs[kept, 1]]).astype(np.int32)
+                out.postings[term] = GrowableArray((2,), np.int32, max(POSTINGS_CAPACITY, len(moved)))
+                out.postings[term].append(moved)
+        lengths = self._lengths[keep]
+        out._lengths.append(lengths)
+        out._alive[:len(keep)] = True
+        out._size = out._live = len(keep)
+        out._total_length = int(lengths.sum())
+        return out
+
+    def stats(self) -> Dict:
+        postings_bytes = sum(p.nbytes for p in self.postings.values())
+        return {
+            'terms': len(self.postings),
+            'postings': sum(len(p) for p in self.postings.values()),
+            'live': self._live,
+            'avg_length': round(self._total_length / self._live, 2) if self._live else 0.0,
+            'memory_bytes': postings_bytes + self._lengths.nbytes + self._alive.nbytes,
+        }
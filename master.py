@@ -1,120 +1,612 @@
-import socket
 import json
+import time
+import asyncio
+import argparse
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Dict
+from typing import List, Dict, Callable, Tuple, Union, Iterable, Iterator
 import heapq
+import itertools
 
-BUFFER_SIZE = 4096
-END_MARKER = "<END>"
+from rpc import get_pool
+from models import load_model, embedding_dim
+from routing import ShardRouter, HEDGE_PERCENTILE
+from shard_map import ShardMap, load_shard_map
+from metrics import Histogram, Metrics, Trace, SlowQueryProfiler
+from metadata import check_filter
+from cache import (EmbeddingCache, EmbeddingSpill, ResultCache,
+                   EMBEDDING_CACHE_SIZE, RESULT_CACHE_SIZE)
+from protocol import (read_message, write_message, ConnectionClosed,
+                      flatten_results, split_results)
 
-def receive_data(sock):
-    data = ""
-    while True:
-        chunk = sock.recv(BUFFER_SIZE).decode('utf-8')
-        if not chunk:
-            break
-        if END_MARKER in chunk:
-            data += chunk[:chunk.index(END_MARKER)]
-            break
-        data += chunk
-    return data
+# --- Constants ---
+ENCODE_THREADS = 2          # threads running model.encode off the event loop
+MAX_CONCURRENT = 32         # queries being encoded/fanned out at once
+MAX_QUEUED = 256            # queries allowed to wait for a slot; beyond this we refuse
+MAX_PIPELINE = 8            # in-flight queries per client connection before we stop reading
+WORKER_TIMEOUT = 5.0        # default end-to-end deadline per query (seconds)
+STREAM_LIMIT = 16 * 1024 * 1024  # largest JSON message a client may send
+BATCH_SIZE = 32             # most queries encoded in one model call
+BATCH_WAIT_MS = 5.0         # longest a query waits for others to join its batch
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+MAX_BATCH_QUERIES = 1024    # queries allowed in one batch search request
+DEFAULT_TOP_K = 3
+MAX_TOP_K = 1000            # most results (offset + top_k) one query may page through
+VERSION_POLL_INTERVAL = 0.5 # seconds between shard version checks (result cache staleness bound)
+SEARCH_MODES = ('dense', 'lexical', 'hybrid')
+RRF_K = 60                  # reciprocal-rank fusion damping: score = sum 1 / (RRF_K + rank)
+HYBRID_DEPTH = 100          # least results per list fetched for fusion
 
-def send_data(sock, data):
+def unique_docs(results: Iterable[Dict]) -> Iterator[Dict]:
+    """Drop repeats of a doc_id; a document being migrated can briefly be on two shards."""
+    seen = set()
+    for result in results:
+        if result['doc_id'] not in seen:
+            seen.add(result['doc_id'])
+            yield result
 
-    data_str = json.dumps(data) + END_MARKER
-    for i in range(0, len(data_str), BUFFER_SIZE):
-        chunk = data_str[i:i + BUFFER_SIZE]
-        sock.send(chunk.encode('utf-8'))
+def describe_query(req: Dict) -> str:
+    """Short label of a query request for logs."""
+    if 'queries' in req:
+        queries = req['queries']
+        return f"batch of {len(queries) if isinstance(queries, list) else 0}"
+    return repr(str(req.get('query'))[:60])
+
+def fuse_rankings(rankings: List[List[Dict]], k: int = RRF_K) -> List[Dict]:
+    """Reciprocal-rank fusion of best-first result lists into one list.
+
+    Each document scores the sum of 1 / (k + rank) over the lists it
+    appears in (rank from 1), so agreeing lists reinforce each other and
+    their raw scores, which aren't comparable, are never mixed.
+    """
+    fused: Dict[int, Dict] = {}
+    for ranking in rankings:
+        for rank, result in enumerate(ranking, 1):
+            entry = fused.setdefault(result['doc_id'], dict(result, score=0.0))
+            entry['score'] += 1.0 / (k + rank)
+    return sorted(fused.values(), key=lambda x: x['score'], reverse=True)
+
+# --- Query encoder ---
+class MicroBatcher:
+    """Collects concurrent queries and encodes them in one model call.
+
+    A batch closes when it holds `max_batch` texts or `max_wait_ms` after
+    its first text arrived. At most one batch per encoder thread is in
+    flight; while they are all busy, waiting queries pile up and go out
+    as the next (fuller) batch.
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray],
+                 executor: ThreadPoolExecutor, threads: int,
+                 max_batch: int = BATCH_SIZE, max_wait_ms: float = BATCH_WAIT_MS):
+        self.encode_fn = encode_fn
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram()
+        self._threads = threads
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """Start collecting on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect())
+
+    async def encode(self, text: str) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        slots = asyncio.Semaphore(self._threads)
+        loop = asyncio.get_running_loop()
+        while True:
+            await slots.acquire()
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._run(batch))
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _run(self, batch: List):
+        now = time.perf_counter()
+        self.batch_sizes.observe(len(batch))
+        for _, _, enqueued in batch:
+            self.queue_wait_ms.observe(1000 * (now - enqueued))
+        try:
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.encode_fn, [text for text, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for row, (_, future, _) in enumerate(batch):
+            if not future.done():
+                future.set_result(embeddings[row])
+
+    def stats(self) -> Dict:
+        return {
+            'max_batch': self.max_batch,
+            'max_wait_ms': self.max_wait * 1000,
+            'batch_size': self.batch_sizes.snapshot(),
+            'queue_wait_ms': self.queue_wait_ms.snapshot(),
+        }
 
 class MasterServer:
-    def __init__(self, port: int, worker_ports: List[int]):
+    def __init__(self, port: int, worker_ports: Union[ShardMap, List[Union[int, List[int]]]],
+                 max_concurrent: int = MAX_CONCURRENT, max_queued: int = MAX_QUEUED,
+                 worker_timeout: float = WORKER_TIMEOUT,
+                 batch_size: int = BATCH_SIZE, batch_wait_ms: float = BATCH_WAIT_MS,
+                 embedding_cache: int = EMBEDDING_CACHE_SIZE,
+                 result_cache: int = RESULT_CACHE_SIZE, cache_dir: str = None,
+                 hedge_percentile: float = HEDGE_PERCENTILE,
+                 profile_slow_ms: float = None, profile_dir: str = None,
+                 embedding_service: str = None):
         """Initialize master server with worker information."""
         self.port = port
-        self.worker_ports = worker_ports
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
-        
-    def query_worker(self, worker_port: int, query_embedding: np.ndarray) -> List[Dict]:
-        """Send query to a worker and get results."""
+        self.worker_ports = worker_ports   # ShardMap, or one port / list of replica ports per shard
+        # A client of the shared embedding service when one is configured
+        self.model = load_model(service=embedding_service)
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.worker_timeout = worker_timeout
+        self.router = ShardRouter(worker_ports, worker_timeout, hedge_percentile)
+        self.encoder = ThreadPoolExecutor(max_workers=ENCODE_THREADS)
+        self.batcher = MicroBatcher(self.encode_texts, self.encoder, ENCODE_THREADS,
+                                    batch_size, batch_wait_ms)
+
+        # Caches: query text -> embedding (optionally spilled to disk), and
+        # (query, top_k) -> merged results, valid while shard versions hold
+        spill = None
+        if cache_dir:
+            spill = EmbeddingSpill(cache_dir, embedding_dim(service=embedding_service))
+        self.embedding_cache = EmbeddingCache(embedding_cache, spill)
+        self.result_cache = ResultCache(result_cache)
+        # Per-stage timings and counters ('metrics' command); queries slower
+        # than profile_slow_ms are logged with their stages and profiled
+        self.metrics = Metrics()
+        self.profile_slow_ms = profile_slow_ms
+        self.profiler = None
+        if profile_slow_ms is not None:
+            self.profiler = SlowQueryProfiler(profile_slow_ms, profile_dir or f"profiles-{port}")
+        self._slots = None    # asyncio.Semaphore, created on the server's loop
+        self._queued = 0
+        self._poller = None
+
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed `texts` with the model, reusing any spilled to disk (runs off the loop)."""
+        spill = self.embedding_cache.spill
+        found = spill.get_many(texts) if spill is not None else {}
+        missing = [text for text in texts if text not in found]
+        if missing:
+            encoded = np.asarray(self.model.encode(missing), dtype=np.float32)
+            found.update(zip(missing, encoded))
+            if spill is not None:
+                spill.put_many(list(zip(missing, encoded)))
+        return np.stack([found[text] for text in texts])
+
+    async def encode(self, text: str) -> np.ndarray:
+        """Embed one query; cache misses go through the micro-batcher."""
+        embedding = self.embedding_cache.get(text)
+        if embedding is None:
+            embedding = await self.batcher.encode(text)
+            self.embedding_cache.put(text, embedding)
+        return embedding
+
+    async def encode_many(self, texts: List[str]) -> np.ndarray:
+        """Embed a batch of queries in one model call for the cache misses."""
+        cached = [self.embedding_cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(t for t, e in zip(texts, cached) if e is None))
+        if missing:
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(self.encoder, self.encode_texts, missing)
+            fresh = dict(zip(missing, encoded))
+            for text, embedding in fresh.items():
+                self.embedding_cache.put(text, embedding)
+            cached = [e if e is not None else fresh[t] for t, e in zip(texts, cached)]
+        return np.stack(cached)
+
+    async def poll_versions(self):
+        """Keep shard versions fresh so cached results go stale promptly."""
+        while True:
+            await asyncio.gather(*[self.refresh_version(port) for port in self.router.ports])
+            await asyncio.sleep(VERSION_POLL_INTERVAL)
+
+    async def refresh_version(self, worker_port: int):
+        resp = await self.router.ask(worker_port, {'command': 'version'}, quiet=True)
+        if resp is None:
+            # Unknown state: stop trusting results that involved this worker
+            self.router.versions.pop(worker_port, None)
+
+    async def query_workers(self, payload: Dict, deadline: float,
+                            trace: Trace = None) -> Tuple[List[Dict], List[int], Dict]:
+        """Fan `payload` out to every shard; (replies, missing shard IDs, port versions).
+
+        With a `trace`, the fan-out is split into the slowest worker's own
+        time ('worker') and the rest ('network': transfer, queueing, hedging).
+        """
+        loop = asyncio.get_running_loop()
+        timeout = deadline - loop.time()
+        replies, missing, versions = [], [], {}
+        if timeout <= 0:
+            return replies, list(self.router.shard_ids), versions
+        sent = loop.time()
+        for shard_id, port, resp in await self.router.fan_out(payload, timeout):
+            if resp is None:
+                missing.append(shard_id)
+                continue
+            replies.append(resp)
+            if resp.get('version') is not None:
+                versions[port] = resp['version']
+        if trace is not None:
+            fan_out_ms = 1000 * (loop.time() - sent)
+            worker_ms = max((resp.get('took_ms', 0.0) for resp in replies), default=0.0)
+            trace.add('worker', worker_ms)
+            trace.add('network', max(0.0, fan_out_ms - worker_ms))
+        if missing:
+            self.metrics.incr('partial')
+        return replies, missing, versions
+
+    def merge_results(self, all_results: List[List[Dict]], top_k: int = DEFAULT_TOP_K,
+                      offset: int = 0) -> List[Dict]:
+        # Each worker list is already sorted best-first, so a k-way heap
+        # merge yields the global order lazily; stop after offset + top_k
+        merged = heapq.merge(*all_results, key=lambda x: x['score'], reverse=True)
+        return list(itertools.islice(unique_docs(merged), offset, offset + top_k))
+
+    def budget(self, query_data: Dict) -> float:
+        """Seconds this request may take end to end (client 'deadline_ms' or the default)."""
+        deadline_ms = query_data.get('deadline_ms')
+        if deadline_ms is None:
+            return self.worker_timeout
+        deadline_ms = float(deadline_ms)
+        if deadline_ms <= 0:
+            raise ValueError("deadline_ms must be positive")
+        return deadline_ms / 1000
+
+    def paging(self, query_data: Dict) -> Tuple[int, int]:
+        """Validated (top_k, offset) from a request; raises ValueError."""
+        top_k = int(query_data.get('top_k', DEFAULT_TOP_K))
+        offset = int(query_data.get('offset', 0))
+        if top_k < 1 or offset < 0:
+            raise ValueError("top_k must be positive and offset non-negative")
+        if offset + top_k > MAX_TOP_K:
+            raise ValueError(f"offset + top_k may not exceed {MAX_TOP_K}")
+        return top_k, offset
+
+    def search_filter(self, query_data: Dict):
+        """Validated metadata 'filter' expression from a request, or None; raises ValueError."""
+        filter_expr = query_data.get('filter')
+        if filter_expr is not None:
+            check_filter(filter_expr)
+        return filter_expr
+
+    def search_mode(self, query_data: Dict) -> str:
+        """Validated 'mode' from a request (default 'dense'); raises ValueError."""
+        mode = query_data.get('mode', 'dense')
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"mode must be one of {', '.join(SEARCH_MODES)}")
+        return mode
+
+    async def handle_query(self, query_data: Dict, trace: Trace = None) -> Dict:
+        """Embed the query (or batch), fan it out to every worker and merge."""
+        # The deadline starts now, so time spent queued and encoding counts
+        start = asyncio.get_running_loop().time()
+        trace = trace or self.metrics.trace()
+
+        # Admission control: refuse outright rather than queue without bound
+        if self._slots.locked() and self._queued >= self.max_queued:
+            self.metrics.incr('refused')
+            return {'status': 'error', 'message': 'Server busy, try again later',
+                    'results': []}
+
+        self._queued += 1
+        try:
+            with trace.stage('admission'):
+                await self._slots.acquire()
+        finally:
+            self._queued -= 1
         try:
-            # Connect to worker
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect(('localhost', worker_port))
-            
-            # Send query embedding using chunked transfer
-            query_data = {
-                'embedding': query_embedding.tolist()
-            }
-            send_data(client_socket, query_data)
-            
-            # Receive results using chunked transfer
-            response = receive_data(client_socket)
-            results = json.loads(response)
-            client_socket.close()
-            
-            return results['results']
-            
+            try:
+                top_k, offset = self.paging(query_data)
+                budget = self.budget(query_data)
+                mode = self.search_mode(query_data)
+                filter_expr = self.search_filter(query_data)
+            except (TypeError, ValueError) as e:
+                return {'status': 'error', 'message': str(e), 'results': []}
+
+            if 'queries' in query_data:
+                if mode != 'dense':
+                    return {'status': 'error', 'results': [],
+                            'message': 'Batch search supports dense mode only'}
+                if 'deadline_ms' not in query_data and isinstance(query_data['queries'], list):
+                    # Bigger batches get proportionally longer by default
+                    budget *= max(1.0, len(query_data['queries']) / self.batcher.max_batch)
+                return await self.search_batch(query_data['queries'], top_k, offset,
+                                               start + budget, filter_expr, trace)
+
+            return await self.search(query_data['query'], top_k, offset, start + budget,
+                                     mode, bool(query_data.get('prefilter')), filter_expr,
+                                     trace)
+        finally:
+            self._slots.release()
+
+    async def search(self, query: str, top_k: int = DEFAULT_TOP_K, offset: int = 0,
+                     deadline: float = None, mode: str = 'dense',
+                     prefilter: bool = False, filter_expr: Dict = None,
+                     trace: Trace = None) -> Dict:
+        """Search one query, answering from the result cache when still valid.
+
+        `mode` is 'dense' (embeddings), 'lexical' (BM25, no encoding) or
+        'hybrid' (both, fused here by reciprocal rank). `filter_expr`
+        restricts every shard to documents whose metadata matches. Shards
+        that miss the `deadline` (event-loop time) are left out; the reply
+        is then flagged 'partial' and lists them in 'missing_shards'.
+        Stage timings go to `trace`.
+        """
+        if deadline is None:
+            deadline = asyncio.get_running_loop().time() + self.worker_timeout
+        trace = trace or self.metrics.trace()
+        self.metrics.incr('queries')
+        key = (query, top_k, offset) if mode == 'dense' else (query, top_k, offset, mode, prefilter)
+        if filter_expr is not None:
+            key += (json.dumps(filter_expr, sort_keys=True),)
+        cached = self.result_cache.lookup(key, self.router.versions)
+        if cached is not None:
+            self.metrics.incr('result_cache_hits')
+            return {'results': cached}
+
+        # Query all shards concurrently; a slow shard only costs the deadline.
+        # Any of a shard's first offset + top_k results could land on the page.
+        depth = offset + top_k
+        request = {'top_k': depth}
+        if filter_expr is not None:
+            request['filter'] = filter_expr
+        if mode != 'dense':
+            request.update(mode=mode, query=query)
+        if mode != 'lexical':
+            with trace.stage('encode'):
+                request['embedding'] = await self.encode(query)
+        if mode == 'hybrid':
+            # A document ranked a little lower in both lists can outscore
+            # one ranked first in just one, so fuse deeper lists
+            depth = request['top_k'] = min(MAX_TOP_K, max(depth, HYBRID_DEPTH))
+            request['prefilter'] = prefilter
+        replies, missing, versions = await self.query_workers(request, deadline, trace)
+
+        # Merge and get the requested page
+        with trace.stage('merge'):
+            if mode == 'hybrid':
+                dense = self.merge_results([resp['results'] for resp in replies], depth)
+                lexical = self.merge_results([resp['lexical'] for resp in replies], depth)
+                results = fuse_rankings([dense, lexical])[offset:offset + top_k]
+            else:
+                results = self.merge_results([resp['results'] for resp in replies], top_k, offset)
+        if missing:
+            return {'results': results, 'partial': True, 'missing_shards': missing}
+
+        # Only complete answers are cached, tagged with the versions they saw
+        if len(versions) == len(replies):
+            self.result_cache.store(key, versions, results)
+        return {'results': results}
+
+    async def search_batch(self, queries: List[str], top_k: int = DEFAULT_TOP_K,
+                           offset: int = 0, deadline: float = None,
+                           filter_expr: Dict = None, trace: Trace = None) -> Dict:
+        """One model call and one request per worker for a whole batch of queries.
+
+        Replies with flattened results and per-query counts (see
+        `protocol.flatten_results`).
+        """
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return {'status': 'error', 'message': 'queries must be a list of strings',
+                    'results': []}
+        if len(queries) > MAX_BATCH_QUERIES:
+            return {'status': 'error', 'results': [],
+                    'message': f'At most {MAX_BATCH_QUERIES} queries per batch'}
+        if not queries:
+            return flatten_results([])
+
+        if deadline is None:
+            deadline = asyncio.get_running_loop().time() + self.worker_timeout
+        trace = trace or self.metrics.trace()
+        self.metrics.incr('batches')
+        self.metrics.incr('batch_queries', len(queries))
+        with trace.stage('encode'):
+            embeddings = await self.encode_many(queries)
+
+        request = {'embeddings': embeddings, 'top_k': offset + top_k}
+        if filter_expr is not None:
+            request['filter'] = filter_expr
+        replies, missing, _ = await self.query_workers(request, deadline, trace)
+        with trace.stage('merge'):
+            per_worker = [split_results(resp) for resp in replies]
+            # per_worker[w][q] -> merge across workers for each query q
+            merged = [self.merge_results(list(results), top_k, offset)
+                      for results in zip(*per_worker)] if per_worker else [[] for _ in queries]
+            resp = flatten_results(merged)
+        if missing:
+            resp.update(partial=True, missing_shards=missing)
+        return resp
+
+    def finish_trace(self, trace: Trace, req: Dict):
+        """Record a query's end-to-end time and report it if it was slow."""
+        total_ms = trace.elapsed_ms()
+        self.metrics.observe('total', total_ms)
+        if self.profile_slow_ms is not None and total_ms >= self.profile_slow_ms:
+            print(f"Slow query ({total_ms:.1f} ms) {describe_query(req)}: {trace.summary()}")
+
+    def metrics_command(self) -> Dict:
+        resp = {'status': 'success', 'metrics': self.metrics.snapshot(),
+                'encoder': self.batcher.stats()}
+        if self.profiler is not None:
+            resp['profiler'] = self.profiler.stats()
+        return resp
+
+    def shard_map_command(self, req: Dict) -> Dict:
+        """Report the shard map, or switch to the one given (used while rebalancing)."""
+        if req.get('shard_map') is not None:
+            shard_map = ShardMap.from_config(req['shard_map'])
+            self.router.update(shard_map)
+            self.worker_ports = shard_map
+            # Cached entries only track the shards that answered them
+            self.result_cache.clear()
+            print(f"Now routing to shards {shard_map.ids}")
+        return {'status': 'success', 'shard_map': self.current_shard_map().to_dict()}
+
+    def current_shard_map(self) -> ShardMap:
+        if isinstance(self.worker_ports, ShardMap):
+            return self.worker_ports
+        return ShardMap.from_config(self.worker_ports)
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one client connection; pipelined queries run concurrently."""
+        addr = writer.get_extra_info('peername')
+        print(f"Connection from {addr}")
+        write_lock = asyncio.Lock()
+        pipeline = asyncio.Semaphore(MAX_PIPELINE)
+        tasks = set()
+
+        async def answer(req: Dict, fmt: str):
+            request_id = req.pop('request_id', None)
+            trace = None
+            try:
+                if req.get('command') == 'ping':
+                    resp = {'status': 'success', 'pong': True}
+                elif req.get('command') == 'shard_map':
+                    resp = self.shard_map_command(req)
+                elif req.get('command') == 'stats':
+                    resp = {'status': 'success', 'encoder': self.batcher.stats(),
+                            'embedding_cache': self.embedding_cache.stats(),
+                            'result_cache': self.result_cache.stats(),
+                            'routing': self.router.stats()}
+                elif req.get('command') == 'metrics':
+                    resp = self.metrics_command()
+                else:
+                    trace = self.metrics.trace()
+                    if self.profiler is None:
+                        resp = await self.handle_query(req, trace)
+                    else:
+                        with self.profiler.profile(f"query {describe_query(req)}"):
+                            resp = await self.handle_query(req, trace)
+                    if resp.get('status') == 'error':
+                        self.metrics.incr('errors')
+                    if req.get('timings'):
+                        resp['timings_ms'] = trace.summary()
+            except Exception as e:
+                print(f"Error: {e}")
+                self.metrics.incr('errors')
+                resp = {'status': 'error', 'message': str(e), 'results': []}
+            if request_id is not None:
+                resp['request_id'] = request_id
+            try:
+                # Replies use whichever format the client spoke
+                async with write_lock:
+                    if trace is None:
+                        await write_message(writer, resp, fmt)
+                    else:
+                        with trace.stage('serialize'):
+                            await write_message(writer, resp, fmt)
+            except (ConnectionError, OSError) as e:
+                print(f"Could not reply to {addr}: {e}")
+            finally:
+                pipeline.release()
+            if trace is not None:
+                self.finish_trace(trace, req)
+
+        try:
+            while True:
+                # Stop reading while this client has too many queries in flight,
+                # so a flood backs up in its own TCP window, not in our memory
+                await pipeline.acquire()
+                try:
+                    req, fmt = await read_message(reader)
+                except ConnectionClosed:
+                    pipeline.release()
+                    break
+                task = asyncio.create_task(answer(req, fmt))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
         except Exception as e:
-            print(f"Error querying worker on port {worker_port}: {e}")
-            return []
-    
-    def merge_results(self, all_results: List[List[Dict]], top_k: int = 3) -> List[Dict]:
-        # Flatten all results
-        flat_results = []
-        for worker_results in all_results:
-            flat_results.extend(worker_results)
-        
-        # Sort by score and get top-k
-        return sorted(flat_results, key=lambda x: x['score'], reverse=True)[:top_k]
-    
+            print(f"Error: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Run the master on the current event loop until cancelled."""
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self.batcher.start()
+        if self.result_cache.max_entries > 0:
+            self._poller = asyncio.create_task(self.poll_versions())
+
+        # Warm the worker pools so the first query doesn't pay for connects
+        for port in self.router.ports:
+            try:
+                await asyncio.wrap_future(get_pool(port).submit({'command': 'ping'}))
+            except Exception as e:
+                print(f"Worker on port {port} not reachable yet: {e}")
+
+        server = await asyncio.start_server(self.handle_client, 'localhost', self.port,
+                                            limit=STREAM_LIMIT)
+        print(f"Master server listening on port {self.port}")
+        async with server:
+            await server.serve_forever()
+
     def start(self):
         #Start the master server.
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind(('localhost', self.port))
-        server_socket.listen(5)
-        print(f"Master server listening on port {self.port}")
-        
-        with ThreadPoolExecutor(max_workers=len(self.worker_ports)) as executor:
-            while True:
-                try:
-                    client_socket, addr = server_socket.accept()
-                    print(f"Connection from {addr}")
-                    
-                    # Receive query using chunked transfer
-                    data = receive_data(client_socket)
-                    query_data = json.loads(data)
-                    query_text = query_data['query']
-                    
-                    # Compute query embedding
-                    query_embedding = self.model.encode([query_text])[0]
-                    
-                    # Query all workers in parallel
-                    future_results = [
-                        executor.submit(self.query_worker, port, query_embedding)
-                        for port in self.worker_ports
-                    ]
-                    
-                    # Collect results
-                    all_results = [future.result() for future in future_results]
-                    
-                    # Merge and get top results
-                    final_results = self.merge_results(all_results)
-                    
-                    # Send response using chunked transfer
-                    response = {'results': final_results}
-                    send_data(client_socket, response)
-                    client_socket.close()
-                    
-                except Exception as e:
-                    print(f"Error: {e}")
-                    continue
+        asyncio.run(self.serve())
 
 if __name__ == "__main__":
     # Configure ports
     MASTER_PORT = 5000
-    WORKER_PORTS = [5001, 5002]  # Two workers
-    
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=MASTER_PORT,
+                        help="Port clients connect to")
+    parser.add_argument("--shard_map", type=str, default=None,
+                        help="Shard map JSON listing each shard's replica ports "
+                             "(default: $SHARD_MAP, else one worker each on 5001 and 5002)")
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="Most queries encoded in one model call")
+    parser.add_argument("--batch_wait_ms", type=float, default=BATCH_WAIT_MS,
+                        help="Longest a query waits for others to join its batch")
+    parser.add_argument("--embedding_cache", type=int, default=EMBEDDING_CACHE_SIZE,
+                        help="Query embeddings kept in memory (0 disables)")
+    parser.add_argument("--result_cache", type=int, default=RESULT_CACHE_SIZE,
+                        help="Merged result lists kept in memory (0 disables)")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Spill query embeddings here so they survive restarts")
+    parser.add_argument("--hedge_percentile", type=float, default=HEDGE_PERCENTILE,
+                        help="Send a backup request to another replica once a shard "
+                             "is slower than this latency percentile")
+    parser.add_argument("--profile_slow_ms", type=float, default=None,
+                        help="Log stage timings of queries slower than this and save "
+                             "sampled stack profiles of them")
+    parser.add_argument("--profile_dir", type=str, default=None,
+                        help="Where slow-query profiles go (default: profiles-<port>)")
+    parser.add_argument("--embedding_service", type=str, default=None,
+                        help="Port (or host:port) of embedder.py to encode with instead of "
+                             "loading a model here (default: $EMBEDDING_SERVICE)")
+    args = parser.parse_args()
+
     # Start master server
-    master = MasterServer(MASTER_PORT, WORKER_PORTS)
-    master.start() 
\ No newline at end of file
+    master = MasterServer(args.port, load_shard_map(args.shard_map),
+                          batch_size=args.batch_size, batch_wait_ms=args.batch_wait_ms,
+                          embedding_cache=args.embedding_cache,
+                          result_cache=args.result_cache, cache_dir=args.cache_dir,
+                          hedge_percentile=args.hedge_percentile,
+                          profile_slow_ms=args.profile_slow_ms, profile_dir=args.profile_dir,
+                          embedding_service=args.embedding_service)
+    master.start()
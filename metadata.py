@@ -0,0 +1,235 @@
+import json
+import numpy as np
+
+from typing import List, Dict, Tuple, Any, Iterable
+
+from index import GrowableArray
+
+# --- Constants ---
+ROWS_CAPACITY = 4          # initial slots per value's row list; grown geometrically
+BUILD_BLOCK = 10000        # rows decoded per step when rebuilding from a shard
+MAX_FILTER_DEPTH = 16      # nesting allowed in a filter expression
+LOGICAL_OPS = ('$and', '$or', '$not')
+FIELD_OPS = ('$eq', '$ne', '$in', '$nin', '$gt', '$gte', '$lt', '$lte', '$exists')
+RANGE_OPS = {
+    '$gt': lambda a, b: a > b,
+    '$gte': lambda a, b: a >= b,
+    '$lt': lambda a, b: a < b,
+    '$lte': lambda a, b: a <= b,
+}
+
+# --- Values ---
+def value_key(value) -> Tuple[str, Any]:
+    """Index key for a scalar; bools, numbers and strings never compare equal to each other."""
+    if isinstance(value, bool):
+        return ('bool', value)
+    if isinstance(value, (int, float)):
+        return ('num', float(value))
+    if isinstance(value, str):
+        return ('str', value)
+    raise ValueError(f"Metadata values must be strings, numbers or booleans, not {value!r}")
+
+def check_metadata(metadata) -> Dict:
+    """A document's metadata as a dict of field -> scalar or list of scalars; raises ValueError."""
+    if metadata is None:
+        return {}
+    if not isinstance(metadata, dict):
+        raise ValueError("Document metadata must be an object")
+    for field, value in metadata.items():
+        if not isinstance(field, str) or not field or field.startswith('$'):
+            raise ValueError(f"Invalid metadata field name: {field!r}")
+        for v in value if isinstance(value, list) else [value]:
+            value_key(v)
+    return metadata
+
+def encode_metadata(metadata: Dict) -> str:
+    """Row form stored next to the text ('' when there is none)."""
+    return json.dumps(metadata, sort_keys=True) if metadata else ''
+
+def decode_metadata(encoded: str) -> Dict:
+    return json.loads(encoded) if encoded else {}
+
+def check_filter(expr, depth: int = 0):
+    """Validate a filter expression without evaluating it; raises ValueError.
+
+    An expression is an object whose entries must all match. A field
+    entry is a value (equality) or an object of operators: $eq, $ne, $in,
+    $nin, $gt, $gte, $lt, $lte, $exists. $and and $or take lists of
+    expressions and $not one expression. A list-valued field matches if
+    any of its values does. Example:
+        {"tenant": "acme", "year": {"$gte": 2020}, "$or": [{"source": "web"}, {"pinned": true}]}
+    """
+    if depth > MAX_FILTER_DEPTH:
+        raise ValueError("Filter is nested too deeply")
+    if not isinstance(expr, dict):
+        raise ValueError("A filter must be an object")
+    for key, cond in expr.items():
+        if key in ('$and', '$or'):
+            if not isinstance(cond, list) or not cond:
+                raise ValueError(f"{key} needs a non-empty list of filters")
+            for sub in cond:
+                check_filter(sub, depth + 1)
+        elif key == '$not':
+            check_filter(cond, depth + 1)
+        elif key.startswith('$'):
+            raise ValueError(f"Unknown filter operator: {key}")
+        elif isinstance(cond, dict):
+            for op, operand in cond.items():
+                if op not in FIELD_OPS:
+                    raise ValueError(f"Unknown operator {op} on field {key}")
+                if op in ('$in', '$nin'):
+                    if not isinstance(operand, list):
+                        raise ValueError(f"{op} on field {key} needs a list")
+                    for v in operand:
+                        value_key(v)
+                elif op == '$exists':
+                    if not isinstance(operand, bool):
+                        raise ValueError(f"$exists on field {key} needs true or false")
+                else:
+                    value_key(operand)
+        else:
+            value_key(cond)
+
+# --- Field indexes ---
+class MetadataIndex:
+    """Per-field indexes from each value to the rows holding it.
+
+    Row lists are int32 arrays appended in row order, so they stay
+    sorted. A filter is evaluated into a boolean row mask (a bitmap) by
+    setting the rows of each matching value and combining masks with
+    vectorised and/or/not; ranges walk only the field's distinct values.
+    Single writer, lock-free readers, as for the other shard indexes:
+    rows are appended before the size is published. Removed rows stay in
+    the row lists, but `delete` tombstones them so no filter matches them,
+    until `compacted` drops them.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Dict[Tuple, GrowableArray]] = {}
+        self._size = 0
+        self._removed = np.zeros(0, dtype=bool)   # tombstones; grown only by deletes
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, metadata: List[Dict]) -> np.ndarray:
+        """Index the metadata of the next rows (None or {} for none) and return those rows."""
+        start = self._size
+        by_value: Dict[str, Dict[Tuple, List[int]]] = {}
+        for row, fields in enumerate(metadata, start):
+            for field, value in (fields or {}).items():
+                for v in value if isinstance(value, list) else [value]:
+                    by_value.setdefault(field, {}).setdefault(value_key(v), []).append(row)
+        for field, values in by_value.items():
+            index = self.fields.get(field)
+            if index is None:
+                index = {}
+            for key, rows in values.items():
+                row_list = index.get(key)
+                if row_list is None:
+                    row_list = GrowableArray((), np.int32, max(ROWS_CAPACITY, len(rows)))
+                # A list value repeating an element lists the row once
+                row_list.append(np.unique(np.array(rows, dtype=np.int32)))
+                index[key] = row_list
+            self.fields[field] = index
+        self._size = start + len(metadata)
+        return np.arange(start, self._size)
+
+    def add_all(self, attributes, n: int):
+        """Index rows 0..n-1 of encoded `attributes` (a list or lazy store), in blocks."""
+        for i in range(0, n, BUILD_BLOCK):
+            self.add([decode_metadata(attributes[row]) for row in range(i, min(i + BUILD_BLOCK, n))])
+
+    def delete(self, rows: Iterable[int]):
+        """Tombstone rows; a fresh mask is swapped in, so readers never see it half-written."""
+        rows = np.asarray(list(rows), dtype=np.int64)
+        removed = np.zeros(max(self._size, len(self._removed)), dtype=bool)
+        removed[:len(self._removed)] = self._removed
+        removed[rows[(rows >= 0) & (rows < len(removed))]] = True
+        self._removed = removed
+
+    def _rows_mask(self, row_lists: List[GrowableArray], n: int) -> np.ndarray:
+        mask = np.zeros(n, dtype=bool)
+        for row_list in row_lists:
+            rows = row_list.view()
+            mask[rows[rows < n]] = True
+        return mask
+
+    def _field_mask(self, field: str, cond, n: int) -> np.ndarray:
+        index = self.fields.get(field, {})
+        if not isinstance(cond, dict):
+            cond = {'$eq': cond}
+        mask = np.ones(n, dtype=bool)
+        for op, operand in cond.items():
+            if op in ('$eq', '$ne'):
+                row_list = index.get(value_key(operand))
+                matched = self._rows_mask([row_list] if row_list is not None else [], n)
+            elif op in ('$in', '$nin'):
+                keys = {value_key(v) for v in operand}
+                matched = self._rows_mask([index[k] for k in keys if k in index], n)
+            elif op == '$exists':
+                matched = self._rows_mask(list(index.values()), n)
+            else:
+                tag, bound = value_key(operand)
+                compare = RANGE_OPS[op]
+                matched = self._rows_mask([rows for (t, v), rows in list(index.items())
+                                           if t == tag and compare(v, bound)], n)
+            if op in ('$ne', '$nin') or (op == '$exists' and not operand):
+                matched = ~matched
+            mask &= matched
+        return mask
+
+    def evaluate(self, expr: Dict, n: int = None) -> np.ndarray:
+        """Boolean mask over the first `n` rows (default: all) matching `expr`.
+
+        Removed rows never match. Call `check_filter` first; this assumes a
+        well-formed expression.
+        """
+        n = self._size if n is None else n
+        mask = self._evaluate(expr, n)
+        removed = self._removed[:n]
+        mask[:len(removed)] &= ~removed
+        return mask
+
+    def _evaluate(self, expr: Dict, n: int) -> np.ndarray:
+        mask = np.ones(n, dtype=bool)
+        for key, cond in expr.items():
+            if key == '$and':
+                for sub in cond:
+                    mask &= self._evaluate(sub, n)
+            elif key == '$or':
+                either = np.zeros(n, dtype=bool)
+                for sub in cond:
+                    either |= self._evaluate(sub, n)
+                mask &= either
+            elif key == '$not':
+                mask &= ~self._evaluate(cond, n)
+            else:
+                mask &= self._field_mask(key, cond, n)
+        return mask
+
+    def compacted(self, keep: np.ndarray) -> "MetadataIndex":
+        """Copy holding only `keep` (old rows, ascending), renumbered from 0."""
+        keep = np.asarray(keep, dtype=np.int64)
+        out = MetadataIndex()
+        mapping = np.full(self._size, -1, dtype=np.int64)
+        mapping[keep] = np.arange(len(keep))
+        for field, index in self.fields.items():
+            new_index = {}
+            for key, row_list in index.items():
+                rows = mapping[row_list.view()]
+                rows = rows[rows >= 0].astype(np.int32)
+                if len(rows):
+                    new_index[key] = GrowableArray((), np.int32, max(ROWS_CAPACITY, len(rows)))
+                    new_index[key].append(rows)
+            if new_index:
+                out.fields[field] = new_index
+        out._size = len(keep)
+        return out
+
+    def stats(self) -> Dict:
+        return {
+            'fields': {field: len(index) for field, index in self.fields.items()},
+            'memory_bytes': sum(rows.nbytes for index in self.fields.values()
+                                for rows in index.values()),
+        }
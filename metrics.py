@@ -0,0 +1,270 @@
+import os
+import sys
+import time
+import bisect
+import logging
+import threading
+
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, Sequence, List
+
+# --- Constants ---
+# Default bucket upper bounds (milliseconds) for latency histograms
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+PROFILE_INTERVAL_MS = 5.0  # stack sampling period while a profiled request runs
+PROFILE_KEEP = 20          # slow-query profiles kept on disk; older ones are deleted
+PROFILE_DEPTH = 64         # innermost frames recorded per sample
+
+def _finite(value: float):
+    """JSON has no infinity; report overflow quantiles as None."""
+    return None if value == float('inf') else value
+
+# --- Histogram ---
+class Histogram:
+    """Fixed-bucket histogram, cheap enough to update on every request.
+
+    `bounds` are inclusive upper bounds; values above the last bound land
+    in an overflow bucket. Quantiles are estimated from bucket bounds.
+    """
+
+    def __init__(self, bounds: Sequence[float] = LATENCY_BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, count: int = 1):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[i] += count
+            self._sum += value * count
+            self._count += count
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th value (inf if overflow)."""
+        with self._lock:
+            counts, total = list(self._counts), self._count
+        if not total:
+            return 0.0
+        target = q * total
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def snapshot(self) -> Dict:
+        """JSON-friendly view: per-bucket counts keyed by upper bound."""
+        with self._lock:
+            counts, total, total_sum = list(self._counts), self._count, self._sum
+        labels = [str(b) for b in self.bounds] + ['+Inf']
+        return {
+            'count': total,
+            'mean': round(total_sum / total, 4) if total else 0.0,
+            'p50': _finite(self.quantile(0.5)),
+            'p95': _finite(self.quantile(0.95)),
+            'p99': _finite(self.quantile(0.99)),
+            'buckets': dict(zip(labels, counts)),
+        }
+
+# --- Counters ---
+class Counters:
+    """Named counters that hot paths bump without taking a lock.
+
+    Each thread increments its own dict; `snapshot` sums them. Only the
+    first increment on a new thread takes a lock, to register its dict.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: List[Counter] = []
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, count: int = 1):
+        counts = getattr(self._local, 'counts', None)
+        if counts is None:
+            counts = self._local.counts = Counter()
+            with self._lock:
+                self._shards.append(counts)
+        counts[name] += count
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            shards = list(self._shards)
+        total = Counter()
+        for counts in shards:
+            total.update(dict(counts))
+        return dict(total)
+
+# --- Stage timings ---
+class Metrics:
+    """Counters plus one latency histogram per stage, for one process."""
+
+    def __init__(self):
+        self.counters = Counters()
+        self.stages: Dict[str, Histogram] = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, count: int = 1):
+        self.counters.incr(name, count)
+
+    def observe(self, stage: str, ms: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, Histogram())
+        histogram.observe(ms)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Record the time spent in the `with` block under `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, 1000 * (time.perf_counter() - start))
+
+    def trace(self) -> "Trace":
+        return Trace(self)
+
+    def snapshot(self) -> Dict:
+        return {
+            'uptime_s': round(time.time() - self.started, 1),
+            'counters': self.counters.snapshot(),
+            'stages_ms': {stage: h.snapshot() for stage, h in sorted(self.stages.items())},
+        }
+
+class Trace:
+    """Stage timings of one request, also recorded into its `Metrics`.
+
+    Stages are timed with the monotonic `perf_counter` clock; a stage
+    entered twice adds up.
+    """
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+        self.stages: Dict[str, float] = {}
+        self.start = time.perf_counter()
+
+    def add(self, stage: str, ms: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+        self.metrics.observe(stage, ms)
+
+    @contextmanager
+    def stage(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, 1000 * (time.perf_counter() - start))
+
+    def elapsed_ms(self) -> float:
+        return 1000 * (time.perf_counter() - self.start)
+
+    def summary(self) -> Dict[str, float]:
+        return {stage: round(ms, 3) for stage, ms in self.stages.items()}
+
+# --- Slow-query profiler ---
+class SlowQueryProfiler:
+    """Opt-in sampling profiler that keeps profiles of slow requests only.
+
+    While any request is inside `profile`, a background thread samples
+    stacks every `interval_ms` (of the request's own thread, or of every
+    thread for requests that hop threads, such as asyncio ones). A request
+    that takes `threshold_ms` or more has its samples written to `out_dir`
+    in collapsed-stack form (one `frame;frame;... count` line per stack,
+    the input of flamegraph.pl and speedscope); the rest are dropped.
+    Concurrent all-thread requests share samples, so their profiles
+    overlap. Costs nothing while no request is being profiled.
+    """
+
+    def __init__(self, threshold_ms: float, out_dir: str,
+                 interval_ms: float = PROFILE_INTERVAL_MS, keep: int = PROFILE_KEEP):
+        self.threshold_ms = threshold_ms
+        self.out_dir = out_dir
+        self.interval = interval_ms / 1000
+        self.recent = deque(maxlen=keep)   # newest dumps: path, label, elapsed
+        self.dumped = 0
+        self._active: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        os.makedirs(out_dir, exist_ok=True)
+        threading.Thread(target=self._sample_loop, daemon=True, name="profiler").start()
+
+    @contextmanager
+    def profile(self, label: str, thread_id: int = None):
+        """Profile the `with` block; `thread_id` limits sampling to that thread."""
+        samples = Counter()
+        token = id(samples)
+        start = time.perf_counter()
+        with self._lock:
+            self._active[token] = (thread_id, samples)
+        self._wake.set()
+        try:
+            yield
+        finally:
+            with self._lock:
+                del self._active[token]
+            elapsed_ms = 1000 * (time.perf_counter() - start)
+            if elapsed_ms >= self.threshold_ms and samples:
+                self._dump(label, elapsed_ms, samples)
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        while True:
+            self._wake.wait()
+            if not self._active:
+                self._wake.clear()
+                # A request may have started between the check and the clear
+                if not self._active:
+                    continue
+            frames = sys._current_frames()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = {tid: self._collapse(names.get(tid, str(tid)), frame)
+                      for tid, frame in frames.items() if tid != me}
+            del frames
+            with self._lock:
+                for thread_id, samples in self._active.values():
+                    if thread_id is None:
+                        samples.update(stacks.values())
+                    elif thread_id in stacks:
+                        samples[stacks[thread_id]] += 1
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        names = []
+        while frame is not None and len(names) < PROFILE_DEPTH:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ';'.join([thread_name] + names[::-1])
+
+    def _dump(self, label: str, elapsed_ms: float, samples: Counter):
+        path = os.path.join(self.out_dir, f"slow-{time.strftime('%Y%m%d-%H%M%S')}-"
+                                          f"{self.dumped}-{int(elapsed_ms)}ms.folded")
+        try:
+            with open(path, 'w') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logging.warning(f"[profiler] could not write {path}: {e}")
+            return
+        with self._lock:
+            self.dumped += 1
+            if len(self.recent) == self.recent.maxlen:
+                try:
+                    os.remove(self.recent[0]['path'])
+                except OSError:
+                    pass
+            self.recent.append({'path': path, 'label': label, 'elapsed_ms': round(elapsed_ms, 2)})
+        logging.warning(f"[profiler] {label} took {elapsed_ms:.1f} ms; profile in {path}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'threshold_ms': self.threshold_ms, 'interval_ms': self.interval * 1000,
+                    'dumped': self.dumped, 'recent': list(self.recent)}
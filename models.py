@@ -0,0 +1,155 @@
+import os
+import time
+import hashlib
+import numpy as np
+
+from typing import List, Union, Tuple, Dict
+
+from lexical import tokenize
+from rpc import get_pool, abandon
+
+# --- Constants ---
+MODEL_NAME = 'all-MiniLM-L6-v2'
+MODEL_ENV = "EMBEDDING_MODEL"   # model to load when none is given; 'stub' for StubModel
+STUB_MODEL = 'stub'
+STUB_DIM = 384                  # same width as MiniLM, so memory and scoring costs match
+TOKEN_CACHE_SIZE = 100000       # token vectors kept by a StubModel
+SERVICE_ENV = "EMBEDDING_SERVICE"  # port (or host:port) of a shared embedder.py to use instead
+MODEL_DIMS = {MODEL_NAME: 384, STUB_MODEL: STUB_DIM}  # widths known without loading the model
+REMOTE_CHUNK = 256              # texts per request to the embedding service
+CONNECT_RETRIES = 30            # attempts to reach the embedding service (it may still be starting)
+RETRY_DELAY = 1.0
+
+def model_name(name: str = None) -> str:
+    return name or os.environ.get(MODEL_ENV) or MODEL_NAME
+
+def load_local_model(name: str = None):
+    """Sentence embedding model `name` (default: $EMBEDDING_MODEL, else MiniLM), in this process.
+
+    'stub' gives a `StubModel`, which needs no download or torch.
+    sentence_transformers is imported only when a real model is loaded.
+    """
+    name = model_name(name)
+    if name == STUB_MODEL:
+        return StubModel()
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(name)
+
+def load_model(name: str = None, service: str = None):
+    """The model to embed with: the shared embedding service at `service`
+    (default: $EMBEDDING_SERVICE) if one is configured, else a local copy."""
+    service = service or os.environ.get(SERVICE_ENV)
+    if service:
+        return RemoteModel(*parse_address(service))
+    return load_local_model(name)
+
+def embedding_dim(name: str = None, service: str = None) -> int:
+    """Vector width of the configured model, without loading it when the width is known.
+
+    With an embedding service configured, the service is asked: it may run
+    a different model than this process would load.
+    """
+    service = service or os.environ.get(SERVICE_ENV)
+    if service:
+        return RemoteModel(*parse_address(service)).get_sentence_embedding_dimension()
+    dim = MODEL_DIMS.get(model_name(name))
+    if dim is None:
+        dim = load_local_model(name).get_sentence_embedding_dimension()
+    return dim
+
+def parse_address(service: Union[str, int]) -> Tuple[str, int]:
+    """(host, port) from 'port' or 'host:port'."""
+    host, _, port = str(service).rpartition(':')
+    return host or 'localhost', int(port)
+
+# --- Embedding service client ---
+class RemoteModel:
+    """Encodes through the shared embedding service (`embedder.py`).
+
+    Offers the model methods callers use (`encode`,
+    `get_sentence_embedding_dimension`), so it drops in for a local model.
+    Large inputs go out as several requests in flight at once, and the
+    service batches them with other callers' texts.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._dim = None
+
+    def _submit(self, payload: Dict):
+        for attempt in range(1, CONNECT_RETRIES + 1):
+            try:
+                return get_pool(self.port, self.host).submit(payload)
+            except OSError:
+                # Only connecting is retried; the service may still be starting
+                if attempt == CONNECT_RETRIES:
+                    raise
+                time.sleep(RETRY_DELAY)
+
+    def _result(self, future) -> Dict:
+        try:
+            resp = future.result(get_pool(self.port, self.host).timeout)
+        finally:
+            abandon(future)
+        if resp.get('status') != 'success':
+            raise RuntimeError(f"Embedding service: {resp.get('message')}")
+        return resp
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dim is None:
+            self._dim = int(self._result(self._submit({'command': 'info'}))['dim'])
+        return self._dim
+
+    def encode(self, texts: Union[str, List[str]], convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        if not texts:
+            return np.empty((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        futures = [self._submit({'command': 'encode', 'texts': texts[i:i + REMOTE_CHUNK]})
+                   for i in range(0, len(texts), REMOTE_CHUNK)]
+        try:
+            out = np.concatenate([np.asarray(self._result(f)['embeddings'], dtype=np.float32)
+                                  for f in futures])
+        finally:
+            for future in futures:
+                abandon(future)
+        return out[0] if single else out
+
+# --- Stub model ---
+class StubModel:
+    """Deterministic, offline stand-in for a sentence embedding model.
+
+    Each token gets a fixed pseudo-random unit vector seeded from its
+    hash; a text's embedding is the normalized sum of its tokens'
+    vectors. Texts sharing words score higher, so search results and
+    recall are meaningful, and every process computes the same vectors.
+    """
+
+    def __init__(self, dim: int = STUB_DIM):
+        self.dim = dim
+        self._tokens = {}
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def token_vector(self, token: str) -> np.ndarray:
+        vector = self._tokens.get(token)
+        if vector is None:
+            seed = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'big')
+            vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            if len(self._tokens) >= TOKEN_CACHE_SIZE:
+                self._tokens.clear()
+            self._tokens[token] = vector
+        return vector
+
+    def encode(self, texts: Union[str, List[str]], convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        out = np.zeros((1 if single else len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate([texts] if single else texts):
+            # A text without word tokens still gets its own vector
+            for token in tokenize(text) or [text]:
+                out[i] += self.token_vector(token)
+        out /= np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out[0] if single else out
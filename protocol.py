@@ -0,0 +1,251 @@
+import os
+import json
+import asyncio
+import struct
+import socket
+import weakref
+import numpy as np
+
+from typing import Dict, Tuple, List
+
+# --- Constants ---
+BUFFER_SIZE = 4096
+END_MARKER = "<END>"
+MAGIC = b"DSS\x01"                 # first bytes of every binary frame
+FRAME_HEADER = struct.Struct("!4sII")  # magic, header length, body length
+JSON = "json"
+BINARY = "binary"
+# Format used when this process starts a conversation; replies always use
+# the format of the request. Set DSS_WIRE_FORMAT=json to debug with plain text.
+WIRE_FORMAT = os.environ.get("DSS_WIRE_FORMAT", BINARY)
+
+# Result fields sent as packed numeric columns in binary frames
+RESULT_COLUMNS = (('doc_id', np.int64), ('score', np.float32))
+
+class ConnectionClosed(ConnectionError):
+    """The peer closed the connection before sending another message."""
+
+# Bytes read past the end of a JSON frame, kept for the next receive on
+# the same (persistent) socket
+_leftovers = weakref.WeakKeyDictionary()
+
+def _recv(sock: socket.socket, n: int) -> bytes:
+    stash = _leftovers.pop(sock, None)
+    if stash:
+        if len(stash) > n:
+            _leftovers[sock] = stash[n:]
+            return stash[:n]
+        return stash
+    return sock.recv(n)
+
+# --- JSON framing (legacy, still accepted) ---
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Not JSON serializable: {type(obj).__name__}")
+
+def encode_json(payload: Dict) -> bytes:
+    """JSON text plus end marker; '<' is escaped so a document can't end the frame."""
+    text = json.dumps(payload, default=_json_default).replace("<", "\\u003c")
+    return (text + END_MARKER).encode('utf-8')
+
+def _receive_json(sock: socket.socket, data: bytearray) -> Dict:
+    """Read until the end marker, decoding once so multi-byte UTF-8 survives chunking."""
+    marker = END_MARKER.encode('utf-8')
+    while True:
+        # Only the tail can contain a marker that straddles two chunks
+        pos = data.find(marker, max(0, len(data) - BUFFER_SIZE - len(marker)))
+        if pos >= 0:
+            if pos + len(marker) < len(data):
+                _leftovers[sock] = bytes(data[pos + len(marker):])
+            del data[pos:]
+            break
+        chunk = _recv(sock, BUFFER_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode('utf-8')) if data else {}
+
+# --- Binary framing ---
+def _pack_results(results: List[Dict], buffers: List[np.ndarray]) -> Dict:
+    """Move numeric result columns into raw buffers; the rest stays in the header."""
+    packed = {'__columns__': {}, 'rest': []}
+    for key, dtype in RESULT_COLUMNS:
+        if not all(key in r for r in results):
+            continue
+        packed['__columns__'][key] = len(buffers)
+        buffers.append(np.array([r[key] for r in results], dtype=dtype))
+    columns = packed['__columns__']
+    packed['rest'] = [{k: v for k, v in r.items() if k not in columns} for r in results]
+    return packed
+
+def _unpack_results(packed: Dict, arrays: List[np.ndarray]) -> List[Dict]:
+    results = packed['rest']
+    for key, idx in packed['__columns__'].items():
+        for r, value in zip(results, arrays[idx].tolist()):
+            r[key] = value
+    return results
+
+def encode_binary(payload: Dict) -> List[bytes]:
+    """Frame a payload as header JSON plus raw buffers (returned as send chunks).
+
+    Top-level numpy arrays travel as raw bytes, and a top-level 'results'
+    list is packed into columns, so neither goes through float-to-text
+    conversion. Arrays are sent from their own memory without copying.
+    """
+    buffers = []
+    header = {}
+    for key, value in payload.items():
+        if isinstance(value, np.ndarray):
+            header[key] = {'__buffer__': len(buffers)}
+            buffers.append(value)
+        elif key == 'results' and isinstance(value, list) and value \
+                and all(isinstance(r, dict) for r in value):
+            header[key] = _pack_results(value, buffers)
+        else:
+            header[key] = value
+
+    buffers = [np.ascontiguousarray(b) for b in buffers]
+    header['__buffers__'] = [[b.dtype.str, list(b.shape)] for b in buffers]
+    header_bytes = json.dumps(header, default=_json_default).encode('utf-8')
+    body_len = sum(b.nbytes for b in buffers)
+    chunks = [FRAME_HEADER.pack(MAGIC, len(header_bytes), body_len), header_bytes]
+    chunks.extend(memoryview(b).cast('B') for b in buffers if b.nbytes)
+    return chunks
+
+def _recv_into(sock: socket.socket, view: memoryview):
+    """Fill `view` completely from the socket."""
+    stash = _leftovers.pop(sock, None)
+    if stash:
+        n = min(len(stash), len(view))
+        view[:n] = stash[:n]
+        if n < len(stash):
+            _leftovers[sock] = stash[n:]
+        view = view[n:]
+    while len(view):
+        n = sock.recv_into(view)
+        if n == 0:
+            raise ConnectionError("Connection closed mid-frame")
+        view = view[n:]
+
+def _receive_binary(sock: socket.socket, prefix: bytes) -> Dict:
+    head = bytearray(FRAME_HEADER.size)
+    head[:len(prefix)] = prefix
+    _recv_into(sock, memoryview(head)[len(prefix):])
+    _, header_len, body_len = FRAME_HEADER.unpack(head)
+
+    # One preallocated buffer for the whole frame; arrays are views into it
+    frame = bytearray(header_len + body_len)
+    _recv_into(sock, memoryview(frame))
+    return decode_frame(frame, header_len)
+
+def decode_frame(frame: bytearray, header_len: int) -> Dict:
+    """Rebuild a payload from a frame's header and body (without the fixed prefix)."""
+    view = memoryview(frame)
+    header = json.loads(view[:header_len].tobytes().decode('utf-8'))
+
+    arrays = []
+    offset = header_len
+    for dtype, shape in header.pop('__buffers__'):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        arrays.append(np.frombuffer(frame, dtype=dtype, count=count,
+                                    offset=offset).reshape(shape))
+        offset += count * dtype.itemsize
+
+    payload = {}
+    for key, value in header.items():
+        if isinstance(value, dict) and '__buffer__' in value:
+            payload[key] = arrays[value['__buffer__']]
+        elif isinstance(value, dict) and '__columns__' in value:
+            payload[key] = _unpack_results(value, arrays)
+        else:
+            payload[key] = value
+    return payload
+
+# --- Batched results ---
+def flatten_results(batch: List[List[Dict]]) -> Dict:
+    """Per-query result lists as one flat 'results' list plus 'counts'.
+
+    A flat top-level 'results' list is what binary frames pack into
+    columns, so batch replies get the same compact encoding.
+    """
+    return {'results': [r for results in batch for r in results],
+            'counts': [len(results) for results in batch]}
+
+def split_results(payload: Dict) -> List[List[Dict]]:
+    """Inverse of `flatten_results`."""
+    results, batch, start = payload['results'], [], 0
+    for count in payload['counts']:
+        batch.append(results[start:start + count])
+        start += count
+    return batch
+
+# --- Public API ---
+def send_message(sock: socket.socket, payload: Dict, fmt: str = None) -> None:
+    """Send `payload` in `fmt` ('binary' or 'json'; default WIRE_FORMAT)."""
+    fmt = fmt or WIRE_FORMAT
+    if fmt == BINARY:
+        for chunk in encode_binary(payload):
+            sock.sendall(chunk)
+    else:
+        sock.sendall(encode_json(payload))
+
+def receive_message(sock: socket.socket) -> Tuple[Dict, str]:
+    """Receive one message in either format; returns (payload, format).
+
+    The format is detected from the first bytes, so a server can answer
+    each peer in the format it spoke. Raises ConnectionClosed if the peer
+    hangs up cleanly between messages.
+    """
+    prefix = bytearray()
+    while len(prefix) < len(MAGIC):
+        chunk = _recv(sock, len(MAGIC) - len(prefix))
+        if not chunk:
+            if not prefix:
+                raise ConnectionClosed("Peer closed the connection")
+            break
+        prefix += chunk
+        if not MAGIC.startswith(bytes(prefix)):
+            break
+    if bytes(prefix) == MAGIC:
+        return _receive_binary(sock, bytes(prefix)), BINARY
+    return _receive_json(sock, prefix), JSON
+
+# --- asyncio streams ---
+async def read_message(reader: asyncio.StreamReader) -> Tuple[Dict, str]:
+    """Async `receive_message` for asyncio servers; same formats and errors."""
+    try:
+        prefix = await reader.readexactly(1)
+    except asyncio.IncompleteReadError:
+        raise ConnectionClosed("Peer closed the connection")
+    if prefix == MAGIC[:1]:
+        try:
+            prefix += await reader.readexactly(len(MAGIC) - 1)
+        except asyncio.IncompleteReadError as e:
+            prefix += e.partial
+    if prefix == MAGIC:
+        try:
+            head = prefix + await reader.readexactly(FRAME_HEADER.size - len(MAGIC))
+            _, header_len, body_len = FRAME_HEADER.unpack(head)
+            frame = bytearray(await reader.readexactly(header_len + body_len))
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed mid-frame")
+        return decode_frame(frame, header_len), BINARY
+    try:
+        data = prefix + await reader.readuntil(END_MARKER.encode('utf-8'))
+        data = data[:-len(END_MARKER)]
+    except asyncio.IncompleteReadError as e:
+        data = prefix + e.partial
+    return (json.loads(data.decode('utf-8')) if data else {}), JSON
+
+async def write_message(writer: asyncio.StreamWriter, payload: Dict, fmt: str = None) -> None:
+    """Async `send_message`; waits for the transport to drain (backpressure)."""
+    fmt = fmt or WIRE_FORMAT
+    if fmt == BINARY:
+        writer.writelines(encode_binary(payload))
+    else:
+        writer.write(encode_json(payload))
+    await writer.drain()
@@ -0,0 +1,117 @@
+import argparse
+
+from typing import Dict
+
+from rpc import get_pool
+from shard_map import ShardMap, load_shard_map
+from admin import read_shard, write_shard
+
+# --- Constants ---
+MASTER_PORT = 5000
+MOVE_BATCH = 1000     # documents moved per export/add/remove step
+MAX_PASSES = 3        # rescans to pick up documents written during a pass
+
+# --- Master ---
+def master_shard_map(master_port: int = MASTER_PORT) -> ShardMap:
+    resp = get_pool(master_port).request({'command': 'shard_map'})
+    return ShardMap.from_config(resp['shard_map'])
+
+def set_master_shard_map(shard_map: ShardMap, master_port: int = MASTER_PORT):
+    resp = get_pool(master_port).request({'command': 'shard_map',
+                                          'shard_map': shard_map.to_dict()})
+    if resp.get('status') != 'success':
+        raise RuntimeError(f"Master refused shard map: {resp.get('message')}")
+
+# --- Migration ---
+def transition_map(old: ShardMap, new: ShardMap) -> ShardMap:
+    """Every shard of both maps, placed by `new`'s ring.
+
+    Shards dropped from `new` stay in with weight 0, so they are still
+    searched (and drained) until their documents have moved.
+    """
+    shards = dict(old.shards)
+    shards.update(new.shards)
+    weights = {shard_id: 0 for shard_id in old.shards}
+    weights.update(new.weights)
+    return ShardMap(shards, weights, new.vnodes)
+
+def migrate_shard(shard_map: ShardMap, shard_id: int, batch: int = MOVE_BATCH) -> int:
+    """Move every document the ring places elsewhere off `shard_id`; returns the count.
+
+    Each batch is added to its new shard (with its embeddings, so nothing
+    is re-encoded, and its doc IDs unchanged) before it is removed here.
+    Until the remove lands a document is on both shards; the master
+    drops the duplicate when merging.
+    """
+    moved, after = 0, -1
+    while True:
+        resp = read_shard(shard_map, 'export',
+                          {'shard_map': shard_map.to_dict(), 'after': after, 'limit': batch},
+                          shard_id)
+        if resp.get('status') != 'success':
+            raise RuntimeError(f"Shard {shard_id} export failed: {resp.get('message')}")
+
+        by_owner: Dict[int, list] = {}
+        for i, owner in enumerate(resp['owners']):
+            by_owner.setdefault(owner, []).append(i)
+        for owner, idx in sorted(by_owner.items()):
+            add = write_shard(shard_map, 'add', {
+                'documents': [resp['documents'][i] for i in idx],
+                'doc_ids': [resp['doc_ids'][i] for i in idx],
+                'metadata': [resp['metadata'][i] for i in idx],
+                'embeddings': resp['embeddings'][idx],
+            }, owner)
+            if add.get('status') != 'success':
+                raise RuntimeError(f"Shard {owner} add failed: {add.get('message')}")
+        if resp['doc_ids']:
+            remove = write_shard(shard_map, 'remove', {'doc_ids': resp['doc_ids']}, shard_id)
+            if remove.get('status') != 'success':
+                raise RuntimeError(f"Shard {shard_id} remove failed: {remove.get('message')}")
+            moved += len(resp['doc_ids'])
+            print(f"Shard {shard_id}: moved {moved} documents")
+
+        if resp['done']:
+            return moved
+        after = resp['cursor']
+
+def rebalance(new_map: ShardMap, master_port: int = MASTER_PORT,
+              batch: int = MOVE_BATCH) -> Dict[int, int]:
+    """Migrate from the master's current shard map to `new_map` while it serves queries.
+
+    New shards' workers must already be running. Only documents whose
+    ring owner changed are moved. Returns documents moved per source shard.
+    """
+    old_map = master_shard_map(master_port)
+    shard_map = transition_map(old_map, new_map)
+    set_master_shard_map(shard_map, master_port)
+
+    moved = {shard_id: 0 for shard_id in shard_map.ids}
+    for _ in range(MAX_PASSES):
+        moved_this_pass = 0
+        for shard_id in shard_map.ids:
+            n = migrate_shard(shard_map, shard_id, batch)
+            moved[shard_id] += n
+            moved_this_pass += n
+        if not moved_this_pass:
+            break
+
+    set_master_shard_map(new_map, master_port)
+    return moved
+
+# --- Entry point ---
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move documents to match a new shard map (add, drain or reweight shards)")
+    parser.add_argument("--shard_map", type=str, required=True,
+                        help="The new shard map; point the web app's $SHARD_MAP at it too")
+    parser.add_argument("--master_port", type=int, default=MASTER_PORT)
+    parser.add_argument("--batch", type=int, default=MOVE_BATCH,
+                        help="Documents moved per step")
+    args = parser.parse_args()
+
+    moved = rebalance(load_shard_map(args.shard_map), args.master_port, args.batch)
+    for shard_id, count in moved.items():
+        print(f"Shard {shard_id}: {count} documents moved out")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import time
+import asyncio
+import itertools
+import numpy as np
+
+from collections import deque, defaultdict
+from typing import List, Dict, Iterator, Optional, Tuple, Union
+
+from rpc import get_pool, abandon
+from shard_map import ShardMap, normalize
+
+# --- Constants ---
+WORKER_TIMEOUT = 5.0        # default per-query budget for the fan-out (seconds)
+HEDGE_PERCENTILE = 95       # send a backup request once a shard is slower than this
+HEDGE_MIN_MS = 2.0          # never hedge sooner than this
+HEDGE_MIN_SAMPLES = 50      # latencies needed before the percentile is trusted
+LATENCY_WINDOW = 1000       # recent latencies kept per shard
+PERCENTILE_REFRESH = 64     # observations between percentile recomputations
+LATENCY_EWMA = 0.2          # weight of the newest sample in a replica's latency average
+FAILURE_BACKOFF = 1.0       # seconds a failed replica is tried last
+
+# --- Latency tracking ---
+class LatencyTracker:
+    """Sliding window of recent latencies with a cached percentile."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._cached = {}
+        self._since_refresh = 0
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, ms: float):
+        self._samples.append(ms)
+        self._since_refresh += 1
+        if self._since_refresh >= PERCENTILE_REFRESH:
+            self._cached.clear()
+            self._since_refresh = 0
+
+    def percentile(self, p: float) -> float:
+        if p not in self._cached:
+            self._cached[p] = float(np.percentile(self._samples, p)) if self._samples else 0.0
+        return self._cached[p]
+
+# --- Router ---
+class ShardRouter:
+    """Fans requests out to every shard, one replica each, within a deadline.
+
+    `shards[i]` lists the worker ports serving shard `shard_ids[i]` (a
+    `ShardMap`, or a plain list for shards 1..n). A request goes
+    to the replica with the fewest requests in flight from this router,
+    ties going to the lowest recent latency; replicas that just failed
+    are tried last. If it hasn't answered after the shard's
+    `hedge_percentile` latency (or fails outright) a backup request goes
+    to another replica, and whichever answers first wins. Shards with no
+    answer by the deadline are reported as missing instead of delaying
+    the whole query.
+    """
+
+    def __init__(self, shards: Union[ShardMap, List[Union[int, List[int]]]],
+                 timeout: float = WORKER_TIMEOUT, hedge_percentile: float = HEDGE_PERCENTILE,
+                 hedge_min_ms: float = HEDGE_MIN_MS):
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_ms = hedge_min_ms
+        self.shards, self.shard_ids, self.latency, self._turns = [], [], [], []
+        self.update(shards)
+        self.versions = {}          # port -> latest shard version it reported
+        self.in_flight = defaultdict(int)   # port -> requests awaiting a reply
+        self.replica_ms = {}        # port -> moving average latency
+        self.failed_at = {}         # port -> loop time of its last failure
+        self.counters = {'requests': 0, 'hedges': 0, 'hedge_wins': 0,
+                         'failures': 0, 'missing': 0}
+
+    def update(self, shards: Union[ShardMap, List[Union[int, List[int]]]]):
+        """Switch to a new set of shards; in-flight fan-outs finish on the old one."""
+        if isinstance(shards, ShardMap):
+            shard_ids, replicas = shards.ids, [shards.replicas(i) for i in shards.ids]
+        else:
+            replicas = normalize(shards)
+            shard_ids = list(range(1, len(replicas) + 1))
+        # Shards that stay keep their latency history
+        kept = dict(zip(self.shard_ids, self.latency))
+        self.latency = [kept.get(i) or LatencyTracker() for i in shard_ids]
+        self._turns = [itertools.count() for _ in shard_ids]
+        self.shards, self.shard_ids = replicas, shard_ids
+
+    @property
+    def ports(self) -> List[int]:
+        return [port for replicas in self.shards for port in replicas]
+
+    def note_version(self, port: int, resp: Optional[Dict]):
+        version = resp.get('version') if resp else None
+        if version is not None:
+            self.versions[port] = max(version, self.versions.get(port, 0))
+
+    async def ask(self, port: int, payload: Dict, timeout: float = None,
+                  quiet: bool = False) -> Optional[Dict]:
+        """Send a request to a worker over its pooled connection; None on failure."""
+        timeout = timeout or self.timeout
+        future = None
+        try:
+            # The pooled connection's reader thread resolves the future
+            future = get_pool(port).submit(payload)
+            resp = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            if not quiet:
+                print(f"Worker on port {port} timed out after {timeout:.3f}s")
+            return None
+        except Exception as e:
+            if not quiet:
+                print(f"Error querying worker on port {port}: {e}")
+            return None
+        finally:
+            # Timed out or cancelled (a hedge won): stop counting it as in flight
+            if future is not None:
+                abandon(future)
+        if resp.get('status') == 'error':
+            if not quiet:
+                print(f"Worker on port {port} failed: {resp.get('message')}")
+            return None
+        self.note_version(port, resp)
+        return resp
+
+    def replica_order(self, shard: int) -> List[int]:
+        """Replicas of `shard` in the order to try them: least loaded, then fastest."""
+        return self._order(self.shards[shard], self._turns[shard])
+
+    def _order(self, replicas: List[int], turns: Iterator[int]) -> List[int]:
+        # Rotate first so equally good replicas take turns
+        start = next(turns) % len(replicas)
+        replicas = replicas[start:] + replicas[:start]
+        return sorted(replicas, key=lambda port: (
+            self.backing_off(port),
+            self.in_flight[port],
+            self.replica_ms.get(port, 0.0),
+        ))
+
+    def backing_off(self, port: int) -> bool:
+        failed_at = self.failed_at.get(port)
+        return failed_at is not None and time.monotonic() - failed_at < FAILURE_BACKOFF
+
+    def note_reply(self, port: int, ms: Optional[float]):
+        """Record how a request to `port` ended (`ms` is None on failure)."""
+        if ms is None:
+            self.failed_at[port] = time.monotonic()
+            return
+        previous = self.replica_ms.get(port, ms)
+        self.replica_ms[port] = previous + LATENCY_EWMA * (ms - previous)
+
+    def hedge_delay(self, shard: int) -> Optional[float]:
+        """Seconds to wait before a backup request, or None if not hedging."""
+        return self._hedge_delay(self.shards[shard], self.latency[shard])
+
+    def _hedge_delay(self, replicas: List[int], tracker: LatencyTracker) -> Optional[float]:
+        if len(replicas) < 2 or self.hedge_percentile is None:
+            return None
+        if len(tracker) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(self.hedge_min_ms, tracker.percentile(self.hedge_percentile)) / 1000
+
+    async def query_shard(self, shard: int, payload: Dict, deadline: float
+                          ) -> Tuple[Optional[int], Optional[Dict]]:
+        """(port, reply) from the first replica to answer before `deadline`."""
+        return await self._query(self.shards[shard], self.latency[shard], self._turns[shard],
+                                 payload, deadline)
+
+    async def _query(self, shard_replicas: List[int], tracker: LatencyTracker,
+                     turns: Iterator[int], payload: Dict, deadline: float
+                     ) -> Tuple[Optional[int], Optional[Dict]]:
+        # Works only on this shard's replicas and tracker as they were when
+        # the query started, so an `update` mid-query can't mix in another shard
+        replicas = self._order(shard_replicas, turns)
+        loop = asyncio.get_running_loop()
+
+        def send(port: int) -> asyncio.Task:
+            # Workers drop requests they can no longer answer in time
+            budget = deadline - loop.time()
+            request = dict(payload, timeout_ms=int(budget * 1000))
+            task = asyncio.ensure_future(self.ask(port, request, budget))
+            task.port, task.sent = port, loop.time()
+            self.in_flight[port] += 1
+            task.add_done_callback(lambda _: self.release(port))
+            return task
+
+        pending = {send(replicas[0])}
+        backups = iter(replicas[1:])
+        delay = self._hedge_delay(shard_replicas, tracker)
+        self.counters['requests'] += 1
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                wait = remaining if delay is None else min(delay, remaining)
+                done, pending = await asyncio.wait(pending, timeout=wait,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    resp = task.result()
+                    self.note_reply(task.port, None if resp is None
+                                    else 1000 * (loop.time() - task.sent))
+                    if resp is not None:
+                        if task.port != replicas[0]:
+                            self.counters['hedge_wins'] += 1
+                        # Time from this replica's own send, so hedged wins
+                        # don't inflate the percentile that triggers hedges
+                        tracker.observe(1000 * (loop.time() - task.sent))
+                        return task.port, resp
+                    self.counters['failures'] += 1
+                if deadline - loop.time() <= 0:
+                    break
+                # Slow (hedge delay passed) or failed: bring in the next replica
+                backup = next(backups, None)
+                if backup is not None:
+                    if not done:
+                        self.counters['hedges'] += 1
+                    pending.add(send(backup))
+                    delay = None if len(shard_replicas) < 3 else delay
+                elif not done:
+                    delay = None
+        finally:
+            for task in pending:
+                # Still waiting: count the time so far, so a slow or hung
+                # replica drifts to the back of the order
+                self.note_reply(task.port, 1000 * (loop.time() - task.sent))
+                task.cancel()
+        self.counters['missing'] += 1
+        return None, None
+
+    def release(self, port: int):
+        self.in_flight[port] -= 1
+
+    async def fan_out(self, payload: Dict, timeout: float = None
+                      ) -> List[Tuple[int, Optional[int], Optional[Dict]]]:
+        """Ask every shard concurrently; (shard_id, port, reply), port and reply None if missed."""
+        deadline = asyncio.get_running_loop().time() + (timeout or self.timeout)
+        shard_ids = self.shard_ids
+        shards = list(zip(self.shards, self.latency, self._turns))
+        replies = await asyncio.gather(*[
+            self._query(replicas, tracker, turns, payload, deadline)
+            for replicas, tracker, turns in shards
+        ])
+        return [(shard_id, port, resp) for shard_id, (port, resp) in zip(shard_ids, replies)]
+
+    def stats(self) -> Dict:
+        return dict(self.counters, shards=[
+            {
+                'shard_id': self.shard_ids[shard],
+                'replicas': [
+                    {
+                        'port': port,
+                        'in_flight': self.in_flight[port],
+                        'latency_ms': round(self.replica_ms.get(port, 0.0), 3),
+                        'backing_off': self.backing_off(port),
+                    }
+                    for port in replicas
+                ],
+                'p50_ms': round(self.latency[shard].percentile(50), 3),
+                'p99_ms': round(self.latency[shard].percentile(99), 3),
+                'hedge_after_ms': (round(1000 * self.hedge_delay(shard), 3)
+                                   if self.hedge_delay(shard) is not None else None),
+            }
+            for shard, replicas in enumerate(self.shards)
+        ])
@@ -0,0 +1,307 @@
+import time
+import socket
+import logging
+import itertools
+import threading
+
+from concurrent.futures import Future, Executor
+from typing import Dict, Callable, List, Tuple
+
+from protocol import send_message, receive_message, ConnectionClosed
+from metrics import Metrics
+
+# --- Constants ---
+POOL_SIZE = 4            # connections kept per (host, port)
+CONNECT_TIMEOUT = 1.0
+REQUEST_TIMEOUT = 30.0   # seconds to wait for a reply
+HEALTH_INTERVAL = 5.0    # seconds between pings of idle connections
+
+_request_ids = itertools.count(1)
+
+# --- Client side ---
+class Connection:
+    """One persistent connection carrying many tagged requests at once.
+
+    Every request gets a `request_id`; a reader thread matches replies to
+    waiting futures by that ID, so replies may arrive in any order. A
+    caller that stops waiting must `abandon` its future, or the request
+    counts as in flight until the server answers or the connection dies.
+    """
+
+    def __init__(self, host: str, port: int, fmt: str = None):
+        self.address = (host, port)
+        self.fmt = fmt
+        self.sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.closed = False
+        self._pending: Dict[int, Tuple[Future, float]] = {}   # request_id -> (future, sent at)
+        self._lock = threading.Lock()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    @property
+    def oldest_sent(self) -> float:
+        """Monotonic send time of the longest-waiting request (None if idle)."""
+        return min((sent for _, sent in list(self._pending.values())), default=None)
+
+    def send(self, payload: Dict) -> Future:
+        """Send a request and return a future for its reply."""
+        request_id = next(_request_ids)
+        future = Future()
+        # A caller giving up (e.g. asyncio timeout) must not cancel the
+        # future under the reader thread, which still owns its reply
+        future.set_running_or_notify_cancel()
+        future.connection, future.request_id = self, request_id
+        with self._lock:
+            if self.closed:
+                raise ConnectionClosed(f"Connection to {self.address} is closed")
+            self._pending[request_id] = (future, time.monotonic())
+            try:
+                send_message(self.sock, dict(payload, request_id=request_id), self.fmt)
+            except OSError as e:
+                self._pending.pop(request_id, None)
+                self._fail(e)
+                raise
+        return future
+
+    def _read_loop(self):
+        try:
+            while True:
+                resp, _ = receive_message(self.sock)
+                entry = self._pending.pop(resp.pop('request_id', None), None)
+                if entry is not None:
+                    entry[0].set_result(resp)
+        except Exception as e:
+            with self._lock:
+                self._fail(e)
+
+    def _fail(self, error: Exception):
+        """Mark closed and fail every waiter (caller holds the lock)."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            future.set_exception(ConnectionError(f"Connection to {self.address} lost: {error}"))
+
+    def abandon(self, request_id: int):
+        """Stop waiting for a request's reply; a late reply is dropped."""
+        entry = self._pending.pop(request_id, None)
+        if entry is not None and not entry[0].done():
+            entry[0].set_exception(TimeoutError(f"Request to {self.address} abandoned"))
+
+    def close(self):
+        with self._lock:
+            self._fail(ConnectionClosed("closed by client"))
+
+def abandon(future: Future):
+    """Give up on a request sent with `Connection.send` (e.g. after a timeout)."""
+    conn = getattr(future, 'connection', None)
+    if conn is not None and not future.done():
+        conn.abandon(future.request_id)
+
+class ConnectionPool:
+    """Long-lived connections to one server, shared by all callers.
+
+    Requests go to the open connection with the fewest in-flight requests;
+    dead connections are replaced on demand, connecting outside the pool's
+    lock so an unreachable server doesn't hold up callers that have a
+    connection to use. `health_check` pings idle connections, and busy ones
+    whose oldest request has waited longer than `timeout`, and drops any
+    that don't answer.
+    """
+
+    def __init__(self, host: str, port: int, size: int = POOL_SIZE,
+                 timeout: float = REQUEST_TIMEOUT, fmt: str = None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.fmt = fmt
+        self._conns: List[Connection] = []
+        self._connecting = 0    # connects in progress, which hold a slot each
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+
+    def _checkout(self) -> Connection:
+        with self._lock:
+            while True:
+                self._conns = [c for c in self._conns if not c.closed]
+                idle = [c for c in self._conns if c.in_flight == 0]
+                if len(self._conns) + self._connecting < self.size and not idle:
+                    self._connecting += 1
+                    break
+                if self._conns:
+                    return min(self._conns, key=lambda c: c.in_flight)
+                # Every slot is a connect in progress; wait for one to finish
+                self._slot_freed.wait()
+        conn = None
+        try:
+            conn = Connection(self.host, self.port, self.fmt)
+            return conn
+        finally:
+            with self._lock:
+                self._connecting -= 1
+                if conn is not None:
+                    self._conns.append(conn)
+                self._slot_freed.notify_all()
+
+    def submit(self, payload: Dict) -> Future:
+        """Send a request on a pooled connection; returns a future reply."""
+        return self._checkout().send(payload)
+
+    def request(self, payload: Dict, timeout: float = None) -> Dict:
+        """Send a request and wait for its reply."""
+        future = self.submit(payload)
+        try:
+            return future.result(timeout or self.timeout)
+        finally:
+            abandon(future)
+
+    def health_check(self) -> bool:
+        """Ping idle or stuck connections, dropping dead ones; True if any survive."""
+        with self._lock:
+            conns = list(self._conns)
+        alive = False
+        now = time.monotonic()
+        for conn in conns:
+            if conn.closed:
+                continue
+            oldest = conn.oldest_sent
+            if oldest is not None and now - oldest < self.timeout:
+                # Busy, with replies still arriving in time
+                alive = True
+                continue
+            try:
+                conn.send({'command': 'ping'}).result(CONNECT_TIMEOUT)
+                alive = True
+            except Exception as e:
+                logging.warning(f"[pool] {self.host}:{self.port} failed health check: {e}")
+                conn.close()
+        return alive
+
+    def close(self):
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+
+_pools: Dict[Tuple[str, int], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+_health_thread = None
+
+def get_pool(port: int, host: str = 'localhost', **kwargs) -> ConnectionPool:
+    """Process-wide pool for (host, port); starts the health checker once."""
+    global _health_thread
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            pool = _pools[(host, port)] = ConnectionPool(host, port, **kwargs)
+        if _health_thread is None:
+            _health_thread = threading.Thread(target=_health_loop, daemon=True)
+            _health_thread.start()
+    return pool
+
+def _health_loop():
+    stop = threading.Event()
+    while not stop.wait(HEALTH_INTERVAL):
+        with _pools_lock:
+            pools = list(_pools.values())
+        for pool in pools:
+            pool.health_check()
+
+# --- Server side ---
+def serve_connection(sock: socket.socket, handler: Callable[[Dict], Dict],
+                     executor: Executor = None, metrics: Metrics = None):
+    """Answer requests on a persistent connection until the peer closes it.
+
+    Each reply carries the request's `request_id` and uses its wire format.
+    'ping' is answered directly. A request with `timeout_ms` that is still
+    queued when that budget runs out is answered with an error unrun.
+    With an `executor`, requests run concurrently and may be answered out of order; otherwise in order.
+    With `metrics`, time queued for the executor, in the handler and
+    sending the reply are recorded as the 'queue', 'handle' and 'send' stages.
+    Works unchanged for one-shot clients that close after one reply.
+    """
+    # Binary replies go out in several writes; without this, Nagle plus
+    # the peer's delayed ACK holds each reply back ~40 ms
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    send_lock = threading.Lock()
+    state = {'in_flight': 0, 'reading': True}
+
+    def finish():
+        """Close once the peer is gone and no reply is outstanding."""
+        with send_lock:
+            if not state['reading'] and state['in_flight'] == 0:
+                sock.close()
+
+    def reply(req: Dict, fmt: str):
+        request_id = req.pop('request_id', None)
+        expires_at = req.pop('_expires_at', None)
+        received_at = req.pop('_received_at', None)
+        started = time.perf_counter()
+        try:
+            if expires_at is not None and time.monotonic() >= expires_at:
+                # Queued past the caller's deadline; it has stopped waiting
+                resp = {'status': 'error', 'message': 'Deadline exceeded', 'expired': True}
+            elif req.get('command') == 'ping':
+                resp = {'status': 'success', 'pong': True}
+            else:
+                resp = handler(req)
+        except Exception as e:
+            logging.error(f"Request handler error: {e}")
+            resp = {'status': 'error', 'message': str(e)}
+        if request_id is not None:
+            resp = dict(resp, request_id=request_id)
+        handled = time.perf_counter()
+        try:
+            with send_lock:
+                send_message(sock, resp, fmt)
+        except OSError as e:
+            logging.warning(f"Could not send reply: {e}")
+        if metrics is not None and received_at is not None:
+            metrics.incr('requests')
+            if resp.get('status') == 'error':
+                metrics.incr('expired' if resp.get('expired') else 'errors')
+            metrics.observe('queue', 1000 * (started - received_at))
+            metrics.observe('handle', 1000 * (handled - started))
+            metrics.observe('send', 1000 * (time.perf_counter() - handled))
+
+    def run(req: Dict, fmt: str):
+        try:
+            reply(req, fmt)
+        finally:
+            with send_lock:
+                state['in_flight'] -= 1
+            finish()
+
+    try:
+        while True:
+            try:
+                req, fmt = receive_message(sock)
+            except ConnectionClosed:
+                break
+            # Pings and version polls would swamp the request stages
+            if metrics is not None and req.get('command') not in ('ping', 'version'):
+                req['_received_at'] = time.perf_counter()
+            if 'timeout_ms' in req:
+                req['_expires_at'] = time.monotonic() + req.pop('timeout_ms') / 1000
+            if executor is not None and req.get('command') != 'ping':
+                with send_lock:
+                    state['in_flight'] += 1
+                executor.submit(run, req, fmt)
+            else:
+                reply(req, fmt)
+    except Exception as e:
+        logging.error(f"Connection error: {e}")
+    finally:
+        state['reading'] = False
+        finish()
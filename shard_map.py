@@ -0,0 +1,136 @@
+import os
+import json
+import bisect
+import hashlib
+import numpy as np
+
+from typing import List, Dict, Union
+
+from dedup import normalize_text
+
+# --- Constants ---
+DEFAULT_SHARD_MAP = [[5001], [5002]]  # shard_id N is served by the ports in entry N-1
+SHARD_MAP_ENV = "SHARD_MAP"           # path of the shard map when none is given
+ADMIN_PORT_OFFSET = 1000              # a worker's admin port is its query port + this
+VNODES = 64                           # ring points per unit of shard weight
+
+def admin_port(port: int) -> int:
+    return port + ADMIN_PORT_OFFSET
+
+def key_hash(key: str) -> int:
+    """Stable 64-bit hash of a placement key (same in every process)."""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def normalize(shards: List[Union[int, List[int]]]) -> List[List[int]]:
+    """One list of replica ports per shard (a bare port is a single replica)."""
+    shards = [[s] if isinstance(s, int) else [int(p) for p in s] for s in shards]
+    if not shards or not all(shards):
+        raise ValueError("Every shard needs at least one replica port")
+    ports = [port for replicas in shards for port in replicas]
+    if len(ports) != len(set(ports)):
+        raise ValueError("A port may serve only one shard")
+    return shards
+
+# --- Consistent hashing ---
+class HashRing:
+    """Consistent-hash ring of shards, each owning `vnodes * weight` points.
+
+    A key belongs to the shard owning the first point at or after the
+    key's hash. Adding or removing a shard only moves the keys between
+    its points and their predecessors; a weight of 0 drains a shard.
+    """
+
+    def __init__(self, weights: Dict[int, int], vnodes: int = VNODES):
+        points = sorted(
+            (key_hash(f"shard-{shard_id}-{v}"), shard_id)
+            for shard_id, weight in weights.items()
+            for v in range(vnodes * weight)
+        )
+        if not points:
+            raise ValueError("Hash ring needs at least one shard with weight > 0")
+        self._hashes = [h for h, _ in points]
+        self._owners = [shard_id for _, shard_id in points]
+        self._hash_array = np.array(self._hashes, dtype=np.uint64)
+        self._owner_array = np.array(self._owners, dtype=np.int64)
+
+    def owner(self, key: str) -> int:
+        i = bisect.bisect_left(self._hashes, key_hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+    def owners(self, keys: List[str]) -> np.ndarray:
+        """`owner` for many keys at once."""
+        hashes = np.array([key_hash(k) for k in keys], dtype=np.uint64)
+        idx = np.searchsorted(self._hash_array, hashes) % len(self._hashes)
+        return self._owner_array[idx]
+
+# --- Shard map ---
+class ShardMap:
+    """Replica ports and ring weight per shard ID, plus the ring they define.
+
+    Documents are placed by hashing their normalized text onto the ring,
+    so copies differing only in whitespace meet on one shard; doc IDs
+    still record the shard that first stored them, which after a
+    rebalance need not be where they live now.
+    """
+
+    def __init__(self, shards: Dict[int, List[int]], weights: Dict[int, int] = None,
+                 vnodes: int = VNODES):
+        ids = sorted(shards)
+        normalize([shards[i] for i in ids])
+        self.shards = {int(i): list(shards[i]) for i in ids}
+        self.weights = {i: int((weights or {}).get(i, 1)) for i in self.shards}
+        self.vnodes = vnodes
+        self.ring = HashRing(self.weights, vnodes)
+
+    @property
+    def ids(self) -> List[int]:
+        return list(self.shards)
+
+    @property
+    def ports(self) -> List[int]:
+        return [port for replicas in self.shards.values() for port in replicas]
+
+    def replicas(self, shard_id: int) -> List[int]:
+        return self.shards[shard_id]
+
+    def owner(self, text: str) -> int:
+        """Shard ID a document with this text belongs on."""
+        return self.ring.owner(normalize_text(text))
+
+    def owners(self, texts: List[str]) -> np.ndarray:
+        """`owner` for many texts at once."""
+        return self.ring.owners([normalize_text(text) for text in texts])
+
+    def to_dict(self) -> Dict:
+        return {'vnodes': self.vnodes, 'shards': [
+            {'shard_id': i, 'replicas': self.shards[i], 'weight': self.weights[i]}
+            for i in self.ids
+        ]}
+
+    @classmethod
+    def from_config(cls, config: Union[List, Dict]) -> "ShardMap":
+        """From a list (one port or port list per shard, IDs from 1) or `to_dict` form."""
+        if isinstance(config, list):
+            return cls(dict(enumerate(normalize(config), start=1)))
+        entries = config['shards']
+        return cls({int(s['shard_id']): s['replicas'] for s in entries},
+                   {int(s['shard_id']): s.get('weight', 1) for s in entries},
+                   config.get('vnodes', VNODES))
+
+def load_shard_map(path: str = None) -> ShardMap:
+    """Shard map shared by the master, the web app and workers.
+
+    Read from `path`, else the file named by $SHARD_MAP, else the default
+    (one worker per shard on 5001 and 5002). The file is JSON: either a
+    list with one port or list of ports per shard, or
+    {"shards": [{"shard_id": 1, "replicas": [5001, 5003], "weight": 1}, ...]}.
+    """
+    path = path or os.environ.get(SHARD_MAP_ENV)
+    if not path:
+        return ShardMap.from_config(DEFAULT_SHARD_MAP)
+    with open(path) as f:
+        return ShardMap.from_config(json.load(f))
+
+def peers_of(shard_map: ShardMap, shard_id: int, port: int) -> List[int]:
+    """Query ports of the other replicas of `shard_id` (none if it isn't mapped)."""
+    return [p for p in shard_map.shards.get(shard_id, []) if p != port]
@@ -0,0 +1,245 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+
+from typing import List, Dict, Iterator, NamedTuple, Tuple
+
+from index import EmbeddingMatrix, MappedArray, VectorIndex
+
+# --- Constants ---
+CURRENT_FILE = "CURRENT"   # names the live generation directory
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f32"
+TEXT_FILE = "docs.txt"
+OFFSETS_FILE = "docs.off"
+ATTRS_FILE = "attrs.jsonl"  # per-row metadata JSON (empty when none)
+ATTRS_OFFSETS_FILE = "attrs.off"
+IDS_FILE = "ids.i64"
+WAL_FILE = "wal.log"
+COPY_BLOCK = 65536         # rows copied per step during a checkpoint
+
+# --- Documents ---
+class DocumentStore:
+    """Append-only UTF-8 text file indexed by per-row end offsets.
+
+    Texts are read lazily with `os.pread`, so only the offsets (8 bytes per
+    row, memory-mapped) are resident. Appends start at the last committed
+    offset and overwrite whatever a crash may have left past it.
+    """
+
+    def __init__(self, text_path: str, offsets_path: str, size: int = 0):
+        self._file = open(text_path, 'a+b')
+        self._ends = MappedArray(offsets_path, (), np.int64, size)
+        self._end = int(self._ends[size - 1]) if size else 0
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def __getitem__(self, row: int) -> str:
+        start = int(self._ends[row - 1]) if row else 0
+        end = int(self._ends[row])
+        return os.pread(self._file.fileno(), end - start, start).decode('utf-8')
+
+    def extend(self, texts: List[str]):
+        encoded = [t.encode('utf-8') for t in texts]
+        if not encoded:
+            return
+        os.pwrite(self._file.fileno(), b''.join(encoded), self._end)
+        ends = self._end + np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        self._ends.append(ends)
+        self._end = int(ends[-1])
+
+    def flush(self):
+        os.fsync(self._file.fileno())
+        self._ends.flush()
+
+# --- Write-ahead log ---
+class WriteAheadLog:
+    """Append-only JSON-lines log of shard mutations since the last checkpoint.
+
+    A record is committed once its line (and the newline) is on disk; a
+    torn final line left by a crash is dropped on replay.
+    """
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._file = open(path, 'ab')
+
+    def append(self, record: Dict):
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def replay(self) -> Iterator[Dict]:
+        """Yield committed records in order, truncating any torn tail."""
+        good = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                yield record
+        if good < os.path.getsize(self.path):
+            logging.warning(f"Truncating torn WAL tail in {self.path}")
+            os.truncate(self.path, good)
+
+    def close(self):
+        self._file.close()
+
+# --- Shard ---
+class ShardFiles(NamedTuple):
+    """Open handles for one generation, plus state replayed from its WAL."""
+    floats: EmbeddingMatrix
+    documents: DocumentStore
+    attributes: DocumentStore   # encoded metadata per row
+    row_ids: MappedArray
+    removed: List[Tuple[int, List[int]]]  # (rows at the time, doc IDs) per remove since the checkpoint, in log order
+    next_seq: int
+    lsn: int               # last replicated operation applied
+
+class ShardStore:
+    """Persistent shard: memory-mapped vectors, offset-indexed texts, IDs, WAL.
+
+    Layout under `root`:
+        CURRENT               name of the live generation directory
+        gen-<n>/meta.json     dim, rows, next_seq and lsn at the checkpoint
+        gen-<n>/vectors.f32   raw float32 rows (memory-mapped)
+        gen-<n>/docs.txt      concatenated UTF-8 texts
+        gen-<n>/docs.off      int64 end offset per row
+        gen-<n>/attrs.jsonl   concatenated metadata JSON per row
+        gen-<n>/attrs.off     int64 end offset per row
+        gen-<n>/ids.i64       doc ID per row
+        gen-<n>/wal.log       adds and removes since the checkpoint
+
+    Data files are written first and the WAL record last, so a row exists
+    after a crash only if its 'add' record made it to disk. A checkpoint
+    (run on compaction) writes a new generation and switches CURRENT.
+    """
+
+    def __init__(self, root: str, dim: int, fsync: bool = True):
+        self.root = root
+        self.dim = dim
+        self.fsync = fsync
+        self.generation = None
+        self.files = None
+        self._wal = None
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.root, CURRENT_FILE))
+
+    def _gen_dir(self, generation: int) -> str:
+        return os.path.join(self.root, f"gen-{generation}")
+
+    def _open_generation(self, generation: int, rows: int):
+        gen_dir = self._gen_dir(generation)
+        floats = EmbeddingMatrix(self.dim, path=os.path.join(gen_dir, VECTORS_FILE), size=rows)
+        documents = DocumentStore(os.path.join(gen_dir, TEXT_FILE),
+                                  os.path.join(gen_dir, OFFSETS_FILE), rows)
+        # Generations written before metadata existed get zero offsets: no metadata
+        attributes = DocumentStore(os.path.join(gen_dir, ATTRS_FILE),
+                                   os.path.join(gen_dir, ATTRS_OFFSETS_FILE), rows)
+        row_ids = MappedArray(os.path.join(gen_dir, IDS_FILE), (), np.int64, rows)
+        return floats, documents, attributes, row_ids
+
+    def _write_generation(self, generation: int, rows: int, next_seq: int, lsn: int = 0):
+        """Write meta.json and an empty WAL, then point CURRENT at `generation`."""
+        gen_dir = self._gen_dir(generation)
+        with open(os.path.join(gen_dir, META_FILE), 'w') as f:
+            json.dump({'dim': self.dim, 'rows': rows, 'next_seq': next_seq, 'lsn': lsn}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        open(os.path.join(gen_dir, WAL_FILE), 'wb').close()
+        tmp = os.path.join(self.root, CURRENT_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            f.write(f"gen-{generation}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.root, CURRENT_FILE))
+
+    def open(self) -> ShardFiles:
+        """Open (or create) the shard and replay its WAL; never touches the model."""
+        if not self.exists():
+            os.makedirs(self._gen_dir(1), exist_ok=True)
+            self._write_generation(1, 0, 0)
+
+        with open(os.path.join(self.root, CURRENT_FILE)) as f:
+            self.generation = int(f.read().strip().split('-')[1])
+        gen_dir = self._gen_dir(self.generation)
+        with open(os.path.join(gen_dir, META_FILE)) as f:
+            meta = json.load(f)
+        if meta['dim'] != self.dim:
+            raise ValueError(f"Shard at {self.root} has dim {meta['dim']}, expected {self.dim}")
+
+        self._wal = WriteAheadLog(os.path.join(gen_dir, WAL_FILE), self.fsync)
+        rows, next_seq, removed = meta['rows'], meta['next_seq'], []
+        lsn = meta.get('lsn', 0)
+        for record in self._wal.replay():
+            if record['op'] == 'add':
+                rows, next_seq = record['rows'], record['next_seq']
+            elif record['op'] == 'remove':
+                # Only rows that existed then can be removed; a later add
+                # may bring the same doc ID back
+                removed.append((rows, record['doc_ids']))
+            lsn = record.get('lsn', lsn)
+
+        floats, documents, attributes, row_ids = self._open_generation(self.generation, rows)
+        logging.info(f"Opened shard {self.root} gen {self.generation}: "
+                     f"{rows} rows, {sum(len(ids) for _, ids in removed)} removals replayed")
+        self.files = ShardFiles(floats, documents, attributes, row_ids, removed, next_seq, lsn)
+        return self.files
+
+    def log_add(self, next_seq: int, lsn: int):
+        """Flush rows appended to the open files, then commit them in the WAL."""
+        if self.fsync:
+            for f in (self.files.floats, self.files.documents, self.files.attributes,
+                      self.files.row_ids):
+                f.flush()
+        self._wal.append({'op': 'add', 'rows': len(self.files.floats),
+                          'next_seq': next_seq, 'lsn': lsn})
+
+    def log_remove(self, doc_ids: List[int], lsn: int):
+        self._wal.append({'op': 'remove', 'doc_ids': list(doc_ids), 'lsn': lsn})
+
+    def log_lsn(self, lsn: int):
+        """Record a replication position reached without changing any rows."""
+        self._wal.append({'op': 'lsn', 'lsn': lsn})
+
+    def checkpoint(self, keep: np.ndarray, index: VectorIndex, documents: DocumentStore,
+                   attributes: DocumentStore, row_ids: MappedArray,
+                   next_seq: int, lsn: int) -> ShardFiles:
+        """Write rows `keep` into a new generation and make it current.
+
+        Vectors are copied from `index` in full precision, so nothing is
+        re-encoded. The old generation is deleted; readers that still hold
+        its maps or file handles keep working until they let go.
+        """
+        generation = self.generation + 1
+        os.makedirs(self._gen_dir(generation), exist_ok=True)
+        floats, new_docs, new_attrs, new_ids = self._open_generation(generation, 0)
+        for i in range(0, len(keep), COPY_BLOCK):
+            block = keep[i:i + COPY_BLOCK]
+            floats.append(index.vectors(block))
+            new_docs.extend([documents[int(row)] for row in block])
+            new_attrs.extend([attributes[int(row)] for row in block])
+            new_ids.append(row_ids[block])
+        floats.flush()
+        new_docs.flush()
+        new_attrs.flush()
+        new_ids.flush()
+        self._write_generation(generation, len(keep), next_seq, lsn)
+
+        old_dir = self._gen_dir(self.generation)
+        self._wal.close()
+        self._wal = WriteAheadLog(os.path.join(self._gen_dir(generation), WAL_FILE), self.fsync)
+        self.generation = generation
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.files = ShardFiles(floats, new_docs, new_attrs, new_ids, [], next_seq, lsn)
+        return self.files
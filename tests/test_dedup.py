@@ -0,0 +1,76 @@
+import os
+import sys
+import socket
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["EMBEDDING_MODEL"] = "stub"
+
+from worker import Worker
+from shard_map import ShardMap, ADMIN_PORT_OFFSET
+
+
+def free_port() -> int:
+    """A port whose admin port (offset above it) is free too."""
+    while True:
+        with socket.socket() as s:
+            s.bind(('localhost', 0))
+            port = s.getsockname()[1]
+        if port + ADMIN_PORT_OFFSET < 65536:
+            return port
+
+
+def live_texts(worker: Worker):
+    view = worker.view
+    return sorted(view.documents[row] for row in view.id_to_row.values())
+
+
+@pytest.mark.parametrize("storage", ["float32", "int8"])
+def test_remove_during_add_stores_text(storage):
+    """A document matched as a duplicate but removed while the add encodes is stored again."""
+    worker = Worker(free_port(), [], index_params={'storage': storage})
+    foo_id = worker.add_documents(["foo"])['doc_ids'][0]
+
+    encode = worker.encode
+    def encode_and_remove(texts):
+        worker.remove_documents([foo_id])
+        return encode(texts)
+    worker.encode = encode_and_remove
+
+    resp = worker.add_documents(["foo", "new"])
+    assert resp['status'] == 'success'
+    assert resp['doc_ids'][0] != foo_id
+    assert resp['duplicates'] == 0
+    assert live_texts(worker) == ["foo", "new"]
+    assert worker.find_documents(["foo"])['doc_ids'] == [resp['doc_ids'][0]]
+
+
+def test_duplicates_skipped():
+    worker = Worker(free_port(), [])
+    first = worker.add_documents(["foo", "bar"])['doc_ids']
+    resp = worker.add_documents(["foo  ", "baz", "baz"])
+    assert resp['doc_ids'][0] == first[0]
+    assert resp['doc_ids'][1] == resp['doc_ids'][2]
+    assert resp['duplicates'] == 2
+    assert live_texts(worker) == ["bar", "baz", "foo"]
+
+
+def test_earlier_copy_found_after_latest_removed():
+    """With two stored copies of a text, removing the newer one leaves the older one matched."""
+    worker = Worker(free_port(), [])
+    older = worker.add_documents(["foo"])['doc_ids'][0]
+    newer = worker.add_documents(["foo"], dedup=False)['doc_ids'][0]
+    worker.remove_documents([newer])
+    resp = worker.add_documents(["foo"])
+    assert resp['doc_ids'] == [older]
+    assert resp['duplicates'] == 1
+    assert live_texts(worker) == ["foo"]
+
+
+def test_whitespace_variants_placed_together():
+    shard_map = ShardMap({i: [5000 + i] for i in range(1, 9)})
+    texts = [f"document {i}" for i in range(50)]
+    variants = [f"  document\t {i}\n" for i in range(50)]
+    assert shard_map.owners(texts).tolist() == shard_map.owners(variants).tolist()
+    assert [shard_map.owner(t) for t in variants] == shard_map.owners(texts).tolist()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["EMBEDDING_MODEL"] = "stub"
+
+from worker import Worker
+from test_dedup import free_port, live_texts
+
+
+def test_readded_doc_id_survives_restart(tmp_path):
+    """A doc ID removed and later re-added under the same ID is still live after a restart."""
+    worker = Worker(free_port(), [], data_dir=str(tmp_path))
+    doc_id = worker.add_documents(["foo"], metadata=[{'tag': 'a'}])['doc_ids'][0]
+    worker.remove_documents([doc_id])
+    # A replica catching up, or a rebalance moving the document back
+    resp = worker.add_documents(["foo"], [doc_id], worker.lsn + 1, metadata=[{'tag': 'a'}])
+    assert resp['status'] == 'success'
+
+    reopened = Worker(free_port(), [], data_dir=str(tmp_path))
+    assert list(reopened.view.id_to_row) == [doc_id]
+    assert live_texts(reopened) == ["foo"]
+    assert reopened.view.filter_mask({'tag': 'a'}).sum() == 1
+    assert reopened.find_documents(["foo"])['doc_ids'] == [doc_id]
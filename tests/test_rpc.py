@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import socket
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rpc import ConnectionPool
+
+
+@pytest.fixture
+def hung_server():
+    """A server that accepts connections but never replies."""
+    server = socket.socket()
+    server.bind(('localhost', 0))
+    server.listen()
+    held = []
+    def accept():
+        while True:
+            try:
+                held.append(server.accept()[0])
+            except OSError:
+                return
+    threading.Thread(target=accept, daemon=True).start()
+    yield server.getsockname()[1]
+    server.close()
+    for conn in held:
+        conn.close()
+
+
+def test_timed_out_request_not_in_flight(hung_server):
+    pool = ConnectionPool('localhost', hung_server, timeout=0.2)
+    with pytest.raises(TimeoutError):
+        pool.request({'command': 'ping'})
+    assert [conn.in_flight for conn in pool._conns] == [0]
+    pool.close()
+
+
+def test_health_check_drops_stuck_connection(hung_server):
+    pool = ConnectionPool('localhost', hung_server, timeout=0.2)
+    pool.submit({'command': 'ping'})
+    time.sleep(0.3)
+    assert not pool.health_check()
+    assert all(conn.closed for conn in pool._conns)
+    pool.close()
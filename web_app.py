@@ -1,82 +1,231 @@
-from flask import Flask, render_template, request, jsonify
-import socket
+from flask import Flask, render_template, request, jsonify, g, Response, stream_with_context
+import os
 import json
-import logging
 import time
+import heapq
+import logging
+
+from rpc import get_pool
+from protocol import split_results
+from shard_map import ShardMap, load_shard_map, SHARD_MAP_ENV
+from doc_ids import shard_of
+from admin import send_admin_command, read_shard, write_shard, scatter
+from ingest import ingest, read_documents, make_encoder_pool
+from metadata import check_metadata, check_filter
+from metrics import Metrics
 
 # Configuration 
-BUFFER_SIZE    = 4096
-END_MARKER     = "<END>"
-WORKER_PORTS   = [5001, 5002]   
-MAX_RETRIES    = 10         # 10 retries for worker connection
-RETRY_DELAY    = 2          # 2 sec delay between retries
+SHARDS         = load_shard_map()  # replicas and ring weight per shard ($SHARD_MAP)
+DEFAULT_TOP_K  = 3          # results per page when the request names none
+MAX_RESULTS    = 1000       # offset + top_k cap (matches the master)
+SEARCH_MODES   = ('dense', 'lexical', 'hybrid')
+ADMIN_RETRIES  = 2          # connection attempts per replica, so a dead worker can't stall a fan-out
+LIST_PAGE      = 100        # default page size of GET /documents?limit=
+MAX_LIST_PAGE  = 1000
+STREAM_PAGE    = 1000       # documents per shard per step while streaming the whole list
 
 #  Logging setup 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
+metrics = Metrics()   # per-route latency and status counts, served at /metrics
+_map_mtime = None
+_ingest_pool = None   # encoder processes for bulk ingest, started on first use
 
-def receive_data(sock: socket.socket) -> str:
-    #  Receive data until END_MARKER -> <END>.
-    data = ""
-    while True:
-        chunk = sock.recv(BUFFER_SIZE).decode('utf-8')
-        if not chunk:
-            break
-        if END_MARKER in chunk:
-            data += chunk[:chunk.index(END_MARKER)]
-            break
-        data += chunk
-    return data
+def shards() -> ShardMap:
+    # Re-read $SHARD_MAP whenever the file changes, so a rebalance
+    # (rebalance.py) moves new writes to their new shards right away.
+    global SHARDS, _map_mtime
+    path = os.environ.get(SHARD_MAP_ENV)
+    if path:
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime != _map_mtime:
+                SHARDS, _map_mtime = load_shard_map(path), mtime
+        except (OSError, ValueError) as e:
+            logging.error(f"[shards] keeping current shard map, could not load {path}: {e}")
+    return SHARDS
 
-def send_data(sock: socket.socket, payload: dict):
 
-    data_str = json.dumps(payload) + END_MARKER
-    for i in range(0, len(data_str), BUFFER_SIZE):
-        chunk = data_str[i:i+BUFFER_SIZE]
-        sock.sendall(chunk.encode('utf-8'))
+def remove_by_shard(doc_ids: list) -> tuple:
+    # Doc IDs carry the shard that first stored them in their high bits.
+    # Try that shard first; IDs it doesn't have may have been moved by a
+    # rebalance, so those are then tried on every other shard.
+    shard_map = shards()
+    by_shard = {}
+    for doc_id in doc_ids:
+        shard_id = shard_of(doc_id)
+        by_shard.setdefault(shard_id if shard_id in shard_map.shards else None, []).append(doc_id)
 
-def send_admin_command(command: str, data: dict, worker_port: int) -> dict:
+    # Both rounds go to their shards in parallel.
+    responses = []
+    errors = []
+    elsewhere = list(by_shard.pop(None, []))
+    replies = scatter(lambda shard_id: write_shard(shard_map, 'remove', {'doc_ids': by_shard[shard_id]},
+                                                   shard_id, ADMIN_RETRIES), by_shard)
+    for shard_id, resp in replies.items():
+        responses.append(resp)
+        if resp.get('status') == 'success':
+            elsewhere.extend(resp.get('missing', []))
+        else:
+            errors.append(f"Shard {shard_id}: {resp.get('message')}")
 
-    admin_port = worker_port + 1000
-    last_err = None
+    missing = set(elsewhere)
+    if missing:
+        ids = sorted(missing)
+        replies = scatter(lambda shard_id: write_shard(shard_map, 'remove', {'doc_ids': ids},
+                                                       shard_id, ADMIN_RETRIES), shard_map.ids)
+        for shard_id, resp in replies.items():
+            if resp.get('status') == 'success':
+                if resp.get('removed'):
+                    responses.append(resp)
+                missing &= set(resp.get('missing', []))
+            else:
+                errors.append(f"Shard {shard_id}: {resp.get('message')}")
+    return responses, sorted(missing), errors
 
-    for attempt in range(1, MAX_RETRIES+1):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(1.0)
-            sock.connect(('localhost', admin_port))
-            logging.info(f"[admin] connected to worker {worker_port} admin port {admin_port}")
-            request = {'command': command, **data}
-            send_data(sock, request)
-            raw = receive_data(sock)
-            sock.close()
-            return json.loads(raw)
-        except (ConnectionRefusedError, socket.timeout) as e:
-            last_err = e
-            logging.warning(f"[admin] attempt {attempt}/{MAX_RETRIES} failed to connect to port {admin_port}: {e}")
-            time.sleep(RETRY_DELAY)
-        except Exception as e:
-            logging.error(f"[admin] unexpected error talking to worker {worker_port}: {e}")
-            return {'status': 'error', 'message': str(e)}
-
-    msg = f"Could not connect to worker {worker_port} admin port {admin_port} after {MAX_RETRIES} attempts: {last_err}"
-    logging.error(msg)
-    return {'status': 'error', 'message': msg}
-
-
-def query_master(query: str, master_port: int = 5000) -> list:
+
+def list_page(shard_map: ShardMap, after: int, limit: int, shard_ids: list) -> tuple:
+    # Up to `limit` documents after doc_id `after`, merged across shards
+    # (asked in parallel) in doc_id order. Returns (documents, cursor for
+    # the next page or None at the end, {shard_id: error}).
+    replies = scatter(lambda shard_id: read_shard(shard_map, 'list', {'after': after, 'limit': limit},
+                                                  shard_id, ADMIN_RETRIES), shard_ids)
+    lists, errors, more = [], {}, False
+    for shard_id, resp in replies.items():
+        if resp.get('status') == 'success':
+            lists.append(resp['documents'])
+            more = more or not resp.get('done', True)
+        else:
+            errors[shard_id] = resp.get('message')
+
+    docs = []
+    for doc in heapq.merge(*lists, key=lambda d: d['id']):
+        # A document being migrated can briefly be on two shards
+        if docs and docs[-1]['id'] == doc['id']:
+            continue
+        docs.append(doc)
+    more = more or len(docs) > limit
+    docs = docs[:limit]
+    return docs, (docs[-1]['id'] if more and docs else None), errors
+
+
+def shard_errors(errors: dict) -> list:
+    return [f"Shard {shard_id}: {message}" for shard_id, message in sorted(errors.items())]
+
+
+def query_master(query: str, master_port: int = 5000, top_k: int = 3, offset: int = 0) -> list:
+    return search_master(query, master_port, top_k, offset).get('results', [])
+
+
+def search_master(query: str, master_port: int = 5000, top_k: int = 3, offset: int = 0,
+                  deadline_ms: float = None, mode: str = 'dense', prefilter: bool = False,
+                  filter_expr: dict = None) -> dict:
+    # Full master reply, including 'partial' / 'missing_shards' when shards timed out
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(('localhost', master_port))
-        send_data(sock, {'query': query})
-        raw = receive_data(sock)
-        sock.close()
-        return json.loads(raw)['results']
+        request = {'query': query, 'top_k': top_k, 'offset': offset}
+        if deadline_ms is not None:
+            request['deadline_ms'] = deadline_ms
+        if filter_expr is not None:
+            request['filter'] = filter_expr
+        if mode != 'dense':
+            request.update(mode=mode, prefilter=prefilter)
+        with metrics.timer('master'):
+            return get_pool(master_port).request(request)
     except Exception as e:
         logging.error(f"[master] query error: {e}")
-        return []
+        return {'results': []}
+
+
+def query_master_batch(queries: list, master_port: int = 5000, top_k: int = 3,
+                       offset: int = 0, deadline_ms: float = None,
+                       filter_expr: dict = None) -> dict:
+    try:
+        request = {'queries': queries, 'top_k': top_k, 'offset': offset}
+        if deadline_ms is not None:
+            request['deadline_ms'] = deadline_ms
+        if filter_expr is not None:
+            request['filter'] = filter_expr
+        with metrics.timer('master_batch'):
+            resp = get_pool(master_port).request(request)
+        if resp.get('status') == 'error':
+            return resp
+        return {'status': 'success', 'results': split_results(resp),
+                'partial': resp.get('partial', False),
+                'missing_shards': resp.get('missing_shards', [])}
+    except Exception as e:
+        logging.error(f"[master] batch query error: {e}")
+        return {'status': 'error', 'message': str(e)}
+
+
+def paging_args(body: dict) -> tuple:
+    # top_k / offset from a request body; raises ValueError when invalid.
+    top_k  = body.get('top_k', DEFAULT_TOP_K)
+    offset = body.get('offset', 0)
+    if not isinstance(top_k, int) or not isinstance(offset, int):
+        raise ValueError('top_k and offset must be integers')
+    if top_k < 1 or offset < 0 or offset + top_k > MAX_RESULTS:
+        raise ValueError(f'Need top_k >= 1, offset >= 0 and offset + top_k <= {MAX_RESULTS}')
+    return top_k, offset
+
+
+def deadline_arg(body: dict):
+    # Optional end-to-end deadline; raises ValueError when invalid.
+    deadline_ms = body.get('deadline_ms')
+    if deadline_ms is not None and (not isinstance(deadline_ms, (int, float)) or deadline_ms <= 0):
+        raise ValueError('deadline_ms must be a positive number')
+    return deadline_ms
+
+
+def filter_arg(body: dict):
+    # Optional metadata filter expression; raises ValueError when invalid.
+    filter_expr = body.get('filter')
+    if filter_expr is not None:
+        check_filter(filter_expr)
+    return filter_expr
+
+
+def document_args(docs) -> list:
+    # (text, metadata) pairs from strings or {"text", "metadata"} objects;
+    # blank texts are skipped, bad metadata raises ValueError.
+    if not isinstance(docs, list):
+        raise ValueError('documents must be a list')
+    pairs = []
+    for doc in docs:
+        if isinstance(doc, dict):
+            text, metadata = doc.get('text'), check_metadata(doc.get('metadata'))
+        else:
+            text, metadata = doc, {}
+        if not isinstance(text, str):
+            raise ValueError('Every document needs a text string')
+        if text.strip():
+            pairs.append((text.strip(), metadata))
+    return pairs
+
+
+def mode_args(body: dict) -> tuple:
+    # Search mode and hybrid prefiltering; raises ValueError when invalid.
+    mode = body.get('mode', 'dense')
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"mode must be one of {', '.join(SEARCH_MODES)}")
+    return mode, bool(body.get('prefilter', False))
+
+
+# Request timing
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    started = g.pop('started', None)
+    if started is not None and request.url_rule is not None:
+        metrics.observe(f"{request.method} {request.url_rule.rule}",
+                        1000 * (time.perf_counter() - started))
+    metrics.incr(f"http_{response.status_code}")
+    return response
 
 
 # Flask route
@@ -91,42 +240,116 @@ def search():
     if not query:
         return jsonify({'error': 'Query is required'}), 400
 
-    results = query_master(query)
-    return jsonify({'results': results})
+    try:
+        top_k, offset = paging_args(request.json)
+        deadline_ms = deadline_arg(request.json)
+        mode, prefilter = mode_args(request.json)
+        filter_expr = filter_arg(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    resp = search_master(query, top_k=top_k, offset=offset, deadline_ms=deadline_ms,
+                         mode=mode, prefilter=prefilter, filter_expr=filter_expr)
+    return jsonify({'results': resp.get('results', []), 'top_k': top_k, 'offset': offset,
+                    'mode': mode,
+                    'partial': resp.get('partial', False),
+                    'missing_shards': resp.get('missing_shards', [])})
+
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    queries = request.json.get('queries', [])
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return jsonify({'error': 'queries must be a list of strings'}), 400
+    queries = [q.strip() for q in queries]
+    if not queries or not all(queries):
+        return jsonify({'error': 'Queries are required'}), 400
+
+    try:
+        top_k, offset = paging_args(request.json)
+        deadline_ms = deadline_arg(request.json)
+        filter_expr = filter_arg(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    resp = query_master_batch(queries, top_k=top_k, offset=offset, deadline_ms=deadline_ms,
+                              filter_expr=filter_expr)
+    if resp.get('status') == 'error':
+        return jsonify({'error': resp.get('message')}), 502
+    return jsonify({'results': resp['results'], 'partial': resp['partial'],
+                    'missing_shards': resp['missing_shards']})
 
 
 @app.route('/documents', methods=['GET'])
 def list_documents():
-    all_docs = []
-    errors   = []
-
-    for port in WORKER_PORTS:
-        resp = send_admin_command('list', {}, port)
-        if resp.get('status') == 'success':
-            all_docs.extend(resp['documents'])
-        else:
-            errors.append(f"Worker {port}: {resp.get('message')}")
+    # ?limit=N (and &cursor=C from the previous page's next_cursor) returns
+    # one page in doc_id order. Without a limit the whole corpus is
+    # streamed, fetched from every shard in parallel a page at a time, so
+    # no process holds it all.
+    try:
+        limit = request.args.get('limit')
+        limit = None if limit is None else int(limit)
+        cursor = int(request.args.get('cursor', -1))
+    except ValueError:
+        return jsonify({'error': 'limit and cursor must be integers'}), 400
+    if limit is not None and not 1 <= limit <= MAX_LIST_PAGE:
+        return jsonify({'error': f'limit must be between 1 and {MAX_LIST_PAGE}'}), 400
 
-    if errors and not all_docs:
+    shard_map = shards()
+    docs, next_cursor, errors = list_page(shard_map, cursor, limit or STREAM_PAGE, shard_map.ids)
+    if len(errors) == len(shard_map.ids):
         return jsonify({
             'status': 'error',
             'message': 'Could not list any documents',
-            'errors': errors
+            'errors': shard_errors(errors)
         }), 500
 
-    return jsonify({
-        'status':    'success',
-        'documents': all_docs,
-        'errors':    errors or None
-    })
+    if limit is not None:
+        return jsonify({
+            'status':      'success',
+            'documents':   docs,
+            'next_cursor': next_cursor,
+            'errors':      shard_errors(errors) or None
+        })
+
+    def generate(docs, next_cursor):
+        yield '{"status": "success", "documents": ['
+        first = True
+        while True:
+            for doc in docs:
+                yield ('' if first else ', ') + json.dumps(doc)
+                first = False
+            if next_cursor is None:
+                break
+            # Shards that failed stay out; they're reported at the end
+            live = [shard_id for shard_id in shard_map.ids if shard_id not in errors]
+            docs, next_cursor, failed = list_page(shard_map, next_cursor, STREAM_PAGE, live)
+            errors.update(failed)
+        yield f'], "errors": {json.dumps(shard_errors(errors) or None)}}}'
+
+    return Response(stream_with_context(generate(docs, next_cursor)),
+                    mimetype='application/json')
 
 
 @app.route('/documents', methods=['POST'])
 def add_documents():
-    docs = request.json.get('documents', [])
-    docs = [d.strip() for d in docs if d.strip()]
+    # Each document is a string, or {"text": ..., "metadata": {...}}
+    try:
+        docs = document_args(request.json.get('documents', []))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     if not docs:
         return jsonify({'error': 'No valid documents provided'}), 400
+    # Shards skip exact duplicates ("dedup": false stores them anyway) and,
+    # given "near_duplicate": <similarity>, flag documents that close to one
+    options = {}
+    if request.json.get('dedup') is False:
+        options['dedup'] = False
+    if request.json.get('near_duplicate') is not None:
+        try:
+            options['near_duplicate'] = float(request.json['near_duplicate'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'near_duplicate must be a number'}), 400
     
     
 # Even partitioning of documents across workers
@@ -149,41 +372,90 @@ def add_documents():
     # status = 'success' if not errors else 'partial_success'
     # return jsonify({'status': status, 'responses': responses, 'errors': errors or None})
 
-    # Round-robin assignment of documents across workers
-    n_workers = len(WORKER_PORTS)
-    worker_docs = [[] for _ in range(n_workers)]
-    for i, doc in enumerate(docs):
-        worker_index = i % n_workers
-        worker_docs[worker_index].append(doc)
+    # Consistent-hash placement: a document's text picks its shard, so
+    # balance doesn't depend on batch sizes and shards can be added later
+    shard_map = shards()
+    shard_docs = {}
+    for text, metadata in docs:
+        shard_docs.setdefault(shard_map.owner(text), []).append((text, metadata))
     
+    def add(shard_id):
+        chunk = shard_docs[shard_id]
+        data = dict(options, documents=[text for text, _ in chunk])
+        if any(metadata for _, metadata in chunk):
+            data['metadata'] = [metadata for _, metadata in chunk]
+        return write_shard(shard_map, 'add', data, shard_id, ADMIN_RETRIES)
+
+    # Every shard's write goes out at once
     responses = []
     errors = []
-    for i, port in enumerate(WORKER_PORTS):
-        chunk = worker_docs[i]
-        if chunk:  
-            resp = send_admin_command('add', {'documents': chunk}, port)
-            responses.append(resp)
-            if resp.get('status') != 'success':
-                errors.append(f"Worker {port}: {resp.get('message')}")
+    for shard_id, resp in sorted(scatter(add, shard_docs).items()):
+        responses.append(resp)
+        if resp.get('status') != 'success':
+            errors.append(f"Shard {shard_id}: {resp.get('message')}")
 
     status = 'success' if not errors else 'partial_success'
-    return jsonify({'status': status, 'responses': responses, 'errors': errors or None})
+    return jsonify({'status': status, 'responses': responses, 'errors': errors or None,
+                    'duplicates': sum(r.get('duplicates', 0) for r in responses),
+                    'encodes_avoided': sum(r.get('encodes_avoided', 0) for r in responses)})
+
+
+@app.route('/documents/bulk', methods=['POST'])
+def bulk_add_documents():
+    # Body is read as a stream (chunked uploads work), one document per
+    # line, or JSONL with Content-Type application/x-ndjson. Documents are
+    # encoded here on a process pool and sent to shards in chunks.
+    global _ingest_pool
+    if _ingest_pool is None:
+        _ingest_pool = make_encoder_pool()
+    fmt = 'jsonl' if request.mimetype in ('application/x-ndjson', 'application/jsonl') else 'text'
+    report = ingest(read_documents(request.stream, fmt), shards(), _ingest_pool,
+                    dedup=request.args.get('dedup') != 'false',
+                    near_duplicate=request.args.get('near_duplicate', type=float))
+    if not report['stored'] and report['errors']:
+        return jsonify(dict(report, status='error')), 400
+    status = 'success' if not report['errors'] else 'partial_success'
+    return jsonify(dict(report, status=status))
 
 
 @app.route('/documents/<int:doc_id>', methods=['DELETE'])
 def remove_document(doc_id):
-    errors = []
-    for port in WORKER_PORTS:
-        resp = send_admin_command('remove', {'doc_ids': [doc_id]}, port)
-        if resp.get('status') == 'success':
-            return jsonify(resp)
-        errors.append(f"Worker {port}: {resp.get('message')}")
+    responses, missing, errors = remove_by_shard([doc_id])
+    if errors:
+        return jsonify({
+            'status':  'error',
+            'message': f"Could not remove doc {doc_id}",
+            'errors':  errors
+        }), 500
+    if missing:
+        return jsonify({
+            'status':  'error',
+            'message': f"Document {doc_id} not found"
+        }), 404
+    return jsonify(next((r for r in responses if r.get('removed')), responses[0]))
+
+
+@app.route('/documents', methods=['DELETE'])
+def remove_documents():
+    doc_ids = request.json.get('doc_ids', [])
+    if not isinstance(doc_ids, list) or not all(isinstance(i, int) for i in doc_ids):
+        return jsonify({'error': 'doc_ids must be a list of integers'}), 400
 
+    responses, missing, errors = remove_by_shard(doc_ids)
+    removed = sum(r.get('removed', 0) for r in responses if r.get('status') == 'success')
+    status = 'success' if not errors else 'partial_success'
     return jsonify({
-        'status':  'error',
-        'message': f"Could not remove doc {doc_id}",
-        'errors':  errors
-    }), 404
+        'status':  status,
+        'removed': removed,
+        'missing': missing or None,
+        'errors':  errors or None
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # This process only; the master and workers answer a 'metrics' command
+    return jsonify({'status': 'success', 'metrics': metrics.snapshot()})
 
 
 if __name__ == '__main__':
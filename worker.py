@@ -1,143 +1,801 @@
+import os
+import time
 import socket
-import json
 import numpy as np
 import threading
 import logging
 import argparse
 
-from typing import List, Tuple, Dict
-from sentence_transformers import SentenceTransformer
+from collections import deque
+from typing import List, Dict, NamedTuple, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from models import load_model, embedding_dim, SERVICE_ENV
+from index import VectorIndex, GrowableArray, make_index, recall_report, storage_report
+from lexical import LexicalIndex
+from dedup import ContentIndex, content_hash, first_occurrences
+from metadata import (MetadataIndex, check_metadata, check_filter,
+                      encode_metadata, decode_metadata)
+from shard_store import ShardStore
+from rpc import serve_connection, get_pool
+from metrics import Metrics, SlowQueryProfiler
+from protocol import flatten_results
+from shard_map import ShardMap, load_shard_map, peers_of, admin_port
+from doc_ids import make_doc_id, shard_of, seq_of
 
 # --- Constants ---
-BUFFER_SIZE = 4096
-END_MARKER = "<END>"
-
-# --- Utility functions ---
-def receive_data(sock: socket.socket) -> str:
-    """Receive data in chunks until the end marker is found."""
-    data = ""
-    while True:
-        chunk = sock.recv(BUFFER_SIZE).decode('utf-8')
-        if not chunk:
-            break
-        if END_MARKER in chunk:
-            data += chunk[:chunk.index(END_MARKER)]
-            break
-        data += chunk
-    return data
-
-def send_data(sock: socket.socket, payload: Dict) -> None:
-    """Send JSON-serializable payload with end marker, in chunks."""
-    data_str = json.dumps(payload) + END_MARKER
-    for i in range(0, len(data_str), BUFFER_SIZE):
-        chunk = data_str[i:i + BUFFER_SIZE]
-        sock.sendall(chunk.encode('utf-8'))
+COMPACT_THRESHOLD = 0.25  # tombstoned fraction that triggers compaction
+RECALL_QUERIES = 100      # sampled queries for the 'recall' admin command
+STORAGE_SAMPLE = 20000    # vectors sampled for the 'storage' admin command
+DEFAULT_TOP_K = 3         # results per query when the request names none
+MAX_TOP_K = 1000          # most results a single query may ask a shard for
+QUERY_THREADS = os.cpu_count() or 4  # default threads scoring queries
+EXPORT_BATCH = 1000       # documents handed over per rebalance step
+EXPORT_SCAN = 10000       # rows hashed per block while looking for them
+OPLOG_SIZE = 10000        # replicated operations kept for lagging replicas
+OPLOG_DOCS = 50000        # ...and at most this many documents across them
+OPLOG_BATCH = 500         # operations sent per catch-up request
+SYNC_INTERVAL = 2.0       # seconds between catch-up checks against peers
+SYNC_TIMEOUT = 30.0       # seconds to wait for a peer's oplog reply
+SEARCH_MODES = ('dense', 'lexical', 'hybrid')
+PREFILTER_CANDIDATES = 1000  # lexical matches dense-scored when a hybrid query prefilters
+
+# --- Shard state ---
+class ShardView(NamedTuple):
+    """Indexes plus row-aligned texts and IDs; replaced as a unit on compaction."""
+    index: VectorIndex
+    documents: List[str]        # list, or a lazy DocumentStore on disk
+    row_ids: GrowableArray      # row -> stable doc ID (int64)
+    id_to_row: Dict[int, int]   # live doc ID -> row (writers only)
+    lexical: LexicalIndex       # BM25 postings over the same rows
+    attributes: List[str]       # encoded metadata per row (list, or lazy store on disk)
+    filters: MetadataIndex      # metadata field -> value -> rows
+    content: ContentIndex       # content hash -> latest row holding that text
+
+    @classmethod
+    def empty(cls, index: VectorIndex) -> "ShardView":
+        return cls(index, [], GrowableArray((), np.int64), {}, LexicalIndex(),
+                   [], MetadataIndex(), ContentIndex())
+
+    def delete_rows(self, rows: List[int]) -> int:
+        """Tombstone rows in every index (caller holds `doc_lock`); returns how many were live."""
+        removed = self.index.delete(rows)
+        self.lexical.delete(rows)
+        self.filters.delete(rows)
+        self.content.delete(rows)
+        return removed
+
+    def metadata(self, row: int) -> Dict:
+        return decode_metadata(self.attributes[row])
+
+    def filter_mask(self, filter_expr: Dict = None) -> np.ndarray:
+        """Rows matching a (checked) filter expression, or None for no filter."""
+        return None if filter_expr is None else self.filters.evaluate(filter_expr)
 
 # --- Worker class ---
 class Worker:
-    def __init__(self, port: int, documents: List[str]):
+    def __init__(self, port: int, documents: List[str], shard_id: int = 1,
+                 index_kind: str = 'flat', index_params: Dict = None,
+                 data_dir: str = None, query_threads: int = QUERY_THREADS,
+                 peers: List[int] = None, profile_slow_ms: float = None,
+                 profile_dir: str = None, embedding_service: str = None,
+                 solo_timeout: float = None):
         # Networking
         self.port = port
-        self.admin_port = port + 1000
+        self.admin_port = admin_port(port)
+        self.shard_id = shard_id
+        # Queries from every connection share this pool. Scoring is NumPy
+        # work that releases the GIL, so the threads run in parallel.
+        self.query_pool = ThreadPoolExecutor(max_workers=query_threads,
+                                             thread_name_prefix="query")
 
-        # Documents & model
-        self.documents = documents
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        # Instrumentation: stage timings and counters ('metrics' admin
+        # command), plus stack profiles of queries slower than profile_slow_ms
+        self.metrics = Metrics()
+        self.profiler = None
+        if profile_slow_ms is not None:
+            self.profiler = SlowQueryProfiler(profile_slow_ms,
+                                              profile_dir or f"profiles-{port}")
+
+        # Documents & model. Queries arrive already embedded, so the model
+        # (local, or the shared embedding service) is only loaded once
+        # documents need encoding; serving queries never imports torch.
+        self.embedding_service = embedding_service
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.dim = embedding_dim(service=embedding_service)
         self.doc_lock = threading.RLock()  # ← allow re-entrant locking
+        self.index_kind = index_kind
+        self.index_params = index_params or {}
+        self.view = ShardView.empty(self.new_index())
+        self._next_seq = 0
+        self._compacting = False
+        self._by_id = None   # (version, view, rows, ids) sorted by doc_id; see live_by_id
+        # Bumped after every add/remove becomes visible, so a cached result
+        # tagged with an older version is known to be stale. Starts at the
+        # startup time (us) so a restarted worker never reuses a version.
+        self.version = int(time.time() * 1e6)
+
+        # Replication: every add/remove gets the next log sequence number
+        # (LSN). Replicas of a shard apply the same operations in LSN order,
+        # and one that fell behind pulls what it missed from `peers`.
+        self.peers = peers or []
+        self.lsn = 0
+        self.oplog = deque()
+        self._oplog_docs = 0
+        self.sync_lock = threading.Lock()
+        self.caught_up = not self.peers   # until then, refuse to lead writes
+        self.solo_timeout = solo_timeout  # lead anyway after this long with no peer reachable
+
+        # Persistence (None keeps the shard in memory only)
+        self.store = None
+        if data_dir:
+            self.store = ShardStore(os.path.join(data_dir, f"shard-{shard_id}"), self.dim)
 
         # Logging
         logging.info(f"Worker initialized on port {self.port} (admin {self.admin_port})")
-        logging.info(f"Initial document count: {len(self.documents)}")
 
-        # Build initial embeddings
-        self.update_embeddings()
+        # Reopen a persisted shard, or build initial embeddings
+        if self.store is not None and self.store.exists():
+            self.open_store()
+        else:
+            if self.store is not None:
+                self.open_store()
+            if documents and self.uses_service:
+                # Sample documents are only a demo; don't wait on the service for them
+                logging.info(f"Embedding service configured; skipping {len(documents)} sample documents")
+            else:
+                logging.info(f"Initial document count: {len(documents)}")
+                self.add_documents(documents)
         # Start admin server thread
         self.start_admin_server()
+        if self.peers:
+            threading.Thread(target=self.sync_loop, daemon=True).start()
 
-    def update_embeddings(self):
-        """(Re)compute embeddings for all documents."""
-        with self.doc_lock:
-            logging.info(f"Recomputing embeddings for {len(self.documents)} documents")
-            self.doc_embeddings = self.model.encode(
-                self.documents, convert_to_tensor=True
-            )
-            logging.info("Embeddings rebuilt successfully")
-
-    def add_documents(self, new_docs: List[str]) -> Dict:
-        """Add new documents, rebuild embeddings, and return their IDs."""
+    @property
+    def index(self) -> VectorIndex:
+        return self.view.index
+
+    @property
+    def documents(self) -> List[str]:
+        return self.view.documents
+
+    def new_index(self) -> VectorIndex:
+        return make_index(self.index_kind, self.dim, **self.index_params)
+
+    def open_store(self):
+        """Map the persisted shard and replay its WAL without calling the model."""
+        files = self.store.open()
+        index = self.new_index()
+        index.adopt(files.floats)
+        # Adds and removes are replayed in log order: a remove only sees rows
+        # added before it, so a doc ID removed and later re-added (by catch-up,
+        # or a rebalance moving it back) stays live
+        ids = files.row_ids.view()
+        id_to_row, removed, indexed = {}, [], 0
+        for rows, doc_ids in files.removed + [(len(ids), [])]:
+            id_to_row.update(zip(ids[indexed:rows].tolist(), range(indexed, rows)))
+            indexed = max(indexed, rows)
+            removed.extend(id_to_row.pop(doc_id) for doc_id in doc_ids if doc_id in id_to_row)
+        # Postings, metadata and content hashes aren't persisted; they are
+        # rebuilt from the stored texts and metadata
+        lexical = LexicalIndex(len(files.row_ids))
+        lexical.add_all(files.documents, len(files.row_ids))
+        filters = MetadataIndex()
+        filters.add_all(files.attributes, len(files.row_ids))
+        content = ContentIndex()
+        content.add_all(files.documents, len(files.row_ids))
+        self.view = ShardView(index, files.documents, files.row_ids, id_to_row, lexical,
+                              files.attributes, filters, content)
+        self.view.delete_rows(removed)
+        self._next_seq = files.next_seq
+        self.lsn = files.lsn
+        logging.info(f"Restored {index.live_count} documents from {self.store.root}")
+
+    @property
+    def uses_service(self) -> bool:
+        return bool(self.embedding_service or os.environ.get(SERVICE_ENV))
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                self._model = load_model(service=self.embedding_service)
+                logging.info(f"Loaded embedding model ({type(self._model).__name__})")
+            return self._model
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embed `texts` as a float32 matrix (no lock held)."""
+        if not texts:
+            return np.empty((0, self.dim), dtype=np.float32)
+        embeddings = np.asarray(self.model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(f"Model returned {embeddings.shape[1]}-dim vectors; shard holds {self.dim}")
+        return embeddings
+
+    def add_documents(self, new_docs: List[str], doc_ids: List[int] = None,
+                      lsn: int = None, embeddings: np.ndarray = None,
+                      metadata: List[Dict] = None, dedup: bool = True,
+                      near_duplicate: float = None) -> Dict:
+        """Encode only the new documents, append them, and return their IDs.
+
+        A replica applying another replica's add passes that add's
+        `doc_ids` and `lsn`; otherwise IDs and the LSN are allocated here.
+        Documents migrated from another shard bring their `embeddings`.
+        `metadata` has one dict (or None) per document.
+
+        New documents are deduplicated by content unless `dedup` is off: a
+        text already live here, or repeated in the batch, isn't stored
+        again and gets the existing doc ID. A text stored before (and since
+        removed) reuses its embedding instead of being encoded. With a
+        `near_duplicate` threshold, documents whose closest live neighbour
+        scores at least that are stored but listed in `near_duplicates`.
+        """
         try:
-            # 1) Extend the document list under lock
-            with self.doc_lock:
-                start_idx = len(self.documents)
-                self.documents.extend(new_docs)
+            if metadata is not None:
+                if len(metadata) != len(new_docs):
+                    raise ValueError("metadata needs one entry per document")
+                metadata = [check_metadata(m) for m in metadata]
+            else:
+                metadata = [{} for _ in new_docs]
+            if lsn is not None and lsn > self.lsn + 1:
+                self.catch_up()
+            if lsn is not None and lsn <= self.lsn:
+                return self.already_applied(lsn, doc_ids=doc_ids)
 
-            # 2) Rebuild embeddings (RLock lets us re-enter safely)
-            self.update_embeddings()
+            # 1) Look up texts already stored, then encode the rest outside
+            #    the lock so queries and other admin calls proceed
+            dedup = dedup and doc_ids is None
+            shipped = embeddings is not None
+            source = first_occurrences(new_docs) if dedup else list(range(len(new_docs)))
+            view, version = self.view, self.version
+            stored = {}
+            if dedup or not shipped:
+                stored = self.stored_rows(view, new_docs, [i for i, j in enumerate(source) if i == j])
+            existing = {}   # position -> ID of a live document with the same text
+            if dedup:
+                existing = {i: int(view.row_ids[row]) for i, row in stored.items()
+                            if view.index.is_alive(row)}
+            pending = [i for i, j in enumerate(source) if i == j and i not in existing]
+            avoided = 0
+            if shipped:
+                given = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.dim)
+                embeddings = given[pending]
+            else:
+                reuse = {}
+                if view.index.has_float_vectors:
+                    reuse = {k: stored[i] for k, i in enumerate(pending)
+                             if i in stored and i not in existing}
+                encode = [k for k in range(len(pending)) if k not in reuse]
+                embeddings = np.empty((len(pending), self.dim), dtype=np.float32)
+                if reuse:
+                    embeddings[list(reuse)] = view.index.vectors(np.array(list(reuse.values())))
+                if encode:
+                    with self.metrics.timer('add.encode'):
+                        embeddings[encode] = self.encode([new_docs[pending[k]] for k in encode])
+                avoided = len(new_docs) - len(encode)
+            near = []
+            if near_duplicate is not None and doc_ids is None and pending:
+                for k, hits in enumerate(view.index.search_batch(embeddings, 1)):
+                    if hits and hits[0][1] >= float(near_duplicate):
+                        near.append((k, int(view.row_ids[hits[0][0]]), hits[0][1]))
 
-            return {
+            # 2) Append under the lock; texts and IDs go first so every row
+            #    a search can see is already resolvable
+            with self.doc_lock:
+                if lsn is not None and lsn <= self.lsn:
+                    # Applied by a concurrent catch-up while we were encoding
+                    return self.already_applied(lsn, doc_ids=doc_ids)
+                lsn = self.next_lsn(lsn)
+                view = self.view
+                if doc_ids is None:
+                    if dedup and self.version != version:
+                        # A concurrent remove may have deleted a document matched
+                        # above; its text is then stored after all
+                        dead = [i for i, doc_id in existing.items() if doc_id not in view.id_to_row]
+                        if dead:
+                            if shipped:
+                                vectors = given[dead]
+                            else:
+                                vectors, encoded = self.revived(view, new_docs, dead)
+                                avoided -= encoded
+                            embeddings = np.concatenate([embeddings, vectors])
+                            pending += dead
+                            for i in dead:
+                                del existing[i]
+                        # A concurrent add may have stored some of these texts meanwhile
+                        for i, row in self.stored_rows(view, new_docs, pending).items():
+                            if view.index.is_alive(row):
+                                existing[i] = int(view.row_ids[row])
+                    kept = [k for k, i in enumerate(pending) if i not in existing]
+                    added_ids = [
+                        make_doc_id(self.shard_id, seq)
+                        for seq in range(self._next_seq, self._next_seq + len(kept))
+                    ]
+                    self._next_seq += len(kept)
+                else:
+                    doc_ids = [int(doc_id) for doc_id in doc_ids]
+                    own = [seq_of(d) for d in doc_ids if shard_of(d) == self.shard_id]
+                    self._next_seq = max([self._next_seq] + [seq + 1 for seq in own])
+                    # Replayed IDs already present are skipped, so applying an
+                    # operation twice is harmless; so are IDs the leader gave
+                    # to repeats of a text earlier in the batch
+                    kept, seen = [], set()
+                    for k, i in enumerate(pending):
+                        if doc_ids[i] not in view.id_to_row and doc_ids[i] not in seen:
+                            seen.add(doc_ids[i])
+                            kept.append(k)
+                    added_ids = [doc_ids[pending[k]] for k in kept]
+                if len(kept) < len(pending):
+                    embeddings = embeddings[kept]
+                added = [pending[k] for k in kept]
+                docs = [new_docs[i] for i in added]
+                metadata = [metadata[i] for i in added]
+                view.documents.extend(docs)
+                view.attributes.extend([encode_metadata(m) for m in metadata])
+                view.row_ids.append(np.array(added_ids, dtype=np.int64))
+                rows = view.index.add(embeddings)
+                view.lexical.add(docs)
+                view.filters.add(metadata)
+                view.content.add(docs)
+                view.id_to_row.update(zip(added_ids, rows.tolist()))
+                if self.store is not None:
+                    self.store.log_add(self._next_seq, lsn)
+                op = {'op': 'add', 'lsn': lsn, 'documents': docs, 'doc_ids': added_ids}
+                if any(metadata):
+                    op['metadata'] = metadata
+                if shipped:
+                    op['embeddings'] = embeddings
+                self.log_op(op)
+                self.version += 1
+
+            duplicates = len(new_docs) - len(added) if dedup else 0
+            if doc_ids is None:
+                ids = {**existing, **dict(zip(added, added_ids))}
+                doc_ids = [ids[i] for i in source]
+            self.metrics.incr('documents_added', len(docs))
+            self.metrics.incr('duplicates_skipped', duplicates)
+            self.metrics.incr('encodes_avoided', avoided)
+            resp = {
                 'status': 'success',
-                'message': f'Added {len(new_docs)} documents',
-                'doc_ids': list(range(start_idx, len(self.documents)))
+                'message': f'Added {len(docs)} documents'
+                           + (f' ({duplicates} duplicates skipped)' if duplicates else ''),
+                'doc_ids': doc_ids,
+                'duplicates': duplicates,
+                'encodes_avoided': avoided,
+                'lsn': lsn
             }
+            if near_duplicate is not None:
+                new_id = dict(zip(kept, added_ids))
+                resp['near_duplicates'] = [
+                    {'doc_id': new_id[k], 'similar_to': doc_id, 'score': score}
+                    for k, doc_id, score in near if k in new_id
+                ]
+            return resp
         except Exception as e:
             logging.error(f"Error in add_documents: {e}")
             return {'status': 'error', 'message': str(e)}
 
-    def remove_documents(self, doc_ids: List[int]) -> Dict:
-        """Remove documents by ID, rebuild embeddings, and report."""
+    def revived(self, view: ShardView, texts: List[str], positions: List[int]) -> Tuple[np.ndarray, int]:
+        """Embeddings for the `texts` at `positions`, whose documents were just
+        removed, and how many of them had to be encoded.
+
+        Removed rows keep their vectors until compaction, so those are used
+        when kept exactly; the rest are encoded here. This only happens when
+        a remove races an add, so the caller's lock is held for it.
+        """
+        rows = self.stored_rows(view, texts, positions)
+        out = np.empty((len(positions), self.dim), dtype=np.float32)
+        if view.index.has_float_vectors:
+            reuse = [k for k, i in enumerate(positions) if i in rows]
+        else:
+            reuse = []
+        if reuse:
+            out[reuse] = view.index.vectors(np.array([rows[positions[k]] for k in reuse]))
+        reused = set(reuse)
+        encode = [k for k in range(len(positions)) if k not in reused]
+        if encode:
+            with self.metrics.timer('add.encode'):
+                out[encode] = self.encode([texts[positions[k]] for k in encode])
+        return out, len(encode)
+
+    @staticmethod
+    def stored_rows(view: ShardView, texts: List[str], positions: List[int]) -> Dict[int, int]:
+        """{position: row} for the `texts` at `positions` whose content `view`
+        already holds: a live row if there is one, else a removed one."""
+        found = {}
+        for i in positions:
+            for row in view.content.get(content_hash(texts[i])):
+                if ContentIndex.same_text(view.documents[row], texts[i]):
+                    found[i] = row
+                    break
+        return found
+
+    def find_documents(self, texts: List[str]) -> Dict:
+        """Per text, the ID of a live document with the same content, or None."""
+        view = self.view
+        stored = self.stored_rows(view, texts, range(len(texts)))
+        return {'status': 'success',
+                'doc_ids': [int(view.row_ids[stored[i]])
+                            if i in stored and view.index.is_alive(stored[i]) else None
+                            for i in range(len(texts))]}
+
+    def remove_documents(self, doc_ids: List[int], lsn: int = None) -> Dict:
+        """Tombstone a batch of documents by ID and schedule compaction."""
         try:
+            if lsn is not None and lsn > self.lsn + 1:
+                self.catch_up()
+            if lsn is not None and lsn <= self.lsn:
+                return self.already_applied(lsn, removed=0, missing=[])
+
             with self.doc_lock:
-                logging.info(f"Removing documents: {doc_ids}")
-                self.documents = [
-                    doc for idx, doc in enumerate(self.documents)
-                    if idx not in doc_ids
-                ]
+                if lsn is not None and lsn <= self.lsn:
+                    return self.already_applied(lsn, removed=0, missing=[])
+                lsn = self.next_lsn(lsn)
+                logging.info(f"Removing {len(doc_ids)} documents")
+                view = self.view
+                rows, missing = [], []
+                for doc_id in doc_ids:
+                    row = view.id_to_row.pop(doc_id, None)
+                    if row is None:
+                        missing.append(doc_id)
+                    else:
+                        rows.append(row)
+                removed = view.delete_rows(rows)
+                remaining = view.index.live_count
+                if self.store is not None:
+                    if rows:
+                        self.store.log_remove([int(view.row_ids[row]) for row in rows], lsn)
+                    else:
+                        self.store.log_lsn(lsn)
+                self.log_op({'op': 'remove', 'lsn': lsn, 'doc_ids': list(doc_ids)})
+                if removed:
+                    self.version += 1
+                self.maybe_compact()
 
-            self.update_embeddings()
+            self.metrics.incr('documents_removed', removed)
             return {
                 'status': 'success',
-                'message': f'Removed {len(doc_ids)} documents',
-                'remaining_docs': len(self.documents)
+                'message': f'Removed {removed} documents',
+                'removed': removed,
+                'missing': missing,
+                'remaining_docs': remaining,
+                'lsn': lsn
             }
         except Exception as e:
             logging.error(f"Error in remove_documents: {e}")
             return {'status': 'error', 'message': str(e)}
 
-    def list_documents(self) -> Dict:
-        """Return all documents (id + text)."""
+    # --- Replication ---
+    def next_lsn(self, lsn: int = None) -> int:
+        """LSN for the operation being applied (caller holds `doc_lock`)."""
+        if lsn is None:
+            return self.lsn + 1
+        if lsn != self.lsn + 1:
+            raise RuntimeError(f"Replica is at LSN {self.lsn}, cannot apply {lsn}")
+        return lsn
+
+    def log_op(self, op: Dict):
+        """Make `op` the latest applied operation (caller holds `doc_lock`)."""
+        self.lsn = op['lsn']
+        self.oplog.append(op)
+        # Bulk adds carry embeddings, so bound the log by documents too
+        self._oplog_docs += len(op['doc_ids'])
+        while len(self.oplog) > OPLOG_SIZE or (self._oplog_docs > OPLOG_DOCS
+                                                and len(self.oplog) > 1):
+            self._oplog_docs -= len(self.oplog.popleft()['doc_ids'])
+
+    def already_applied(self, lsn: int, **fields) -> Dict:
+        return dict(fields, status='success', message=f'Operation {lsn} already applied',
+                    lsn=self.lsn)
+
+    def oplog_since(self, since: int) -> Dict:
+        """Operations after LSN `since`, or a full snapshot if they have been trimmed."""
         with self.doc_lock:
-            docs = [
-                {'id': idx, 'text': doc}
-                for idx, doc in enumerate(self.documents)
-            ]
-        return {'status': 'success', 'documents': docs}
-
-    def handle_admin_request(self, client_socket: socket.socket):
-        """Receive an admin command (add/remove/list) and reply."""
-        try:
-            raw = receive_data(client_socket)
-            req = json.loads(raw)
-            cmd = req.get('command', '').lower()
-
-            if cmd == 'add':
-                resp = self.add_documents(req.get('documents', []))
-            elif cmd == 'remove':
-                resp = self.remove_documents(req.get('doc_ids', []))
-            elif cmd == 'list':
-                resp = self.list_documents()
-            else:
-                resp = {'status': 'error', 'message': f'Unknown command: {cmd}'}
+            lsn, oplog = self.lsn, list(self.oplog)
+            if since >= lsn:
+                return {'status': 'success', 'lsn': lsn, 'ops': []}
+            if oplog and oplog[0]['lsn'] <= since + 1:
+                ops = [op for op in oplog if op['lsn'] > since][:OPLOG_BATCH]
+                return {'status': 'success', 'lsn': lsn, 'ops': ops}
+            view = self.view
+            rows = view.index.live_rows()
+            snapshot = {'doc_ids': [int(view.row_ids[row]) for row in rows],
+                        'documents': [view.documents[row] for row in rows],
+                        'metadata': [view.metadata(row) for row in rows]}
+        return {'status': 'success', 'lsn': lsn, 'snapshot': snapshot}
 
-            send_data(client_socket, resp)
+    def catch_up(self) -> int:
+        """Pull missed operations from the most up-to-date peer.
 
-        except Exception as e:
-            logging.error(f"Admin handler error: {e}")
+        Returns the number of operations applied, or None if it couldn't
+        finish: no peer answered, or an operation failed to apply.
+        """
+        applied = 0
+        with self.sync_lock:
+            while True:
+                best = None
+                for peer in self.peers:
+                    try:
+                        resp = get_pool(admin_port(peer)).request(
+                            {'command': 'oplog', 'since': self.lsn}, SYNC_TIMEOUT)
+                    except Exception as e:
+                        logging.debug(f"Peer {peer} unavailable for catch-up: {e}")
+                        continue
+                    if resp.get('status') == 'success' and (best is None or resp['lsn'] > best['lsn']):
+                        best = resp
+                if best is None:
+                    return None
+                if best['lsn'] <= self.lsn:
+                    return applied
+                if 'snapshot' in best:
+                    self.resync(best['snapshot'], best['lsn'])
+                    return applied + 1
+                if not best['ops']:
+                    return applied
+                for op in best['ops']:
+                    if op['op'] == 'add':
+                        resp = self.add_documents(op['documents'], op['doc_ids'], op['lsn'],
+                                                  op.get('embeddings'), op.get('metadata'))
+                    else:
+                        resp = self.remove_documents(op['doc_ids'], op['lsn'])
+                    if resp.get('status') != 'success':
+                        logging.error(f"Catch-up stopped at LSN {op['lsn']}: {resp.get('message')}")
+                        return None
+                    applied += 1
+                logging.info(f"Caught up to LSN {self.lsn}")
+
+    def resync(self, snapshot: Dict, lsn: int):
+        """Make this shard match a peer's snapshot, then adopt its LSN.
+
+        Used when the peer no longer holds the operations we missed. Only
+        the difference is applied: extra documents are removed and missing
+        ones encoded and added under their original IDs.
+        """
+        wanted = dict(zip(snapshot['doc_ids'], snapshot['documents']))
+        metadata = dict(zip(snapshot['doc_ids'], snapshot.get('metadata') or []))
+        extra = [doc_id for doc_id in list(self.view.id_to_row) if doc_id not in wanted]
+        missing = [doc_id for doc_id in wanted if doc_id not in self.view.id_to_row]
+        logging.info(f"Resyncing from snapshot at LSN {lsn}: "
+                     f"-{len(extra)} +{len(missing)} documents")
+        if extra:
+            self.remove_documents(extra)
+        if missing:
+            self.add_documents([wanted[doc_id] for doc_id in missing], missing,
+                               metadata=[metadata.get(doc_id) for doc_id in missing])
+        with self.doc_lock:
+            self.lsn = lsn
+            self.oplog.clear()
+            self._oplog_docs = 0
+            if self.store is not None:
+                self.store.log_lsn(lsn)
+
+    # --- Rebalancing ---
+    def export_documents(self, shard_map: Dict, after: int = -1,
+                         limit: int = EXPORT_BATCH) -> Dict:
+        """Live documents that `shard_map`'s ring places on another shard.
+
+        Scans in doc_id order from just after `after`, returning up to
+        `limit` documents with their new owners and embeddings (exact if
+        float32 copies are kept, else decoded), plus a `cursor` to resume
+        from. `done` is set once the scan reaches the end of the shard.
+        """
+        new_map = ShardMap.from_config(shard_map)
+        view, rows, ids = self.live_by_id()
+        start = int(np.searchsorted(ids, after, side='right'))
+        moving, cursor = [], after
+        for i in range(start, len(rows), EXPORT_SCAN):
+            block = rows[i:i + EXPORT_SCAN]
+            owners = new_map.owners([view.documents[row] for row in block])
+            away = np.flatnonzero(owners != self.shard_id)
+            moving.extend(zip(block[away].tolist(), owners[away].tolist()))
+            cursor = int(ids[min(i + EXPORT_SCAN, len(ids)) - 1])
+            if len(moving) >= limit:
+                moving = moving[:limit]
+                cursor = int(view.row_ids[moving[-1][0]])
+                break
+        rows = np.array([row for row, _ in moving], dtype=np.int64)
+        return {
+            'status': 'success',
+            'doc_ids': [int(view.row_ids[row]) for row in rows],
+            'documents': [view.documents[row] for row in rows],
+            'metadata': [view.metadata(row) for row in rows],
+            'owners': [owner for _, owner in moving],
+            'embeddings': view.index.vectors(rows) if len(rows) else np.empty((0, self.dim), np.float32),
+            'cursor': cursor,
+            'done': cursor >= (int(ids[-1]) if len(ids) else after),
+        }
+
+    def sync_loop(self):
+        """Catch up at startup, then keep checking peers for missed operations.
+
+        Writes are refused until a pass reaches a peer and applies all it
+        missed. A replica whose peers are all down would otherwise reuse
+        LSNs they already assigned; with `solo_timeout` it leads alone once
+        that many seconds pass without reaching any.
+        """
+        started = time.monotonic()
+        while True:
             try:
-                send_data(client_socket, {'status': 'error', 'message': str(e)})
-            except:
-                pass
+                if self.catch_up() is not None and not self.caught_up:
+                    self.caught_up = True
+                    logging.info(f"Caught up with peers at LSN {self.lsn}; accepting writes")
+            except Exception as e:
+                logging.error(f"Catch-up failed: {e}")
+            if (not self.caught_up and self.solo_timeout is not None
+                    and time.monotonic() - started >= self.solo_timeout):
+                self.caught_up = True
+                logging.warning(f"No peer of shard {self.shard_id} reachable for {self.solo_timeout:.0f} s; "
+                                f"ACCEPTING WRITES WITHOUT CATCHING UP from LSN {self.lsn}. "
+                                f"If a peer holds later operations, the replicas will diverge.")
+            time.sleep(SYNC_INTERVAL)
+
+    def maybe_compact(self):
+        """Start a background compaction once enough rows are tombstoned."""
+        with self.doc_lock:
+            if self._compacting or self.index.tombstone_ratio < COMPACT_THRESHOLD:
+                return
+            self._compacting = True
+        threading.Thread(target=self.compact, daemon=True).start()
+
+    def compact(self):
+        """Drop tombstoned rows by building a fresh index and swapping it in.
+
+        Runs under `doc_lock`, which only serializes writers; searches use
+        whichever snapshot was current when they started. A persisted shard
+        is checkpointed into a new on-disk generation at the same time.
+        """
+        start = time.perf_counter()
+        try:
+            with self.doc_lock:
+                view = self.view
+                before = len(view.index)
+                if self.store is not None:
+                    files = self.store.checkpoint(view.index.live_rows(), view.index,
+                                                  view.documents, view.attributes,
+                                                  view.row_ids, self._next_seq, self.lsn)
+                    index, keep = view.index.compacted(floats=files.floats)
+                    documents, row_ids = files.documents, files.row_ids
+                    attributes = files.attributes
+                else:
+                    index, keep = view.index.compacted()
+                    documents = [view.documents[row] for row in keep]
+                    attributes = [view.attributes[row] for row in keep]
+                    row_ids = GrowableArray((), np.int64, len(keep))
+                    row_ids.append(view.row_ids[keep])
+                id_to_row = {int(doc_id): row for row, doc_id in enumerate(row_ids.view())}
+                lexical = view.lexical.compacted(keep)
+                filters = view.filters.compacted(keep)
+                content = view.content.compacted(keep)
+                self.view = ShardView(index, documents, row_ids, id_to_row, lexical,
+                                      attributes, filters, content)
+            self.metrics.incr('compactions')
+            self.metrics.observe('compact', 1000 * (time.perf_counter() - start))
+            logging.info(f"Compacted shard: {before} -> {len(index)} rows")
+        except Exception as e:
+            logging.error(f"Error compacting shard: {e}")
         finally:
-            client_socket.close()
+            self._compacting = False
+
+    def live_by_id(self):
+        """(view, live rows, their doc IDs) in doc_id order, for cursor scans.
+
+        The sort is kept until the shard changes, so paging through a
+        large shard doesn't re-sort it for every page.
+        """
+        version = self.version
+        view = self.view
+        cached = self._by_id
+        if cached is not None and cached[0] == version and cached[1] is view:
+            return cached[1:]
+        rows = view.index.live_rows()
+        ids = np.asarray(view.row_ids[rows], dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        self._by_id = (version, view, rows[order], ids[order])
+        return self._by_id[1:]
+
+    def list_documents(self, after: int = -1, limit: int = None) -> Dict:
+        """Live documents (id + text + any metadata) in doc_id order.
+
+        Starts just after the doc_id `after`; with a `limit`, returns at
+        most that many plus a `cursor` (the last ID) to resume from, and
+        `done` once nothing follows.
+        """
+        view, rows, ids = self.live_by_id()
+        start = int(np.searchsorted(ids, after, side='right'))
+        end = len(rows) if limit is None else min(len(rows), start + limit)
+        docs = []
+        for row in rows[start:end]:
+            doc = {'id': int(view.row_ids[row]), 'text': view.documents[row]}
+            metadata = view.metadata(row)
+            if metadata:
+                doc['metadata'] = metadata
+            docs.append(doc)
+        return {'status': 'success', 'documents': docs, 'lsn': self.lsn,
+                'cursor': docs[-1]['id'] if docs else after, 'done': end >= len(rows)}
+
+    def index_info(self, nprobe: int = None) -> Dict:
+        """Report index stats, optionally retuning the IVF probe count."""
+        index = self.index
+        if nprobe is not None:
+            if not hasattr(index, 'nprobe'):
+                return {'status': 'error', 'message': f'{index.kind} index has no nprobe'}
+            index.nprobe = int(nprobe)
+        return {'status': 'success', 'index': index.stats(),
+                'lexical': self.view.lexical.stats(),
+                'metadata': self.view.filters.stats(),
+                'content': self.view.content.stats()}
+
+    def recall(self, top_k: int = 10, queries: int = RECALL_QUERIES) -> Dict:
+        """Measure recall@k of the live index against an exact scan.
+
+        Queries are embeddings of documents sampled from the shard itself.
+        """
+        index = self.index
+        live = index.live_rows()
+        if len(live) == 0:
+            return {'status': 'error', 'message': 'Shard is empty'}
+        rng = np.random.default_rng()
+        sample = rng.choice(live, min(queries, len(live)), replace=False)
+        report = recall_report(index, index.vectors(sample), top_k)
+        return {'status': 'success', 'recall': report}
+
+    def storage_modes(self, top_k: int = 10, queries: int = RECALL_QUERIES) -> Dict:
+        """Compare bytes/doc and recall@k of every storage mode on this shard.
+
+        Needs full-precision vectors (float32 storage or re-rank enabled).
+        """
+        index = self.index
+        if not index.has_float_vectors:
+            return {'status': 'error',
+                    'message': 'Storage comparison needs float32 vectors (use --rerank)'}
+        live = index.live_rows()
+        if len(live) == 0:
+            return {'status': 'error', 'message': 'Shard is empty'}
+        rng = np.random.default_rng()
+        sample = index.vectors(rng.choice(live, min(STORAGE_SAMPLE, len(live)), replace=False))
+        probe = sample[rng.choice(len(sample), min(queries, len(sample)), replace=False)]
+        return {'status': 'success', 'modes': storage_report(sample, probe, top_k)}
+
+    def handle_admin(self, req: Dict) -> Dict:
+        """Run one admin command (add/remove/list/...) and return the reply."""
+        cmd = req.get('command', '').lower()
+
+        if cmd in ('add', 'remove') and req.get('lsn') is None and not self.caught_up:
+            # A returning replica must not allocate IDs/LSNs its peers already used
+            return {'status': 'error', 'message': 'Replica is catching up with its peers'}
+        if cmd == 'add':
+            return self.add_documents(req.get('documents', []), req.get('doc_ids'),
+                                      req.get('lsn'), req.get('embeddings'),
+                                      req.get('metadata'), bool(req.get('dedup', True)),
+                                      req.get('near_duplicate'))
+        elif cmd == 'remove':
+            return self.remove_documents(req.get('doc_ids', []), req.get('lsn'))
+        elif cmd == 'lookup':
+            return self.find_documents(req.get('documents', []))
+        elif cmd == 'oplog':
+            return self.oplog_since(int(req.get('since', 0)))
+        elif cmd == 'export':
+            return self.export_documents(req['shard_map'], int(req.get('after', -1)),
+                                         int(req.get('limit', EXPORT_BATCH)))
+        elif cmd == 'list':
+            limit = req.get('limit')
+            return self.list_documents(int(req.get('after', -1)),
+                                       None if limit is None else max(1, int(limit)))
+        elif cmd == 'index':
+            return self.index_info(req.get('nprobe'))
+        elif cmd == 'recall':
+            return self.recall(int(req.get('top_k', 10)),
+                               int(req.get('queries', RECALL_QUERIES)))
+        elif cmd == 'metrics':
+            resp = {'status': 'success', 'metrics': self.metrics.snapshot()}
+            if self.profiler is not None:
+                resp['profiler'] = self.profiler.stats()
+            return resp
+        elif cmd == 'storage':
+            return self.storage_modes(int(req.get('top_k', 10)),
+                                      int(req.get('queries', RECALL_QUERIES)))
+        return {'status': 'error', 'message': f'Unknown command: {cmd}'}
 
     def start_admin_server(self):
         """Spawn a thread to listen for admin (add/remove/list) connections."""
@@ -152,25 +810,157 @@ class Worker:
                 client, addr = sock.accept()
                 logging.info(f"Admin connection from {addr}")
                 threading.Thread(
-                    target=self.handle_admin_request,
-                    args=(client,),
+                    target=serve_connection,
+                    args=(client, self.handle_admin),
                     daemon=True
                 ).start()
 
         threading.Thread(target=admin_loop, daemon=True).start()
 
-    def compute_similarities(self, query_embedding: np.ndarray, top_k: int = 3
-                            ) -> List[Tuple[int, float]]:
-        """Return top_k (doc_id, score) pairs by cosine similarity."""
+    @staticmethod
+    def to_results(view: ShardView, hits: List) -> List[Dict]:
+        """(row, score) pairs as result dicts (doc_id, document, score, and any metadata)."""
+        results = []
+        for row, score in hits:
+            result = {
+                'doc_id': int(view.row_ids[row]),
+                'document': view.documents[row],
+                'score': score
+            }
+            metadata = view.metadata(row)
+            if metadata:
+                result['metadata'] = metadata
+            results.append(result)
+        return results
+
+    @staticmethod
+    def dense_hits(view: ShardView, query_embedding: np.ndarray, top_k: int,
+                   mask: np.ndarray = None) -> List:
+        if mask is None:
+            return view.index.search(query_embedding, top_k)
+        return view.index.search_filtered(query_embedding, mask, top_k)
+
+    def compute_similarities(self, query_embedding: np.ndarray, top_k: int = DEFAULT_TOP_K,
+                             filter_expr: Dict = None) -> List[Dict]:
+        """Return the top_k results (doc_id, document, score) by inner product.
+
+        With `filter_expr`, only documents whose metadata matches are scored.
+        """
         try:
-            with self.doc_lock:
-                sims = np.dot(self.doc_embeddings, query_embedding.T).squeeze()
-            top_idxs = np.argsort(sims)[-top_k:][::-1]
-            return [(int(i), float(sims[i])) for i in top_idxs]
+            view = self.view  # one consistent snapshot of the shard
+            mask = view.filter_mask(filter_expr)
+            return self.to_results(view, self.dense_hits(view, query_embedding, top_k, mask))
         except Exception as e:
             logging.error(f"Error computing similarities: {e}")
             return []
 
+    def lexical_search(self, query: str, top_k: int = DEFAULT_TOP_K,
+                       filter_expr: Dict = None) -> List[Dict]:
+        """Return the top_k results by BM25 score."""
+        try:
+            view = self.view
+            mask = view.filter_mask(filter_expr)
+            return self.to_results(view, view.lexical.search(query, top_k, mask))
+        except Exception as e:
+            logging.error(f"Error in lexical search: {e}")
+            return []
+
+    def hybrid_search(self, query: str, query_embedding: np.ndarray,
+                      top_k: int = DEFAULT_TOP_K, prefilter: bool = False,
+                      filter_expr: Dict = None) -> Dict:
+        """Dense and lexical top_k lists from one snapshot; the master fuses them.
+
+        With `prefilter`, only the best lexical matches are dense-scored
+        instead of the whole shard, so documents sharing no query term
+        are never returned.
+        """
+        try:
+            view = self.view
+            mask = view.filter_mask(filter_expr)
+            if prefilter:
+                lexical = view.lexical.search(query, max(top_k, PREFILTER_CANDIDATES), mask)
+                rows = np.array([row for row, _ in lexical], dtype=np.int64)
+                dense = view.index.search_rows(query_embedding, rows, top_k)
+                lexical = lexical[:top_k]
+            else:
+                dense = self.dense_hits(view, query_embedding, top_k, mask)
+                lexical = view.lexical.search(query, top_k, mask)
+            return {'results': self.to_results(view, dense),
+                    'lexical': self.to_results(view, lexical)}
+        except Exception as e:
+            logging.error(f"Error in hybrid search: {e}")
+            return {'results': [], 'lexical': []}
+
+    def compute_similarities_batch(self, query_embeddings: np.ndarray, top_k: int = DEFAULT_TOP_K,
+                                   filter_expr: Dict = None) -> List[List[Dict]]:
+        """`compute_similarities` for every row of a (q, dim) query matrix."""
+        try:
+            view = self.view
+            mask = view.filter_mask(filter_expr)
+            if mask is None:
+                batch = view.index.search_batch(query_embeddings, top_k)
+            else:
+                batch = [view.index.search_filtered(query, mask, top_k)
+                         for query in query_embeddings]
+            return [self.to_results(view, hits) for hits in batch]
+        except Exception as e:
+            logging.error(f"Error computing batch similarities: {e}")
+            return [[] for _ in range(len(query_embeddings))]
+
+    def handle_query(self, req: Dict) -> Dict:
+        # Read the version before searching, so results may be newer than
+        # the version they are reported with but never older; a cache keyed
+        # on it can only invalidate too early, never serve stale results
+        version = self.version
+        if req.get('command') == 'version':
+            return {'status': 'success', 'version': version}
+        kind = 'batch' if 'embeddings' in req else req.get('mode', 'dense')
+        start = time.perf_counter()
+        if self.profiler is None:
+            resp = self.search(req, version)
+        else:
+            with self.profiler.profile(f"{kind} query on shard {self.shard_id}",
+                                       threading.get_ident()):
+                resp = self.search(req, version)
+        # The master subtracts this from its round trip to get network time
+        took_ms = 1000 * (time.perf_counter() - start)
+        if resp.get('status') == 'error':
+            self.metrics.incr('query_errors')
+        else:
+            self.metrics.observe(f"search.{kind}", took_ms)
+        return dict(resp, took_ms=round(took_ms, 3))
+
+    def search(self, req: Dict, version: int) -> Dict:
+        """Answer one query request (dense, lexical, hybrid or batch)."""
+        # The master asks for offset + top_k so it can page after merging
+        top_k = min(int(req.get('top_k', DEFAULT_TOP_K)), MAX_TOP_K)
+        mode = req.get('mode', 'dense')
+        if mode not in SEARCH_MODES:
+            return {'status': 'error', 'message': f'Unknown search mode: {mode}'}
+        filter_expr = req.get('filter')
+        if filter_expr is not None:
+            try:
+                check_filter(filter_expr)
+            except ValueError as e:
+                return {'status': 'error', 'message': str(e)}
+        if mode == 'lexical':
+            return {'results': self.lexical_search(req['query'], top_k, filter_expr),
+                    'version': version}
+        if mode == 'hybrid':
+            query_emb = np.asarray(req['embedding'], dtype=np.float32)
+            resp = self.hybrid_search(req['query'], query_emb, top_k,
+                                      bool(req.get('prefilter')), filter_expr)
+            return dict(resp, version=version)
+        if 'embeddings' in req:
+            # Batch: results for all queries go back flattened, with a
+            # per-query count, so they still travel as packed columns
+            query_embs = np.asarray(req['embeddings'], dtype=np.float32).reshape(-1, self.dim)
+            batch = self.compute_similarities_batch(query_embs, top_k, filter_expr)
+            return dict(flatten_results(batch), version=version)
+        query_emb = np.asarray(req['embedding'], dtype=np.float32)
+        return {'results': self.compute_similarities(query_emb, top_k, filter_expr),
+                'version': version}
+
     def start(self):
         """Main loop: accept query connections and return nearest docs."""
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -179,30 +969,17 @@ class Worker:
         sock.listen(5)
         logging.info(f"Worker server listening on port {self.port}")
 
+        # Connections are persistent (the master pools them). Each one gets
+        # a reader thread; its queries run on the shared query pool against
+        # the current snapshot, so they never wait for adds or compaction.
         while True:
             client, addr = sock.accept()
             logging.info(f"Query connection from {addr}")
-            try:
-                raw = receive_data(client)
-                q = json.loads(raw)
-                query_emb = np.array(q['embedding'])
-                results = self.compute_similarities(query_emb)
-
-                resp = {
-                    'results': [
-                        {
-                            'doc_id': doc_id,
-                            'document': self.documents[doc_id],
-                            'score': score
-                        }
-                        for doc_id, score in results
-                    ]
-                }
-                send_data(client, resp)
-            except Exception as e:
-                logging.error(f"Error handling query: {e}")
-            finally:
-                client.close()
+            threading.Thread(
+                target=serve_connection,
+                args=(client, self.handle_query, self.query_pool, self.metrics),
+                daemon=True
+            ).start()
 
 # --- Sample document loader ---
 def load_sample_documents(worker_id: int) -> List[str]:
@@ -232,10 +1009,49 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, required=True,
                         help="Port for the worker server")
-    parser.add_argument("--worker_id", type=int, choices=[1,2], required=True,
-                        help="Worker ID (1 or 2)")
+    parser.add_argument("--worker_id", type=int, required=True,
+                        help="Shard ID this worker serves (1 and 2 start with sample documents)")
+    parser.add_argument("--index", choices=["flat", "ivf"], default="flat",
+                        help="Vector index backend (exact flat scan or IVF ANN)")
+    parser.add_argument("--nlist", type=int, default=256,
+                        help="IVF: number of k-means lists")
+    parser.add_argument("--nprobe", type=int, default=8,
+                        help="IVF: lists scanned per query (recall vs latency)")
+    parser.add_argument("--storage", choices=["float32", "int8", "pq"], default="float32",
+                        help="Embedding storage (int8 ~4x, pq ~16x smaller than float32)")
+    parser.add_argument("--rerank", type=int, default=0,
+                        help="Keep float32 copies and exactly re-rank this many candidates")
+    parser.add_argument("--pq_m", type=int, default=None,
+                        help="PQ: sub-quantizers (bytes per doc); default dim/4")
+    parser.add_argument("--data_dir", type=str, default=None,
+                        help="Persist the shard here and reopen it on restart")
+    parser.add_argument("--query_threads", type=int, default=QUERY_THREADS,
+                        help="Threads scoring queries concurrently")
+    parser.add_argument("--shard_map", type=str, default=None,
+                        help="Shard map JSON; other replicas of this shard become catch-up peers")
+    parser.add_argument("--profile_slow_ms", type=float, default=None,
+                        help="Sample stacks of queries and save profiles of those slower than this")
+    parser.add_argument("--profile_dir", type=str, default=None,
+                        help="Where slow-query profiles go (default: profiles-<port>)")
+    parser.add_argument("--embedding_service", type=str, default=None,
+                        help="Port (or host:port) of embedder.py to encode with instead of "
+                             "loading a model here (default: $EMBEDDING_SERVICE)")
+    parser.add_argument("--solo_timeout", type=float, default=None,
+                        help="Seconds after which a replica that can reach none of its peers "
+                             "accepts writes alone (default: never; risks diverging histories)")
     args = parser.parse_args()
 
+    index_params = {'storage': args.storage, 'rerank': args.rerank}
+    if args.storage == "pq" and args.pq_m:
+        index_params['storage_params'] = {'m': args.pq_m}
+    if args.index == "ivf":
+        index_params.update({'nlist': args.nlist, 'nprobe': args.nprobe})
+
     docs = load_sample_documents(args.worker_id)
-    worker = Worker(args.port, docs)
+    worker = Worker(args.port, docs, shard_id=args.worker_id,
+                    index_kind=args.index, index_params=index_params,
+                    data_dir=args.data_dir, query_threads=args.query_threads,
+                    peers=peers_of(load_shard_map(args.shard_map), args.worker_id, args.port),
+                    profile_slow_ms=args.profile_slow_ms, profile_dir=args.profile_dir,
+                    embedding_service=args.embedding_service, solo_timeout=args.solo_timeout)
     worker.start()